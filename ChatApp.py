@@ -6,9 +6,22 @@ import threading # multi threading: sending and receiving at the same time
 import sys # for CLI
 import os # os.exit()
 import time
+import math
 import json
+import struct # binary wire format
 import queue
+import itertools
+import heapq
+import collections
 import re
+import asyncio # event-loop server engine
+import concurrent.futures # results of pipelined client requests
+import ctypes # sendmmsg for group fan-out, when the platform has it
+import ctypes.util
+import select
+import multiprocessing # sharded server: one worker process per core
+import signal
+import zlib
 
 '''
 UDP Datagram Format
@@ -17,12 +30,24 @@ sender_listening_port:
 sender_name:
 <sender_name> (uniquely identify an instance, like an id)
 msg_type:
-<reg_ack/ack/table/grp_msg/pri_msg> (client may receive)
-<reg/dereg/create_group/list_groups/join_group/leave_group/list_members/send_group/ack/kick> (server may receive)
+<reg_ack/ack/table/snapshot/delta/presence/grp_msg/grp_seq/pri_msg/ping/slow_down> (client may receive)
+<reg/dereg/create_group/list_groups/join_group/leave_group/list_members/send_group/ack/kick/snapshot_req/spool/spool_req/subscribe/unsubscribe/resolve/pong/history/multicast> (server may receive)
 message:
 <actual message>
 '''
 
+# client capabilities, sent as a comma separated list in the message of "reg"
+# a client without capabilities (msg None) is served exactly like before
+CAP_DELTA = "delta" # versioned client table: one snapshot, then small deltas
+CAP_BINARY = "binary" # understands the binary wire format below
+CAP_ZLIB = "zlib" # accepts compressed binary packets (FLAG_ZLIB)
+CAP_BATCH = "batch" # understands deltas carrying several changes (coalesced table broadcasts)
+CAP_PRESENCE = "presence" # no table broadcasts, fetches the peers it talks to with "subscribe" and gets only their changes
+CAP_HEARTBEAT = "heartbeat" # answers the server's "ping" with "pong" (liveness detection, --heartbeat)
+CAP_GROUP_SEQ = "gseq" # gets group messages numbered per group ("grp_seq"), fills gaps with "history"
+CAP_SLOW_DOWN = "slowdown" # told with "slow_down" when over a rate limit, holds back its requests to the server
+CAP_MULTICAST = "mcast" # joins the multicast address of its groups and gets their "grp_seq" from there (--multicast)
+
 
 def packetFormat(sender_listening_port, sender_name, msg_type, msg):
     if msg is None:
@@ -44,14 +69,945 @@ def packetResolve(in_packet):
     return sender_listening_port, sender_name, msg_type, msg
 
 
+'''
+Binary Datagram Format (version 1)
+fixed header, network byte order, 15 bytes:
+magic (1B, 0xC5, a text packet always starts with "p") | version (1B) | msg_type (1B, index in MSG_TYPES) | flags (1B)
+sender_listening_port (2B) | seq (4B, sequence number of a request, echoed in its ack, 0 if none) | name length (1B) | msg length (4B)
+followed by <sender_name> and <message>, both utf-8
+
+Negotiation: a client always sends "reg" in text and lists CAP_BINARY in it.
+Server answers such a client in binary from then on, and a client switches to binary towards
+the server or another client once it received a binary packet from it, so legacy text-only peers keep working.
+
+Compression: with FLAG_ZLIB set, <message> is zlib compressed with the preset dictionary ZLIB_DICTIONARY
+(msg length is the compressed length). Server compresses table broadcasts, snapshots and group messages
+to clients that listed CAP_ZLIB in "reg", and only messages of at least COMPRESS_MIN bytes that get shorter
+'''
+WIRE_TEXT = "text"
+WIRE_BINARY = "binary"
+WIRE_MAGIC = 0xC5
+WIRE_VERSION = 1
+WIRE_HEADER = struct.Struct("!BBBBHIBI")
+FLAG_HAS_MSG = 0x01 # message is not None
+FLAG_ZLIB = 0x02 # message is compressed
+
+# preset dictionary: the strings tables, deltas and snapshots are made of, so even a short message compresses,
+# the most frequent ones last (closest to the data); never change it, both sides have to use the same bytes
+ZLIB_DICTIONARY = (b'{"version": 1, "op": "add", "name": "client", "info": {"ip": "127.0.0.1", "port": 70, "online": false}, '
+                   b'"table": {"client": {"ip": "127.0.0.1", "port": 80, "online": true}, '
+                   b'"client": {"ip": "127.0.0.1", "port": 90, "online": false}}}, '
+                   b'{"version": 2, "op": "status", "name": "client", "info": {"ip": "127.0.0.1", "port": 60, "online": true}}')
+COMPRESS_MIN = 48 # shorter messages are sent raw, zlib would not save enough to pay for itself
+MAX_DECOMPRESSED = 1 << 24 # a compressed message never expands beyond this
+
+
+class Compressor:
+    """
+    compress the messages of binary packets (packetEncode(..., compressor=...)), and count what it saved
+    """
+    def __init__(self, level=6):
+        self.level = level
+        self.packets = 0 # packets sent compressed
+        self.raw_bytes = 0 # their messages before compression
+        self.compressed_bytes = 0 # and after
+
+    def compress(self, msg_bytes):
+        # the compressed message, None when it is not worth it
+        if len(msg_bytes) < COMPRESS_MIN:
+            return None
+        compressor = zlib.compressobj(self.level, zdict=ZLIB_DICTIONARY)
+        compressed = compressor.compress(msg_bytes) + compressor.flush()
+        if len(compressed) >= len(msg_bytes):
+            return None
+        self.packets += 1
+        self.raw_bytes += len(msg_bytes)
+        self.compressed_bytes += len(compressed)
+        return compressed
+
+    def saved(self):
+        return self.raw_bytes - self.compressed_bytes
+
+def decompressMsg(msg_bytes):
+    decompressor = zlib.decompressobj(zdict=ZLIB_DICTIONARY)
+    out = decompressor.decompress(msg_bytes, MAX_DECOMPRESSED)
+    if decompressor.unconsumed_tail:
+        raise ValueError("compressed message too long")
+    return out
+
+MSG_TYPES = ["reg", "reg_ack", "dereg", "kick", "ack", "table", "snapshot", "delta", "snapshot_req",
+             "create_group", "list_groups", "join_group", "list_members", "leave_group", "send_group",
+             "grp_msg", "pri_msg", "spool", "spool_req", "subscribe", "unsubscribe", "presence", "resolve", "ping", "pong", "grp_seq", "history", "slow_down", "multicast"]
+MSG_TYPE_CODE = {msg_type: code for code, msg_type in enumerate(MSG_TYPES)}
+
+
+def packetEncode(sender_listening_port, sender_name, msg_type, msg, wire=WIRE_BINARY, seq=0, compressor=None):
+    # return the encoded datagram (bytes) in the given wire format
+    # the text format has no seq field, a text peer matches acks by sender name only
+    # with a Compressor, a binary packet's message is compressed when that makes it shorter
+    if wire == WIRE_TEXT:
+        return packetFormat(sender_listening_port, sender_name, msg_type, msg).encode()
+    name_bytes = sender_name.encode()
+    if msg is None:
+        return WIRE_HEADER.pack(WIRE_MAGIC, WIRE_VERSION, MSG_TYPE_CODE[msg_type], 0,
+                                sender_listening_port, seq, len(name_bytes), 0) + name_bytes
+    msg_bytes = msg.encode()
+    flags = FLAG_HAS_MSG
+    compressed = compressor.compress(msg_bytes) if compressor is not None else None
+    if compressed is not None:
+        flags |= FLAG_ZLIB
+        msg_bytes = compressed
+    return WIRE_HEADER.pack(WIRE_MAGIC, WIRE_VERSION, MSG_TYPE_CODE[msg_type], flags,
+                            sender_listening_port, seq, len(name_bytes), len(msg_bytes)) + name_bytes + msg_bytes
+
+def packetDecode(in_packet):
+    # accept both wire formats, return the fields of packetResolve and seq (0 for text packets)
+    if in_packet[0] != WIRE_MAGIC:
+        return packetResolve(in_packet) + (0,)
+    magic, version, type_code, flags, sender_listening_port, seq, name_len, msg_len = WIRE_HEADER.unpack_from(in_packet)
+    if version != WIRE_VERSION:
+        raise ValueError(f"unsupported wire version {version}")
+    start = WIRE_HEADER.size
+    sender_name = in_packet[start:start + name_len].decode()
+    start += name_len
+    msg = None
+    if flags & FLAG_HAS_MSG:
+        msg_bytes = in_packet[start:start + msg_len]
+        msg = (decompressMsg(msg_bytes) if flags & FLAG_ZLIB else msg_bytes).decode()
+    return sender_listening_port, sender_name, MSG_TYPES[type_code], msg, seq
+
+# what packetDecode raises on a malformed packet (truncated, unknown version or type, bad zlib data, not utf-8):
+# whoever receives drops such a packet and goes on
+DECODE_ERRORS = (ValueError, IndexError, struct.error, zlib.error)
+
+def packetWire(in_packet):
+    return WIRE_BINARY if in_packet[0] == WIRE_MAGIC else WIRE_TEXT
+
+
+'''
+Fragments
+a binary packet longer than MAX_DATAGRAM is sent as numbered fragments, each at most MAX_DATAGRAM bytes
+(below the usual path MTU of 1500 bytes, so IP never fragments them), header in network byte order, 12 bytes:
+magic (1B, 0xC6) | kind (1B, FRAGMENT_DATA/FRAGMENT_NACK) | fragment id (4B) | index (2B) | count (2B) | sender_listening_port (2B)
+FRAGMENT_DATA: followed by the bytes of the packet from index * chunk size on
+FRAGMENT_NACK: receiver asks for the fragments still missing, count is their number, followed by count indices (2B each)
+text packets are never fragmented, a legacy text peer gets them like before
+'''
+FRAGMENT_MAGIC = 0xC6
+FRAGMENT_HEADER = struct.Struct("!BBIHHH")
+FRAGMENT_DATA = 0
+FRAGMENT_NACK = 1
+MAX_DATAGRAM = 1400
+
+
+class FragmentLayer:
+    """
+    split outgoing packets into fragments and put incoming fragments back together, for one listening port
+    - a split packet keeps its fragments for KEEP_SENT seconds (at most MAX_SENT packets), to answer nacks
+    - at most MAX_PARTIAL packets are reassembled at a time (the oldest is dropped for a new one), each of at most
+      MAX_FRAGMENTS fragments; after NACK_AFTER seconds without a new fragment the missing ones are asked for,
+      MAX_NACKS times at most, and a packet still incomplete after TIMEOUT seconds is dropped
+    expire() has to be called regularly (start() runs a thread for it)
+    send(datagram, addr) sends nacks and retransmitted fragments
+    fragment ids are id_start, id_start + id_step, ... (the sharded server puts its worker number in them)
+    """
+    MAX_FRAGMENTS = 256
+    MAX_PARTIAL = 64
+    MAX_SENT = 256
+    KEEP_SENT = 5.0
+    NACK_AFTER = 0.1
+    MAX_NACKS = 5
+    TIMEOUT = 2.0
+
+    def __init__(self, listening_port, send, id_start=0, id_step=1):
+        self.listening_port = listening_port
+        self.send = send
+        self.id_step = id_step
+        self.next_id = id_start
+        self.running = True
+        self.sent = collections.OrderedDict() # fragment id -> (time, [fragments])
+        self.partial = collections.OrderedDict() # (ip, port, fragment id) -> [count, {index: bytes}, first time, last time, nacks]
+        self.lock = threading.Lock()
+        # metrics
+        self.split_packets = 0
+        self.reassembled = 0
+        self.retransmitted = 0
+        self.dropped = 0
+        self.rejected = 0 # malformed fragments and nacks
+
+    def split(self, packet):
+        # the datagrams to send for packet
+        if len(packet) <= MAX_DATAGRAM or packet[0] != WIRE_MAGIC:
+            return [packet]
+        chunk = MAX_DATAGRAM - FRAGMENT_HEADER.size
+        count = math.ceil(len(packet) / chunk)
+        if count > self.MAX_FRAGMENTS:
+            return [packet] # too long for the receiver anyway
+        with self.lock:
+            frag_id = self.next_id
+            self.next_id = (self.next_id + self.id_step) % (1 << 32)
+            fragments = [FRAGMENT_HEADER.pack(FRAGMENT_MAGIC, FRAGMENT_DATA, frag_id, i, count, self.listening_port) + packet[i * chunk:(i + 1) * chunk]
+                         for i in range(count)]
+            self.sent[frag_id] = (time.monotonic(), fragments)
+            if len(self.sent) > self.MAX_SENT:
+                self.sent.popitem(last=False)
+            self.split_packets += 1
+        return fragments
+
+    def receive(self, data, addr):
+        # return the whole packet, or None while it is incomplete (and for nacks, which are answered here)
+        if not data or data[0] != FRAGMENT_MAGIC:
+            return data
+        if len(data) < FRAGMENT_HEADER.size:
+            self.rejected += 1
+            return None
+        _, kind, frag_id, index, count, port = FRAGMENT_HEADER.unpack_from(data)
+        if kind == FRAGMENT_NACK:
+            if len(data) < FRAGMENT_HEADER.size + 2 * count:
+                self.rejected += 1
+                return None
+            missing = struct.unpack_from(f"!{count}H", data, FRAGMENT_HEADER.size)
+            with self.lock:
+                entry = self.sent.get(frag_id)
+            if entry is not None:
+                fragments = entry[1]
+                for i in missing:
+                    if i < len(fragments):
+                        self.send(fragments[i], (addr[0], port))
+                        self.retransmitted += 1
+            return None
+        now = time.monotonic()
+        key = (addr[0], port, frag_id)
+        with self.lock:
+            partial = self.partial.get(key)
+            # every fragment of a packet has to agree on its count, and its index has to lie below it,
+            # the packet is complete once indices 0..count-1 are all there
+            if count > self.MAX_FRAGMENTS or index >= count or (partial is not None and count != partial[0]):
+                self.rejected += 1
+                return None
+            if partial is None:
+                if len(self.partial) >= self.MAX_PARTIAL:
+                    self.partial.popitem(last=False)
+                    self.dropped += 1
+                partial = self.partial[key] = [count, {}, now, now, 0]
+            partial[1][index] = data[FRAGMENT_HEADER.size:]
+            partial[3] = now
+            if len(partial[1]) < partial[0]:
+                return None
+            del self.partial[key]
+            self.reassembled += 1
+        return b"".join(partial[1][i] for i in range(partial[0]))
+
+    def expire(self, now):
+        nacks = []
+        with self.lock:
+            for key, partial in list(self.partial.items()):
+                if now - partial[2] > self.TIMEOUT:
+                    del self.partial[key]
+                    self.dropped += 1
+                elif now - partial[3] > self.NACK_AFTER and partial[4] < self.MAX_NACKS:
+                    partial[3] = now
+                    partial[4] += 1
+                    nacks.append((key, [i for i in range(partial[0]) if i not in partial[1]]))
+            while self.sent and now - next(iter(self.sent.values()))[0] > self.KEEP_SENT:
+                self.sent.popitem(last=False)
+        for (ip, port, frag_id), missing in nacks:
+            nack = FRAGMENT_HEADER.pack(FRAGMENT_MAGIC, FRAGMENT_NACK, frag_id, 0, len(missing), self.listening_port)
+            self.send(nack + struct.pack(f"!{len(missing)}H", *missing), (ip, port))
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def stop(self):
+        self.running = False
+
+    def run(self):
+        while True:
+            time.sleep(self.NACK_AFTER / 2)
+            if not self.running:
+                return
+            self.expire(time.monotonic())
+
+
+class BatchSender:
+    """
+    send the same datagram to many addresses with as few syscalls as possible
+    Python's socket module has no sendmmsg, so on Linux it is called through ctypes
+    (up to SENDMMSG_BATCH datagrams per syscall, all pointing to one shared buffer);
+    on other platforms, or for addresses that are not IPv4, one sendto per address
+    """
+    SENDMMSG_BATCH = 1024 # UIO_MAXIOV, max datagrams of one sendmmsg call
+    # struct mmsghdr {struct msghdr {name, namelen, iov, iovlen, control, controllen, flags}, msg_len}
+    MMSGHDR = struct.Struct("@PIPNPNi4xI4x")
+    IOVEC = struct.Struct("@PN")
+    SOCKADDR_IN = struct.Struct("=H2s4s8x") # family (host order), port, address (network order)
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.sockaddr_cache = {} # (ip, port) -> packed sockaddr_in
+        self.sendmmsg = None
+        if sys.platform.startswith("linux"):
+            try:
+                libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+                self.sendmmsg = libc.sendmmsg
+                self.sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+                self.sendmmsg.restype = ctypes.c_int
+            except (OSError, AttributeError):
+                self.sendmmsg = None
+
+    def send(self, data, addrs):
+        if len(addrs) == 1: # a reply, one syscall anyway
+            try:
+                self.sock.sendto(data, addrs[0])
+            except OSError:
+                pass
+            return
+        if self.sendmmsg is not None:
+            try:
+                sockaddrs = [self.sockaddr(addr) for addr in addrs]
+            except OSError: # not an IPv4 address, e.g. "localhost"
+                sockaddrs = None
+            if sockaddrs is not None:
+                for start in range(0, len(sockaddrs), self.SENDMMSG_BATCH):
+                    self.sendBatch(data, sockaddrs[start:start + self.SENDMMSG_BATCH])
+                return
+        for addr in addrs:
+            try:
+                self.sock.sendto(data, addr)
+            except OSError:
+                pass
+
+    def sockaddr(self, addr):
+        sockaddr = self.sockaddr_cache.get(addr)
+        if sockaddr is None:
+            if len(self.sockaddr_cache) > 65536:
+                self.sockaddr_cache.clear()
+            sockaddr = self.SOCKADDR_IN.pack(AF_INET, addr[1].to_bytes(2, "big"), inet_aton(addr[0]))
+            self.sockaddr_cache[addr] = sockaddr
+        return sockaddr
+
+    def sendBatch(self, data, sockaddrs):
+        # all buffers stay referenced by local variables until sendmmsg returned
+        data_buf = ctypes.create_string_buffer(data, len(data))
+        iov_buf = ctypes.create_string_buffer(self.IOVEC.pack(ctypes.addressof(data_buf), len(data)))
+        names = b"".join(sockaddrs)
+        names_buf = ctypes.create_string_buffer(names, len(names))
+        names_addr = ctypes.addressof(names_buf)
+        iov_addr = ctypes.addressof(iov_buf)
+        name_len = self.SOCKADDR_IN.size
+        pack = self.MMSGHDR.pack
+        headers = b"".join([pack(names_addr + i * name_len, name_len, iov_addr, 1, 0, 0, 0, 0) for i in range(len(sockaddrs))])
+        headers_buf = ctypes.create_string_buffer(headers, len(headers))
+        sent = 0
+        while sent < len(sockaddrs):
+            n = self.sendmmsg(self.sock.fileno(), ctypes.addressof(headers_buf) + sent * self.MMSGHDR.size, len(sockaddrs) - sent, 0)
+            if n < 0:
+                # the datagram at position "sent" failed, skip it like a failed sendto
+                n = 1
+            sent += n
+
+
+class BatchReceiver:
+    """
+    receive datagrams a batch per wakeup instead of one recvfrom each: block until one arrives, then take
+    everything else already waiting, up to RECVMMSG_BATCH
+    on Linux one recvmmsg call (through ctypes, like sendmmsg) fills a ring of buffers allocated once;
+    elsewhere, or on a socket with a timeout, recvfrom for the first datagram and MSG_DONTWAIT for the rest
+    close() ends the iteration, the socket is closed by its owner once the iterating thread is gone
+    """
+    RECVMMSG_BATCH = 64
+    MSG_WAITFORONE = 0x10000 # recvmmsg: block for the first datagram only
+
+    def __init__(self, sock, max_size=4096):
+        self.sock = sock
+        self.max_size = max_size
+        self.addr_cache = {} # first 8 bytes of a sockaddr_in (family, port, address) as an int -> (ip, port)
+        self.calls = 0 # wakeups
+        self.received = 0 # datagrams
+        self.closed = False
+        self.recvmmsg = None
+        if sys.platform.startswith("linux"):
+            try:
+                libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+                self.recvmmsg = libc.recvmmsg
+                self.recvmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+                self.recvmmsg.restype = ctypes.c_int
+            except (OSError, AttributeError):
+                self.recvmmsg = None
+        if self.recvmmsg is not None:
+            # the ring: RECVMMSG_BATCH slots of max_size bytes, a sockaddr_in, an iovec and an mmsghdr each
+            batch = self.RECVMMSG_BATCH
+            name_len = BatchSender.SOCKADDR_IN.size
+            self.data_buf = ctypes.create_string_buffer(batch * max_size)
+            self.names_buf = ctypes.create_string_buffer(batch * name_len)
+            data_addr, names_addr = ctypes.addressof(self.data_buf), ctypes.addressof(self.names_buf)
+            iovs = b"".join([BatchSender.IOVEC.pack(data_addr + i * max_size, max_size) for i in range(batch)])
+            self.iov_buf = ctypes.create_string_buffer(iovs, len(iovs))
+            iov_addr = ctypes.addressof(self.iov_buf)
+            headers = b"".join([BatchSender.MMSGHDR.pack(names_addr + i * name_len, name_len, iov_addr + i * BatchSender.IOVEC.size, 1, 0, 0, 0, 0)
+                                for i in range(batch)])
+            self.headers_buf = ctypes.create_string_buffer(headers, len(headers))
+            # read without unpacking: msg_len of every mmsghdr, every sockaddr_in as an int
+            self.data_view = memoryview(self.data_buf).cast("B")
+            self.msg_lens = memoryview(self.headers_buf).cast("B").cast("I")[BatchSender.MMSGHDR.size // 4 - 2::BatchSender.MMSGHDR.size // 4]
+            self.name_keys = memoryview(self.names_buf).cast("B").cast("Q")[::name_len // 8]
+
+    def __iter__(self):
+        # every datagram, as they come, until close(): a shut down socket returns nothing (or fails) at once
+        while not self.closed:
+            try:
+                datagrams = self.receive()
+            except TimeoutError:
+                continue # nothing within the socket's timeout: look at closed again
+            except OSError:
+                if self.closed:
+                    return
+                raise
+            if self.closed:
+                return
+            yield from datagrams
+
+    def close(self):
+        # wake up a receive blocked on the socket and end the iteration
+        self.closed = True
+        try:
+            self.sock.shutdown(SHUT_RDWR)
+        except OSError:
+            pass
+
+    def receive(self):
+        # list of (data, addr), at least one datagram
+        self.calls += 1
+        if self.recvmmsg is None or self.sock.gettimeout() is not None:
+            timeout = self.sock.gettimeout()
+            datagrams = [self.sock.recvfrom(self.max_size)]
+            flags = getattr(sys.modules["socket"], "MSG_DONTWAIT", 0)
+            while flags and len(datagrams) < self.RECVMMSG_BATCH:
+                # a socket with a timeout waits it out even with MSG_DONTWAIT: take only what is already there
+                if timeout is not None and not select.select([self.sock], [], [], 0)[0]:
+                    break
+                try:
+                    datagrams.append(self.sock.recvfrom(self.max_size, flags))
+                except (BlockingIOError, InterruptedError, TimeoutError):
+                    break
+            self.received += len(datagrams)
+            return datagrams
+        while True:
+            n = self.recvmmsg(self.sock.fileno(), ctypes.addressof(self.headers_buf), self.RECVMMSG_BATCH, self.MSG_WAITFORONE, None)
+            if n >= 0:
+                break
+            errno = ctypes.get_errno()
+            if errno != 4: # EINTR: try again, like recvfrom
+                raise OSError(errno, os.strerror(errno))
+        # copied out of the ring: the packets outlive this batch (state thread, reply cache, fragments)
+        view, size, addr_cache = self.data_view, self.max_size, self.addr_cache
+        datagrams = [(view[i * size:i * size + msg_len].tobytes(), addr_cache.get(key) or self.addrOf(key))
+                     for i, (msg_len, key) in enumerate(zip(self.msg_lens[:n].tolist(), self.name_keys[:n].tolist()))]
+        self.received += n
+        return datagrams
+
+    def addrOf(self, key):
+        if len(self.addr_cache) > 65536:
+            self.addr_cache.clear()
+        packed = key.to_bytes(8, sys.byteorder)
+        addr = self.addr_cache[key] = (inet_ntoa(packed[4:8]), int.from_bytes(packed[2:4], "big"))
+        return addr
+
+
+class FanoutWorker:
+    """
+    dedicated sender thread for group messages (and, in the threaded engine, another one for replies)
+    the state thread only enqueues (encoded packet, recipient addresses) and moves on,
+    the worker sends it with BatchSender from its own socket, so no socket is shared between threads
+    the queue is bounded: when the worker falls far behind, the state thread waits (backpressure)
+    """
+    def __init__(self, max_jobs=1024, sock=None):
+        self.sock = sock if sock is not None else socket(AF_INET, SOCK_DGRAM)
+        self.sender = BatchSender(self.sock)
+        self.jobs = queue.Queue(maxsize=max_jobs)
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def submit(self, out_packet, addrs):
+        self.jobs.put((out_packet, addrs))
+
+    def run(self):
+        while True:
+            out_packet, addrs = self.jobs.get()
+            self.sender.send(out_packet, addrs)
+
+
+class GroupSlots:
+    """
+    small integer slot for every member of one group, used as bit position in the ack bitmasks
+    a released slot is reused only after REUSE_AFTER seconds, longer than any ack deadline,
+    so the bitmask of a message in flight never points to a member who joined later
+    """
+    REUSE_AFTER = 2.0
+
+    def __init__(self):
+        self.slot_of = {} # member name -> slot
+        self.name_of = {} # slot -> member name
+        self.released = collections.deque() # (release time, slot), oldest first
+        self.next_slot = 0
+
+    def assign(self, name):
+        if name in self.slot_of:
+            return
+        if self.released and self.released[0][0] + self.REUSE_AFTER <= time.monotonic():
+            slot = self.released.popleft()[1]
+        else:
+            slot = self.next_slot
+            self.next_slot += 1
+        self.slot_of[name] = slot
+        self.name_of[slot] = name
+
+    def release(self, name):
+        slot = self.slot_of.pop(name, None)
+        if slot is not None:
+            del self.name_of[slot]
+            self.released.append((time.monotonic(), slot))
+
+    def mask(self, names):
+        mask = 0
+        for name in names:
+            mask |= 1 << self.slot_of[name]
+        return mask
+
+    def names(self, mask):
+        # members behind the set bits, a bit of a member who already left is skipped
+        names = set()
+        while mask:
+            low_bit = mask & -mask
+            name = self.name_of.get(low_bit.bit_length() - 1)
+            if name is not None:
+                names.add(name)
+            mask ^= low_bit
+        return names
+
+
+class AckTimerWheel:
+    """
+    hashed timer wheel owning the ack requirements of every group message in flight
+    a message is identified by an integer id and waits for its deadline with a bitmask of the group
+    slots (GroupSlots) of the recipients that have not acked yet, a few dozen bytes per message.
+    an ack clears one bit in O(1) and a fully acknowledged message is dropped at once.
+    when the wheel reaches a slot, the messages due there timed out and
+    on_expire(group_name, bitmask_of_nonresponsive_recipients) is called for each of them.
+    no locks: only the owner of the server state (state thread or event loop) adds, acks and calls advance() at next_tick
+    """
+    def __init__(self, on_expire, slot_of, tick=0.05, num_slots=64):
+        self.on_expire = on_expire
+        self.slot_of = slot_of # slot_of(group_name, member_name) -> slot or None
+        self.tick = tick
+        self.slots = [[] for _ in range(num_slots)] # ids of the messages due in that slot
+        self.pending = {} # msg_id -> [group_name, bitmask without ack, due tick]
+        self.ticks = 0 # number of ticks done
+        self.next_tick = time.monotonic() + tick
+
+    def add(self, msg_id, group_name, mask, timeout):
+        if not mask:
+            return
+        due = self.ticks + max(0, math.ceil((time.monotonic() + timeout - self.next_tick) / self.tick))
+        self.pending[msg_id] = [group_name, mask, due]
+        self.slots[due % len(self.slots)].append(msg_id)
+
+    def ack(self, msg_id, recipient):
+        entry = self.pending.get(msg_id)
+        if entry is None:
+            return # late ack, the message already expired
+        slot = self.slot_of(entry[0], recipient)
+        if slot is not None:
+            entry[1] &= ~(1 << slot)
+            if not entry[1]:
+                del self.pending[msg_id]
+
+    def pendingCount(self):
+        # number of group messages still waiting for acks
+        return len(self.pending)
+
+    def advance(self, now):
+        expired = []
+        while now >= self.next_tick:
+            slot = self.slots[self.ticks % len(self.slots)]
+            later = [] # due after more turns of the wheel
+            for msg_id in slot:
+                entry = self.pending.get(msg_id)
+                if entry is None:
+                    continue # fully acked
+                if entry[2] > self.ticks:
+                    later.append(msg_id)
+                    continue
+                del self.pending[msg_id]
+                expired.append((entry[0], entry[1]))
+            slot[:] = later
+            self.ticks += 1
+            self.next_tick += self.tick
+        # call back once the wheel is moved, on_expire may add new messages
+        for group_name, mask in expired:
+            self.on_expire(group_name, mask)
+
+
+REPLY_CACHE_SIZE = 64 # replies remembered per client, a client's requests in flight are never further apart (Client.window)
+TABLE_MAX_STALE_WINDOWS = 5 # coalesced table changes wait at most this many windows, even if more keep coming
+MAX_COMMANDS = 65536 # requests waiting for the server's state thread, more are dropped
+MAX_SUBSCRIPTIONS = 1024 # names one client may subscribe to, beyond that it gets addresses without their changes
+RATE_BURST = 2 # sec of its rate a token bucket holds, a burst up to that passes at once
+RATE_MAX_KEYS = 65536 # token buckets kept per limiter, the least recently used one is forgotten (comes back full)
+SHED_COMMANDS = 16384 # requests waiting for the state thread above which only CONTROL_TYPES are queued
+SHED_RETRY = 0.2 # sec a client told to slow down because of shedding waits
+CONTROL_TYPES = ("ack", "pong", "dereg") # answers and goodbyes free state: never rate limited nor shed
+MULTICAST_NET = "239.255" # group multicast addresses are in 239.255.0.0/16 (organization-local scope)
+
+
+class RateLimiter:
+    """
+    token buckets by key (a sender, a group), each refills at rate tokens per sec up to burst, a request takes one
+    only the RATE_MAX_KEYS most recently used buckets are kept
+    """
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.buckets = collections.OrderedDict() # key -> [tokens, time.monotonic() of the last refill]
+
+    def take(self, key, now):
+        # 0 if the request may pass, else the sec until the bucket has a token again
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = [self.burst, now]
+            if len(self.buckets) > RATE_MAX_KEYS:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(key)
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return 0
+        return (1 - bucket[0]) / self.rate
+
+
+class StateStore:
+    """
+    server state on disk, in directory path:
+    - state.wal: append-only write-ahead log, one json event per line, written before the reply leaves
+      {"op": "reg", "name": ..., "ip": ..., "port": ..., "caps": [...]}, {"op": "offline", "name": ...},
+      {"op": "compact", "names": [...]}, {"op": "group", "group": ...},
+      {"op": "join"/"leave", "group": ..., "name": ...}, {"op": "evict", "group": ..., "names": [...]},
+      {"op": "seqs", "group": ..., "upto": ...} (group message seqs up to upto are taken, see GROUP_SEQ_RESERVE)
+    - state.snap: compact json snapshot of the whole state, rewritten every SNAPSHOT_EVERY events,
+      after which the log starts over; read once on start, then the log is replayed on top of it
+    every event can be applied twice without harm, except that reg/offline bump the table version,
+    which only the owner of the server state logs (state thread or event loop), the same one that takes snapshots:
+    appends and snapshots never run at the same time, no lock
+    the log is flushed to the OS on every event: a crashed server loses nothing, a crashed machine may lose the tail
+    """
+    SNAPSHOT_EVERY = 10000
+
+    def __init__(self, path):
+        os.makedirs(path, exist_ok=True)
+        self.wal_path = os.path.join(path, "state.wal")
+        self.snap_path = os.path.join(path, "state.snap")
+        self.wal = None
+        self.events = 0 # events since the last snapshot
+
+    @staticmethod
+    def emptyState():
+        return {"version": 0, "clients": {}, "tombstones": [], "groups": {}, "group_seqs": {}}
+
+    def load(self):
+        # read-only, may also be used on the store of another sharded worker
+        state = self.emptyState()
+        if os.path.exists(self.snap_path) and os.path.getsize(self.snap_path):
+            with open(self.snap_path, "rb") as f:
+                state = json.load(f) # one read of the whole file, parsed as it is
+        events = 0
+        if os.path.exists(self.wal_path):
+            with open(self.wal_path, "rb") as f:
+                for line in f:
+                    try:
+                        event = json.loads(line)
+                    except ValueError:
+                        break # torn last line of a crash
+                    self.applyEvent(state, event)
+                    events += 1
+        self.events = events
+        return state
+
+    @staticmethod
+    def applyEvent(state, event):
+        op = event["op"]
+        clients = state["clients"]
+        groups = state["groups"]
+        if op == "reg":
+            clients[event["name"]] = {"ip": event["ip"], "port": event["port"], "online": True, "caps": event["caps"]}
+            state["version"] += 1
+        elif op == "offline":
+            clients[event["name"]]["online"] = False
+            state["version"] += 1
+        elif op == "compact":
+            for name in event["names"]:
+                clients.pop(name, None)
+            state["tombstones"].extend(event["names"])
+            for members in groups.values():
+                members[:] = [name for name in members if name not in event["names"]]
+        elif op == "group":
+            groups.setdefault(event["group"], [])
+        elif op == "join":
+            if event["name"] not in groups[event["group"]]:
+                groups[event["group"]].append(event["name"])
+        elif op == "leave":
+            if event["name"] in groups[event["group"]]:
+                groups[event["group"]].remove(event["name"])
+        elif op == "evict":
+            groups[event["group"]] = [name for name in groups[event["group"]] if name not in event["names"]]
+        elif op == "seqs":
+            group_seqs = state.setdefault("group_seqs", {})
+            group_seqs[event["group"]] = max(group_seqs.get(event["group"], 0), event["upto"])
+
+    def append(self, event):
+        if self.wal is None:
+            self.wal = open(self.wal_path, "ab")
+        self.wal.write(json.dumps(event).encode() + b"\n")
+        self.wal.flush()
+        self.events += 1
+
+    def snapshotDue(self):
+        return self.events >= self.SNAPSHOT_EVERY
+
+    def snapshot(self, state):
+        # write the new snapshot next to the old one, switch atomically, then start a new log
+        tmp_path = self.snap_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(json.dumps(state).encode())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snap_path)
+        if self.wal is not None:
+            self.wal.close()
+        self.wal = open(self.wal_path, "wb")
+        self.events = 0
+
+
+class MessageSpool:
+    """
+    private messages kept by the server for offline clients, delivered when the client registers again
+    per recipient a queue of at most max_per_recipient messages, the oldest is evicted when a new one comes in;
+    all queues together hold at most max_bytes of text (utf-8), beyond that new messages are rejected
+    with a directory, every queue is also a file <directory>/<hex of recipient>.spool (one json [sender, text] per line),
+    appended on every message, rewritten on eviction and deleted once delivered, and read back on start
+    """
+    def __init__(self, max_per_recipient=100, max_bytes=16 * 1024 * 1024, path=None):
+        self.max_per_recipient = max_per_recipient
+        self.max_bytes = max_bytes
+        self.path = path
+        self.queues = {} # recipient -> deque of (sender, text)
+        self.bytes = 0
+        self.lock = threading.Lock()
+        # metrics
+        self.queued = 0
+        self.delivered = 0
+        self.evicted = 0
+        self.rejected = 0
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+            for file_name in os.listdir(path):
+                if file_name.endswith(".spool"):
+                    with open(os.path.join(path, file_name), "rb") as f:
+                        queue_ = collections.deque(tuple(json.loads(line)) for line in f if line.strip())
+                    self.queues[bytes.fromhex(file_name[:-len(".spool")]).decode()] = queue_
+                    self.bytes += sum(len(text.encode()) for _, text in queue_)
+
+    def filePath(self, recipient):
+        return os.path.join(self.path, recipient.encode().hex() + ".spool")
+
+    def put(self, recipient, sender, text):
+        # return: "queued" or "full"
+        size = len(text.encode())
+        with self.lock:
+            if self.bytes + size > self.max_bytes:
+                self.rejected += 1
+                return "full"
+            queue_ = self.queues.setdefault(recipient, collections.deque())
+            queue_.append((sender, text))
+            self.bytes += size
+            self.queued += 1
+            evicted = False
+            while len(queue_) > self.max_per_recipient:
+                _, old_text = queue_.popleft()
+                self.bytes -= len(old_text.encode())
+                self.evicted += 1
+                evicted = True
+            if self.path is not None:
+                if evicted:
+                    with open(self.filePath(recipient), "wb") as f:
+                        f.writelines(json.dumps(message).encode() + b"\n" for message in queue_)
+                else:
+                    with open(self.filePath(recipient), "ab") as f:
+                        f.write(json.dumps((sender, text)).encode() + b"\n")
+            return "queued"
+
+    def take(self, recipient, max_size):
+        # oldest messages of recipient that fit into max_size bytes of json (at least one), removed from the spool
+        with self.lock:
+            queue_ = self.queues.get(recipient)
+            if not queue_:
+                return []
+            batch = []
+            size = 2
+            while queue_ and (not batch or size + len(json.dumps(queue_[0])) + 1 <= max_size):
+                message = queue_.popleft()
+                size += len(json.dumps(message)) + 1
+                batch.append(message)
+                self.bytes -= len(message[1].encode())
+            self.delivered += len(batch)
+            if self.path is not None:
+                if queue_:
+                    with open(self.filePath(recipient), "wb") as f:
+                        f.writelines(json.dumps(message).encode() + b"\n" for message in queue_)
+                else:
+                    os.remove(self.filePath(recipient))
+            if not queue_:
+                del self.queues[recipient]
+            return batch
+
+    def pending(self, recipient):
+        with self.lock:
+            return len(self.queues.get(recipient, ()))
+
+    def drop(self, recipient):
+        # recipient is gone for good (compacted)
+        with self.lock:
+            queue_ = self.queues.pop(recipient, None)
+            if queue_:
+                self.bytes -= sum(len(text.encode()) for _, text in queue_)
+                self.evicted += len(queue_)
+                if self.path is not None:
+                    os.remove(self.filePath(recipient))
+
+    def stats(self):
+        with self.lock:
+            return {"recipients": len(self.queues), "messages": sum(len(queue_) for queue_ in self.queues.values()), "bytes": self.bytes,
+                    "queued": self.queued, "delivered": self.delivered, "evicted": self.evicted, "rejected": self.rejected}
+
+
+SPOOL_BATCH_SIZE = 3000 # bytes of spooled messages per reply, clients receive at most 4096 bytes
+GROUP_HISTORY_SIZE = 256 # group messages kept per group for members catching up
+HISTORY_BATCH_SIZE = 3000 # bytes of kept group messages per reply, like SPOOL_BATCH_SIZE
+GROUP_MAX_MISSES = 3 # group acks in a row a CAP_GROUP_SEQ member may miss before it is evicted
+GROUP_ACK_TIMEOUT = 0.5 # sec a group message waits for the acks of its recipients
+GROUP_SEQ_RESERVE = 1024 # group message seqs logged as taken at a time, a restarted server goes on after the last reserved one
+
+
+class Histogram:
+    """
+    counts of values in power-of-two buckets (bucket i: values below 2 ** i), plus count, sum and max
+    values are integers, e.g. microseconds or number of recipients
+    """
+    NUM_BUCKETS = 32
+
+    def __init__(self):
+        self.lock = threading.Lock() # recorded by the owner of the server state, summed up by serveStats()
+        self.buckets = [0] * self.NUM_BUCKETS
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, value):
+        with self.lock:
+            self.buckets[min(int(value).bit_length(), self.NUM_BUCKETS - 1)] += 1
+            self.count += 1
+            self.total += value
+            if value > self.max:
+                self.max = value
+
+    def percentile(self, p):
+        # upper bound of the bucket the p-th percentile falls into
+        rank = self.count * p / 100
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= rank:
+                return min(2 ** i - 1, self.max)
+        return self.max
+
+    def summary(self):
+        with self.lock:
+            return {"count": self.count, "mean": self.total / self.count if self.count else 0, "max": self.max,
+                    "p50": self.percentile(50), "p99": self.percentile(99)}
+
+
+class ServerMetrics:
+    """
+    counters and histograms of the server's hot path, cheap enough to be always on
+    - "requests" / "latency_us": per msg_type, number handled and time spent handling one (decode to last send/enqueue)
+    - "queue_wait_us": time a command waited in the state thread's queue (the threaded engines), where requests
+      wait for each other now that the state has a single owner instead of locks
+    - "fanout_size": recipients per group message
+    - "counters": ack timeouts, evicted members, retransmitted requests answered from reply_cache, ...
+    snapshot() adds the gauges of the server (queue depths, ...) given to it
+    """
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.requests = collections.Counter()
+        self.latency = {msg_type: Histogram() for msg_type in MSG_TYPES}
+        self.queue_wait = Histogram()
+        self.fanout_size = Histogram()
+        self.counters = collections.Counter()
+        self.counter_lock = threading.Lock()
+
+    def count(self, name, n=1):
+        with self.counter_lock:
+            self.counters[name] += n
+
+    def handled(self, msg_type, started):
+        # called by the owner of the server state only (state thread or event loop)
+        self.requests[msg_type] += 1
+        self.latency[msg_type].record(int((time.perf_counter() - started) * 1e6))
+
+    def snapshot(self, gauges):
+        with self.counter_lock:
+            counters = dict(self.counters)
+        return {
+            "uptime": time.monotonic() - self.started_at,
+            "requests": dict(self.requests),
+            "latency_us": {msg_type: histogram.summary() for msg_type, histogram in self.latency.items() if histogram.count},
+            "queue_wait_us": self.queue_wait.summary(),
+            "fanout_size": self.fanout_size.summary(),
+            "counters": counters,
+            "gauges": gauges,
+        }
+
+
+# server output: VERBOSE_QUIET only start up and errors, VERBOSE_EVENTS one line per account/group change,
+# VERBOSE_TABLES also the whole client/group table after every change, listings and group messages (the old output)
+VERBOSE_QUIET = 0
+VERBOSE_EVENTS = 1
+VERBOSE_TABLES = 2
+
+
 class Server:
-    def __init__(self, server_listen_port):
+    REPLY_THREADS = True # receive and reply from threads (BatchReceiver, reply worker), not through an event loop
+
+    def __init__(self, server_listen_port, compact_offline=None, state_dir=None, spool_limit=0, stats_port=None, verbosity=VERBOSE_EVENTS, table_window=0, heartbeat=0, heartbeat_misses=3, rate_limit=0, group_rate_limit=0, multicast_port=0):
         self.host = '127.0.0.1'
         self.server_listen_port = server_listen_port # client know this by default
-        self.server_listen_socket = socket(AF_INET, SOCK_DGRAM)
-        self.server_listen_socket.bind((self.host, self.server_listen_port))
-
-        self.server_send_socket = socket(AF_INET, SOCK_DGRAM) # randomly assign a port number
+        self.server_listen_socket = self.bindListenSocket()
+        self.receiver = None
+        if self.REPLY_THREADS:
+            self.receiver = BatchReceiver(self.server_listen_socket) # all datagrams waiting at a wakeup, one syscall
+
+        # instrumentation of the hot path (ServerMetrics), sent as json to whoever sends a datagram to the stats port
+        self.metrics = ServerMetrics()
+        self.stats_port = stats_port
+        self.verbosity = verbosity
+
+        self.reply_worker = None
+        if self.REPLY_THREADS:
+            self.server_send_socket = socket(AF_INET, SOCK_DGRAM) # randomly assign a port number
+            self.reply_worker = FanoutWorker(sock=self.server_send_socket) # the only thread sending from server_send_socket
+        self.fanout_worker = FanoutWorker() # sends group messages from its own socket and thread
+        # packets longer than MAX_DATAGRAM leave as fragments, fragments of long requests are put back together
+        self.fragments = FragmentLayer(server_listen_port, self.sendDatagram)
 
         print(">>> Server is online")
 
@@ -59,6 +1015,8 @@ class Server:
         # nickname is like an id, uniquely identify each instance, no matter online or offline
         # allow registration of same (IP, port) if the previous user already offline
         # disallow change from offline to online, can only create a new account (otherwise hard to handle complex duplicate (ip, port) problem
+        # EXCEPT with the message spool (spool_limit > 0, --spool): an offline client may register again under its name,
+        # possibly at a new address (online_addrs keeps addresses unique), and fetches the messages kept for it
         self.client_table = {}
         """
         client_table is a dictionary 
@@ -78,6 +1036,65 @@ class Server:
 
         self.onlineMembers = set()
 
+        # (ip, port) of every online client -> its name, registration checks addresses in O(1)
+        self.online_addrs = {}
+
+        # tombstone compaction (off unless compact_offline is given): once compact_offline accounts went offline,
+        # they are dropped from client_table, group tables and caches, only their names stay in tombstones,
+        # so names are still never reused but client_table, snapshots and tables only hold live accounts
+        self.compact_offline = compact_offline
+        self.offline_names = [] # gone offline since the last compaction
+        self.tombstones = set()
+
+        # capabilities each client announced in its "reg" message
+        self.client_caps = {}
+        # compresses what is sent to CAP_ZLIB clients, and counts the bytes it saved
+        self.compressor = Compressor()
+
+        # last replies to each client by request seq: a retransmitted request gets the same reply again
+        # instead of being executed twice (e.g. create_group answering "exists" to its own retry)
+        self.reply_cache = {} # name -> OrderedDict(seq -> reply packet), at most REPLY_CACHE_SIZE each
+
+        # every change of client_table increases table_version by one
+        # clients with CAP_DELTA receive a versioned snapshot on registration and then one small delta per change
+        # {"version": 3, "op": "add"/"status", "name": "clientName", "info": {"ip": ..., "port": ..., "online": ...}}
+        # a client that sees a version gap asks for a new snapshot with "snapshot_req"
+        self.table_version = 0
+
+        # coalesced table broadcasts (off unless table_window is given): during a registration storm the changes
+        # of table_window seconds go out as one broadcast, instead of one broadcast to every online member per change
+        self.table_window = table_window
+        self.table_max_stale = table_window * TABLE_MAX_STALE_WINDOWS
+        self.table_changes = [] # changes not broadcast yet, {"version": ..., "op": ..., "name": ..., "info": ...}
+        self.table_changes_since = None
+        self.table_flush_at = None # time of the next broadcast, None without pending changes
+
+        # interest-based presence: clients with CAP_PRESENCE get no table broadcasts, they look up the peers they
+        # talk to with "subscribe" and from then on get a "presence" push {name: info} only when one of those changes,
+        # so push traffic follows who talks to whom instead of every online member times every change
+        self.subscribers = {} # name -> names of the online clients subscribed to it
+        self.subscriptions = {} # subscriber -> names it subscribed to
+
+        # heartbeats (off unless heartbeat is given, in seconds): every heartbeat seconds the online CAP_HEARTBEAT clients
+        # the server did not hear from since the last round get a "ping" and answer "pong"; one that misses a ping is
+        # suspected, after heartbeat_misses missed pings it is set offline like a kicked client, so senders find it
+        # offline in their table instead of waiting for acks, and a group member that is known to be alive
+        # is not evicted for one lost group message
+        self.heartbeat_interval = heartbeat
+        self.heartbeat_misses = heartbeat_misses
+        self.heartbeat_at = time.monotonic() + heartbeat if heartbeat else None # time of the next round
+        self.heartbeat_round = 0.0 # time of the last round
+        self.last_seen = {} # online CAP_HEARTBEAT client -> time.monotonic() of its last packet
+        self.probed = set() # pinged in the last round
+        self.suspects = {} # name -> pings in a row it did not answer
+
+        # rate limits (off unless rate_limit / group_rate_limit is given, requests per sec): every sender and every group
+        # has a token bucket that is checked on the receive thread before a request is queued, so a client flooding
+        # send_group costs a dict lookup instead of a fan-out per message; a CAP_SLOW_DOWN client is told with
+        # "slow_down" how many msec to wait and paces its requests to the server, others just retransmit later
+        self.sender_limiter = RateLimiter(rate_limit, rate_limit * RATE_BURST) if rate_limit else None
+        self.group_limiter = RateLimiter(group_rate_limit, group_rate_limit * RATE_BURST) if group_rate_limit else None
+
         # group name uniquely identify a group, disallow duplicated name
         # disallow ";" in groupname, because need to send group name list to client using ;
         self.group_table = {}
@@ -89,22 +1106,156 @@ class Server:
         }
         """
 
-        # acknowledgements of group messages received
-        # Q: good format?
-        # if senderA sends sequential grp msg (because already received ack from server, can move on to send another grp msg)
-        # if senderA send grp msg, server deal with it, between then senderB send grp msg
-        self.ack_dict = {}
+        # every member of a group has a small slot number in it, the bit of that member in ack bitmasks
+        self.group_slots = {}
         """
         {
-            ("senderA", msg1_timestamp): {"member1": False, "member2": False, ...},
-            ("senderB", msg1_timestamp): {"member3": False, "member4": False, ...}, 
+            "groupA_name": GroupSlots (slot_of: {"member1": 0, "member2": 1, ...}),
             ...
         }
         """
 
-        self.ack_lock = threading.Lock()
-        self.send_lock = threading.Lock()
-        self.group_lock = threading.Lock()
+        # every group message gets the next seq of its group, and the last GROUP_HISTORY_SIZE of them are kept,
+        # so a CAP_GROUP_SEQ member shows them in order and fetches the ones it missed with "history"
+        # instead of being evicted for one lost message (it is evicted after GROUP_MAX_MISSES acks in a row)
+        # with a state directory, seqs are logged as taken GROUP_SEQ_RESERVE at a time, so a restarted server goes on
+        # after the last reserved one: its seqs are higher than all before, and members skip at most that many
+        self.group_seqs = {} # group name -> seq of its last message
+        self.group_seqs_reserved = {} # group name -> seqs up to this one are logged as taken
+        self.group_history = {} # group name -> deque of (seq, sender, text)
+        self.ack_misses = {} # name -> group acks in a row it did not send
+        self.group_acked = {} # name -> time.monotonic() of its last group ack
+
+        # multicast fan-out (off unless multicast_port is given): every group has a multicast address (multicastAddr),
+        # announced to CAP_MULTICAST members on join_group; a member that joined it says so with "multicast", from then on
+        # one datagram from the fan-out socket reaches all those members of the group instead of one per member.
+        # acks stay per member: one that misses an ack gets the group's messages by unicast again (and the lost one from history)
+        self.multicast_port = multicast_port
+        self.multicast_members = {} # group name -> members getting its messages by multicast
+        if multicast_port:
+            try:
+                self.fanout_worker.sock.setsockopt(IPPROTO_IP, IP_MULTICAST_IF, inet_aton(self.host))
+                self.fanout_worker.sock.setsockopt(IPPROTO_IP, IP_MULTICAST_TTL, 1) # this host / LAN only
+                self.fanout_worker.sock.setsockopt(IPPROTO_IP, IP_MULTICAST_LOOP, 1) # members on this host
+            except OSError:
+                print(">>> Multicast not available, group messages are sent by unicast")
+                self.multicast_port = 0
+
+        # acknowledgements of group messages received
+        # every grp msg gets an integer id from the server and waits in the wheel for 0.5 sec with the bitmask
+        # of its recipients that did not ack yet; members that have not acked by then are removed from the group
+        self.msg_ids = itertools.count(1)
+        self.ack_wheel = AckTimerWheel(on_expire=self.evictNonresponsive, slot_of=self.slotOf)
+        """
+        shards: {
+            msg_id1: ["groupA_name", 0b0110 (slots of member2, member3), due tick],
+            msg_id2: ["groupB_name", 0b1 (slot of member4), due tick],
+            ...
+        }
+        """
+
+        # single owner instead of locks: one state thread (serverState) owns client_table, group_table, onlineMembers,
+        # the ack wheel and the caches, and runs the commands (function, args) the I/O threads put into this queue;
+        # the receive thread only reassembles and decodes, the workers only send
+        # (the asyncio engine runs the commands right away, its event loop is the owner)
+        self.commands = queue.SimpleQueue()
+
+        # private messages for offline clients (MessageSpool), on disk next to the persistent state
+        self.spool = None
+        if spool_limit > 0:
+            self.spool = MessageSpool(spool_limit, path=os.path.join(state_dir, "spool") if state_dir is not None else None)
+
+        # persistent state (StateStore), only with a state directory: accounts and groups survive a restart
+        self.store = None
+        if state_dir is not None:
+            self.store = StateStore(state_dir)
+            started_at = time.monotonic()
+            self.restoreState(self.store.load())
+            print(f">>> Restored {len(self.client_table)} clients and {len(self.group_table)} groups in {time.monotonic() - started_at:.3f}s")
+
+    def restoreState(self, state):
+        self.table_version = state["version"]
+        for name, info in state["clients"].items():
+            self.client_table[name] = {"ip": info["ip"], "port": info["port"], "online": info["online"]}
+            self.client_caps[name] = set(info["caps"])
+            if info["online"]:
+                self.onlineMembers.add(name)
+                self.online_addrs[(info["ip"], info["port"])] = name
+                if self.heartbeat_interval and CAP_HEARTBEAT in self.client_caps[name]:
+                    self.last_seen[name] = time.monotonic() # gone meanwhile: found by the next heartbeats
+        self.tombstones.update(state["tombstones"])
+        for group_name, upto in state.get("group_seqs", {}).items():
+            self.group_seqs[group_name] = self.group_seqs_reserved[group_name] = upto
+        for group_name, members in state["groups"].items():
+            self.group_table[group_name] = set(members)
+            self.group_slots[group_name] = GroupSlots()
+            for member in members:
+                self.group_slots[group_name].assign(member)
+
+    def dumpState(self):
+        clients = {name: dict(info, caps=sorted(self.client_caps.get(name, ()))) for name, info in self.client_table.items()}
+        groups = {group_name: sorted(members) for group_name, members in self.group_table.items()}
+        return {"version": self.table_version, "clients": clients, "tombstones": sorted(self.tombstones), "groups": groups,
+                "group_seqs": dict(self.group_seqs_reserved)}
+
+    def logEvent(self, event):
+        if self.store is not None:
+            self.store.append(event)
+
+    def bindListenSocket(self):
+        listen_socket = socket(AF_INET, SOCK_DGRAM)
+        listen_socket.bind((self.host, self.server_listen_port))
+        return listen_socket
+
+    def statsGauges(self):
+        # current sizes of the server's queues and tables, read when stats are asked for
+        gauges = {
+            "clients": len(self.client_table),
+            "online": len(self.onlineMembers),
+            "groups": len(self.group_table),
+            "ack_pending": self.ack_wheel.pendingCount(),
+            "command_queue": self.commands.qsize(),
+            "fanout_queue": self.fanout_worker.jobs.qsize(),
+            "reply_cache": sum(len(replies) for replies in list(self.reply_cache.values())),
+            "subscriptions": sum(len(names) for names in list(self.subscriptions.values())),
+            "heartbeat_clients": len(self.last_seen),
+            "heartbeat_suspects": len(self.suspects),
+            "multicast_members": sum(len(names) for names in list(self.multicast_members.values())),
+            "rate_buckets": sum(len(limiter.buckets) for limiter in (self.sender_limiter, self.group_limiter) if limiter is not None),
+            "fragments_partial": len(self.fragments.partial),
+            "fragments_reassembled": self.fragments.reassembled,
+            "fragments_retransmitted": self.fragments.retransmitted,
+            "fragments_dropped": self.fragments.dropped,
+            "fragments_rejected": self.fragments.rejected,
+            "compressed_packets": self.compressor.packets,
+            "compression_saved_bytes": self.compressor.saved(),
+            "threads": threading.active_count(),
+        }
+        if self.reply_worker is not None:
+            gauges["reply_queue"] = self.reply_worker.jobs.qsize()
+        if self.receiver is not None:
+            gauges["receive_calls"] = self.receiver.calls
+            gauges["received_datagrams"] = self.receiver.received
+        if self.spool is not None:
+            gauges["spool"] = self.spool.stats()
+        return gauges
+
+    def startStats(self):
+        # stats port (off unless stats_port is given): any datagram to it is answered with the metrics as json
+        if self.stats_port is None:
+            return
+        self.stats_socket = socket(AF_INET, SOCK_DGRAM)
+        self.stats_socket.bind((self.host, self.stats_port))
+        threading.Thread(target=self.serveStats, daemon=True).start()
+
+    def serveStats(self):
+        while True:
+            _, addr = self.stats_socket.recvfrom(64)
+            stats = json.dumps(self.metrics.snapshot(self.statsGauges())).encode()
+            try:
+                self.stats_socket.sendto(stats, addr)
+            except OSError:
+                pass # e.g. longer than a datagram
 
     def checkDuplicatedAddr(self, client_table, ip, port):
         """
@@ -112,13 +1263,7 @@ class Server:
         notice that new client can use the same addr if the previous user is offline
         return: True (being taken); False (valid)
         """
-        effective_addr = []
-        for name, info in self.client_table.items():
-            if info["online"]:
-                effective_addr.append((info["ip"], info["port"]))
-        if (ip, port) in effective_addr:
-            return True
-        return False
+        return (ip, port) in self.online_addrs
 
     def checkDuplicatedName(self, client_table, name):
         """
@@ -126,357 +1271,1774 @@ class Server:
         return: True (duplicated); False (valid)
         """
 
-        if name in client_table:
+        if name in self.tombstones:
             return True
+        if name in client_table:
+            # with the spool, an offline client comes back under its name
+            return self.spool is None or client_table[name]["online"]
         return False
 
     # main thread: sit listening for client req, but not ack
+    # main thread: sit listening for client req, the state thread handles them
     def serverMode(self):
+        threading.Thread(target=self.serverState, daemon=True).start()
+        self.fragments.start()
+        self.startStats()
+        # print(">>> Server is listening")
+        for data, addr in self.receiver:
+            self.serverDatagram(data, addr)
+
+    # state thread: run the commands of the I/O threads one at a time, move the ack wheel
+    # and broadcast coalesced table changes in between
+    def serverState(self):
         while True:
-            # print(">>> Server is listening")
-            in_packet, addr = self.server_listen_socket.recvfrom(4096)
-            sender_listening_port, sender_name, msg_type, in_msg = packetResolve(in_packet)
-            sender_ip = addr[0]
-            # sender_sending_port = addr[1] # useless
-
-            # based on client's request, direct to corresponding server action
-            if msg_type == "reg":
-                """
-                1) if client submit duplicated name/(ip,port), send ack with "not successful" msg
-                2) else, send ack, with no additional msg, add client into table
-                """
+            deadline = self.ack_wheel.next_tick
+            if self.table_flush_at is not None:
+                deadline = min(deadline, self.table_flush_at)
+            if self.heartbeat_at is not None:
+                deadline = min(deadline, self.heartbeat_at)
+            try:
+                command = self.commands.get(timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                command = None
+            if command is not None:
+                enqueued, function, args = command
+                self.metrics.queue_wait.record(int((time.perf_counter() - enqueued) * 1e6))
+                self.serverRun(function, *args)
+            now = time.monotonic()
+            if now >= self.ack_wheel.next_tick:
+                self.serverRun(self.ack_wheel.advance, now)
+            if self.table_flush_at is not None and now >= self.table_flush_at:
+                self.serverRun(self.flushTableChanges)
+            if self.heartbeat_at is not None and now >= self.heartbeat_at:
+                self.serverRun(self.heartbeatRound, now)
+
+    # run one command on the owner of the state: a command that fails is logged and dropped,
+    # the owner goes on with the next one instead of dying and leaving every later request unanswered
+    def serverRun(self, function, *args):
+        try:
+            function(*args)
+        except Exception as error:
+            self.metrics.count("failed_commands")
+            print(f">>> Error in {function.__name__}: {error!r}")
+
+    # hand a command to the owner of the state
+    def serverSubmit(self, function, *args):
+        if self.commands.qsize() >= MAX_COMMANDS:
+            self.metrics.count("dropped_requests") # the state thread is far behind, like a full socket buffer
+            return
+        self.commands.put((time.perf_counter(), function, args))
+
+    # one datagram from the listening socket: a whole packet, or a fragment of one (FragmentLayer)
+    # decoded and admitted here, off the state thread
+    def serverDatagram(self, data, addr, forwarded=False):
+        in_packet = self.fragments.receive(data, addr)
+        if in_packet is not None:
+            try:
+                fields = packetDecode(in_packet)
+            except DECODE_ERRORS:
+                self.metrics.count("malformed_packets")
+                return
+            if self.serverAdmit(in_packet, addr, fields, forwarded):
+                self.serverSubmit(self.serverDispatch, in_packet, addr, fields)
+
+    # rate limits and load shedding, before a request is queued: False if it is dropped
+    # forwarded: the worker that received it already charged the sender (sharded server)
+    def serverAdmit(self, in_packet, addr, fields, forwarded=False):
+        sender_listening_port, sender_name, msg_type, in_msg, seq = fields
+        if msg_type in CONTROL_TYPES:
+            return True
+        if self.commands.qsize() >= SHED_COMMANDS:
+            # the state thread is far behind: its queue is kept for acks, requests are shed before it is full
+            counter, wait = "shed_requests", SHED_RETRY
+        else:
+            now = time.monotonic()
+            counter, wait = None, 0
+            if self.sender_limiter is not None and not forwarded:
+                counter, wait = "throttled_senders", self.sender_limiter.take(sender_name, now)
+            if not wait and self.group_limiter is not None and msg_type == "send_group" and in_msg is not None:
+                group_name = in_msg.split(";", maxsplit=1)[0]
+                if self.limitsGroup(group_name):
+                    counter, wait = "throttled_groups", self.group_limiter.take(group_name, now)
+            if not wait:
+                return True
+        self.metrics.count(counter)
+        if seq and CAP_SLOW_DOWN in self.client_caps.get(sender_name, ()):
+            out_packet = packetEncode(sender_listening_port=self.server_listen_port, sender_name="server", msg_type="slow_down",
+                                      msg=str(max(1, int(wait * 1000))), wire=packetWire(in_packet), seq=seq)
+            self.sendDatagram(out_packet, (addr[0], sender_listening_port))
+            self.metrics.count("slow_downs")
+        return False
 
-                regSuccess = False
-                if self.checkDuplicatedName(self.client_table, sender_name):
-                    out_msg = "Name taken."
-                elif self.checkDuplicatedAddr(self.client_table, sender_ip, sender_listening_port):
-                    out_msg = "(IP, port) combination taken."
-                else:
-                    out_msg = "Successfully registered."
-                    # add client into client_table
-                    self.client_table[sender_name] = {
-                        "ip": sender_ip,
-                        "port": sender_listening_port,
-                        "online": True
-                    }
-                    # add client into onlineMembers list
-                    self.onlineMembers.add(sender_name)
+    def limitsGroup(self, group_name):
+        # the rate of a group is counted where its messages are fanned out
+        return True
+
+    # handle one incoming packet (fields: packetDecode(in_packet), decoded here if not given), shared by every server engine,
+    # on the owner of the state
+    # replies go through serverReply/serverFanout and ack deadlines live in ack_wheel,
+    # so an engine only has to decide how packets are sent and how the wheel is moved
+    def serverDispatch(self, in_packet, addr, fields=None):
+        started = time.perf_counter()
+        if fields is None:
+            fields = packetDecode(in_packet)
+        msg_type = self.serverHandle(in_packet, addr, fields)
+        self.metrics.handled(msg_type, started)
+        # snapshots are taken here, between two requests, by the thread that changes client_table
+        if self.store is not None and self.store.snapshotDue():
+            self.store.snapshot(self.dumpState())
+
+    def serverHandle(self, in_packet, addr, fields):
+        sender_listening_port, sender_name, msg_type, in_msg, seq = fields
+        wire = packetWire(in_packet) # reply in the format of the request, with the seq of the request
+        sender_ip = addr[0]
+        # sender_sending_port = addr[1] # useless
+
+        # any packet of a client shows it is alive, not only its pongs
+        if sender_name in self.last_seen:
+            self.last_seen[sender_name] = time.monotonic()
+            self.suspects.pop(sender_name, None)
+
+        if seq:
+            replies = self.reply_cache.get(sender_name)
+            if replies is not None and seq in replies:
+                self.serverReply(replies[seq], sender_ip, sender_listening_port)
+                self.metrics.count("reply_cache_hits")
+                return msg_type
+
+        # based on client's request, direct to corresponding server action
+        if msg_type == "reg":
+            """
+            1) if client submit duplicated name/(ip,port), send ack with "not successful" msg
+            2) else, send ack, with no additional msg, add client into table
+            """
+
+            regSuccess = False
+            if self.checkDuplicatedName(self.client_table, sender_name):
+                out_msg = "Name taken."
+            elif self.checkDuplicatedAddr(self.client_table, sender_ip, sender_listening_port):
+                out_msg = "(IP, port) combination taken."
+            else:
+                out_msg = "Successfully registered."
+                # a client coming back starts its seqs anew
+                self.reply_cache.pop(sender_name, None)
+                # add client into client_table
+                self.client_table[sender_name] = {
+                    "ip": sender_ip,
+                    "port": sender_listening_port,
+                    "online": True
+                }
+                # add client into onlineMembers list
+                self.onlineMembers.add(sender_name)
+                self.online_addrs[(sender_ip, sender_listening_port)] = sender_name
+                self.client_caps[sender_name] = set(in_msg.split(",")) if in_msg else set()
+                if self.heartbeat_interval and CAP_HEARTBEAT in self.client_caps[sender_name]:
+                    self.last_seen[sender_name] = time.monotonic()
+                self.logEvent({"op": "reg", "name": sender_name, "ip": sender_ip, "port": sender_listening_port, "caps": sorted(self.client_caps[sender_name])})
+                # registration always arrives in text, answer in binary if the client can read it
+                wire = self.wireOf(sender_name)
+                if self.verbosity >= VERBOSE_TABLES:
                     print(">>> Client table updated.")
                     print(self.client_table)
-                    regSuccess = True
-                out_packet = packetFormat(sender_listening_port=self.server_listen_port, sender_name="server", msg_type="reg_ack", msg=out_msg)
-
-                # send ack to requested client (start the serverRespond thread)
-                # NOTICE: each sender has two ports, should send to sender's listening port
-                # Q: reason for using a sub-thread for respond: we want to quickly move on to the next round or while-loop,
-                # so that server can listen to future incoming msg while processing the following req of the previous msg
-                threading.Thread(target=self.serverRespond, args=(out_packet, sender_ip, sender_listening_port)).start()
-                # print("Server registration ack thread starts")
-
-                if regSuccess:
-                    # broadcast new client_table to all onlineMembers, do not need ack
-                    # print("START: Broadcast client_table update to online members")
-                    for onlineMember in self.onlineMembers:
-                        out_msg = json.dumps(self.client_table)  # dict -> string
-                        out_packet = packetFormat(sender_listening_port=self.server_listen_port, sender_name="server", msg_type="table", msg=out_msg)
-                        threading.Thread(target=self.serverRespond, args=(out_packet, self.client_table[onlineMember]["ip"], self.client_table[onlineMember]["port"])).start()
-                    # print("FINISH: Broadcast client_table update to online members")
-
-            elif msg_type == "dereg":
-                # change the client's online status to "offline"
-                self.client_table[sender_name]["online"] = False
-                self.onlineMembers.remove(sender_name)
-                print(">>> Client table updated.")
-                print(self.client_table)
+                regSuccess = True
+            out_packet = packetEncode(sender_listening_port=self.server_listen_port, sender_name="server", msg_type="reg_ack", msg=out_msg, wire=wire, seq=seq)
 
-                # send ack to requested client (start the serverRespond thread)
-                out_packet = packetFormat(sender_listening_port=self.server_listen_port, sender_name="server", msg_type="ack", msg=None)
-                threading.Thread(target=self.serverRespond, args=(out_packet, sender_ip, sender_listening_port)).start()
+            # send ack to requested client (queued for the reply worker)
+            # NOTICE: each sender has two ports, should send to sender's listening port
+            # Q: reason for using a sub-thread for respond: we want to quickly move on to the next round or while-loop,
+            # so that server can listen to future incoming msg while processing the following req of the previous msg
+            self.serverAck(out_packet, sender_name, seq, sender_ip, sender_listening_port)
+            # print("Server registration ack thread starts")
 
+            if regSuccess:
                 # broadcast new client_table to all onlineMembers, do not need ack
-                for onlineMember in self.onlineMembers:
-                    out_msg = json.dumps(self.client_table)
-                    out_packet = packetFormat(sender_listening_port=self.server_listen_port, sender_name="server", msg_type="table", msg=out_msg)
-                    threading.Thread(target=self.serverRespond, args=(out_packet, self.client_table[onlineMember]["ip"], self.client_table[onlineMember]["port"])).start()
-
-
-            elif msg_type == "kick":
-                # if clientA not received clientB's ack, clientA report to server, server change clientB to offline
-                kick_name = in_msg
-
-                # scenario: X dereg itself, then Y find out X is offline, so report to server,
-                # but X already not in onlineMembers set, and X's online_status already changed to offline,
-                # so client_table shouldn't be considered as updated
-                if kick_name in self.onlineMembers:
-                    self.client_table[kick_name]["online"] = False
-                    self.onlineMembers.remove(kick_name)
+                self.broadcastTableChange("add", sender_name)
+
+        elif msg_type == "dereg":
+            # a client set offline meanwhile (kick, heartbeat) only gets its ack
+            was_online = sender_name in self.onlineMembers
+            if was_online:
+                # change the client's online status to "offline"
+                self.client_table[sender_name]["online"] = False
+                self.onlineMembers.remove(sender_name)
+                self.online_addrs.pop((self.client_table[sender_name]["ip"], self.client_table[sender_name]["port"]), None)
+                self.last_seen.pop(sender_name, None)
+                self.suspects.pop(sender_name, None)
+                self.logEvent({"op": "offline", "name": sender_name})
+                if self.verbosity >= VERBOSE_TABLES:
                     print(">>> Client table updated.")
                     print(self.client_table)
 
-                    # broadcast client_table
-                    for onlineMember in self.onlineMembers:
-                        out_msg = json.dumps(self.client_table)
-                        out_packet = packetFormat(sender_listening_port=self.server_listen_port, sender_name="server", msg_type="table", msg=out_msg)
-                        threading.Thread(target=self.serverRespond, args=(out_packet, self.client_table[onlineMember]["ip"], self.client_table[onlineMember]["port"])).start()
-
-                # need to send ack back, see explanation on client side
-                # send ack to requested client (start the serverRespond thread)
-                out_packet = packetFormat(sender_listening_port=self.server_listen_port, sender_name="server", msg_type="ack", msg=None)
-                threading.Thread(target=self.serverRespond, args=(out_packet, sender_ip, sender_listening_port)).start()
-
-
-            elif msg_type == "create_group":
-                # check if the group name exists,
-                group_name = in_msg
-                with self.group_lock:
-                    if group_name in self.group_table:
-                        # NOTE: to check if a key is presented, better not use .get(), because will return False if value is NULL (e.g. an empty dict {})
-                        out_msg = "exists"
-                        print(f">>> Client {sender_name} creating group {group_name} failed, group already exists")
-                    else:
-                        self.group_table[group_name] = set()
-                        print(f">>> Client {sender_name} created group {group_name} successfully")
-                        out_msg = "created"
-                        print(">>> Group table updated.")
-                        print(self.group_table)
-
-                out_packet = packetFormat(sender_listening_port=self.server_listen_port, sender_name="server", msg_type="ack", msg=out_msg)
-                threading.Thread(target=self.serverRespond, args=(out_packet, sender_ip, sender_listening_port)).start()
+            # send ack to requested client (queued for the reply worker)
+            out_packet = packetEncode(sender_listening_port=self.server_listen_port, sender_name="server", msg_type="ack", msg=None, wire=wire, seq=seq)
+            self.serverAck(out_packet, sender_name, seq, sender_ip, sender_listening_port)
 
-            elif msg_type == "list_groups":
+            if was_online:
+                # broadcast new client_table to all onlineMembers, do not need ack
+                self.broadcastTableChange("status", sender_name)
+                self.dropSubscriptions(sender_name)
+                self.retireOffline(sender_name)
+
+        elif msg_type == "pong":
+            pass # answer to a ping, last_seen is already updated above
+
+
+        elif msg_type == "kick":
+            # if clientA not received clientB's ack, clientA report to server, server change clientB to offline
+            kick_name = in_msg
+
+            # scenario: X dereg itself, then Y find out X is offline, so report to server,
+            # but X already not in onlineMembers set, and X's online_status already changed to offline,
+            # so client_table shouldn't be considered as updated
+            if kick_name in self.onlineMembers:
+                self.markOffline(kick_name)
+
+            # need to send ack back, see explanation on client side
+            # send ack to requested client (queued for the reply worker)
+            out_packet = packetEncode(sender_listening_port=self.server_listen_port, sender_name="server", msg_type="ack", msg=None, wire=wire, seq=seq)
+            self.serverAck(out_packet, sender_name, seq, sender_ip, sender_listening_port)
+
+
+        elif msg_type == "spool":
+            # private message for a client that is offline, kept until it registers again
+            recipient, text = in_msg.split(";", maxsplit=1)
+            if recipient not in self.client_table:
+                out_msg = "not exists"
+            elif self.client_table[recipient]["online"]:
+                # the sender's table is stale, the recipient is back: "online;ip;port", the sender delivers it directly
+                # (the spool is only fetched right after registering, a message kept now would wait for the next time)
+                out_msg = ";".join(["online", self.client_table[recipient]["ip"], str(self.client_table[recipient]["port"])])
+            elif self.spool is None:
+                out_msg = "not queued"
+            else:
+                out_msg = self.spool.put(recipient, sender_name, text)
+                if self.verbosity >= VERBOSE_EVENTS:
+                    print(f">>> Client {sender_name} left a message for {recipient}: {out_msg}")
+            out_packet = packetEncode(sender_listening_port=self.server_listen_port, sender_name="server", msg_type="ack", msg=out_msg, wire=wire, seq=seq)
+            self.serverAck(out_packet, sender_name, seq, sender_ip, sender_listening_port)
+
+        elif msg_type == "spool_req":
+            # client fetches its kept messages, one batch per request, None when there are no more
+            # a retransmitted request gets the same batch again from reply_cache
+            batch = self.spool.take(sender_name, SPOOL_BATCH_SIZE) if self.spool is not None else []
+            out_msg = json.dumps(batch) if batch else None
+            if batch:
+                if self.verbosity >= VERBOSE_EVENTS:
+                    print(f">>> Delivered {len(batch)} kept messages to {sender_name}, spool: {self.spool.stats()}")
+            out_packet = packetEncode(sender_listening_port=self.server_listen_port, sender_name="server", msg_type="ack", msg=out_msg, wire=wire, seq=seq)
+            self.serverAck(out_packet, sender_name, seq, sender_ip, sender_listening_port)
+
+        elif msg_type == "snapshot_req":
+            # client detected a gap in the table versions, send a full versioned snapshot, do not need ack
+            self.serverReply(self.snapshotPacket(wire, self.compressorOf(sender_name)), sender_ip, sender_listening_port)
+
+        elif msg_type == "resolve":
+            # client looks up a peer it has no (fresh) address of: ack with its client_table entry (json), None if there is no such client
+            # "name;ip;port": the client got no ack from it at that address, if it is still online there it is set offline first
+            # (like kick), so a failed delivery costs one round trip instead of a kick and waiting for the next broadcast
+            target_name, _, unreachable = in_msg.partition(";")
+            out_msg = None
+            info = self.client_table.get(target_name)
+            if info is not None:
+                if unreachable and target_name in self.onlineMembers:
+                    ip, port = unreachable.split(";")
+                    if (info["ip"], info["port"]) == (ip, int(port)):
+                        self.markOffline(target_name) # info stays valid, even if the account is compacted right away
+                out_msg = json.dumps(info)
+            out_packet = packetEncode(sender_listening_port=self.server_listen_port, sender_name="server", msg_type="ack", msg=out_msg, wire=wire, seq=seq)
+            self.serverAck(out_packet, sender_name, seq, sender_ip, sender_listening_port)
+
+        elif msg_type == "subscribe":
+            # presence client looks up a peer: ack with its client_table entry (json), None if there is no such client,
+            # and push its later changes to the subscriber
+            target_name = in_msg
+            out_msg = None
+            if target_name in self.client_table:
+                out_msg = json.dumps(self.client_table[target_name])
+                names = self.subscriptions.setdefault(sender_name, set())
+                if target_name in names or len(names) < MAX_SUBSCRIPTIONS:
+                    names.add(target_name)
+                    self.subscribers.setdefault(target_name, set()).add(sender_name)
+            out_packet = packetEncode(sender_listening_port=self.server_listen_port, sender_name="server", msg_type="ack", msg=out_msg, wire=wire, seq=seq)
+            self.serverAck(out_packet, sender_name, seq, sender_ip, sender_listening_port)
+
+        elif msg_type == "unsubscribe":
+            target_name = in_msg
+            self.subscriptions.get(sender_name, set()).discard(target_name)
+            self.subscribers.get(target_name, set()).discard(sender_name)
+            out_packet = packetEncode(sender_listening_port=self.server_listen_port, sender_name="server", msg_type="ack", msg=None, wire=wire, seq=seq)
+            self.serverAck(out_packet, sender_name, seq, sender_ip, sender_listening_port)
+
+        elif msg_type == "create_group":
+            # check if the group name exists,
+            group_name = in_msg
+            if group_name in self.group_table:
+                # NOTE: to check if a key is presented, better not use .get(), because will return False if value is NULL (e.g. an empty dict {})
+                out_msg = "exists"
+                if self.verbosity >= VERBOSE_EVENTS:
+                    print(f">>> Client {sender_name} creating group {group_name} failed, group already exists")
+            else:
+                self.group_table[group_name] = set()
+                self.group_slots[group_name] = GroupSlots()
+                self.logEvent({"op": "group", "group": group_name})
+                if self.verbosity >= VERBOSE_EVENTS:
+                    print(f">>> Client {sender_name} created group {group_name} successfully")
+                out_msg = "created"
+                if self.verbosity >= VERBOSE_TABLES:
+                    print(">>> Group table updated.")
+                    print(self.group_table)
+
+            out_packet = packetEncode(sender_listening_port=self.server_listen_port, sender_name="server", msg_type="ack", msg=out_msg, wire=wire, seq=seq)
+            self.serverAck(out_packet, sender_name, seq, sender_ip, sender_listening_port)
+
+        elif msg_type == "list_groups":
+            if self.verbosity >= VERBOSE_TABLES:
                 print(f">>> Client {sender_name} requested listing groups, current groups:")
                 for group_name in self.group_table:
                     print(">>> " + group_name)
 
-                # send ack with group_table  (start the serverRespond thread)
-                with self.group_lock:
-                    out_msg = ';'.join(list(self.group_table.keys())) # if group_table is empty, out_msg=None
-                out_packet = packetFormat(sender_listening_port=self.server_listen_port, sender_name="server", msg_type="ack", msg=out_msg)
-                threading.Thread(target=self.serverRespond, args=(out_packet, sender_ip, sender_listening_port)).start()
-
-            elif msg_type == "join_group":
-                # check if the group name exists,
-                group_name = in_msg
-                with self.group_lock:
-                    if group_name in self.group_table:
-                        out_msg = "joined"
-                        self.group_table[group_name].add(sender_name)
-                        print(f">>> Client {sender_name} joined group {group_name}")
-                        print(">>> Group table updated.")
-                        print(self.group_table)
-                    else:
-                        print(f">>> Client {sender_name} joining group {group_name} failed, group does not exist")
-                        out_msg = "not exists"
-
-                out_packet = packetFormat(sender_listening_port=self.server_listen_port, sender_name="server", msg_type="ack", msg=out_msg)
-                threading.Thread(target=self.serverRespond, args=(out_packet, sender_ip, sender_listening_port)).start()
-
-            elif msg_type == "list_members":
-                group_name = in_msg
-                with self.group_lock:
-                    member_names = list(self.group_table[group_name])
-                # check if sender still in group (because may be kick off before due to no-ack of grp-msg)
-                if sender_name not in member_names:
-                    out_msg = "already not in group"
-                else:
-                    out_msg = ";".join(member_names)  # members in that group, names seperated by ;
+            # send ack with group_table  (queued for the reply worker)
+            out_msg = ';'.join(list(self.group_table.keys())) # if group_table is empty, out_msg=None
+            out_packet = packetEncode(sender_listening_port=self.server_listen_port, sender_name="server", msg_type="ack", msg=out_msg, wire=wire, seq=seq)
+            self.serverAck(out_packet, sender_name, seq, sender_ip, sender_listening_port)
+
+        elif msg_type == "join_group":
+            # check if the group name exists,
+            group_name = in_msg
+            if group_name in self.group_table:
+                out_msg = "joined"
+                if CAP_GROUP_SEQ in self.client_caps.get(sender_name, ()):
+                    # the seq of the group's last message, the new member's messages start after it
+                    out_msg = "joined;" + str(self.group_seqs.get(group_name, 0))
+                    if self.multicast_port and {CAP_MULTICAST, CAP_BINARY} <= self.client_caps[sender_name]:
+                        # unicast until the member tells that it joined the group's multicast address
+                        multicast_ip, multicast_port = self.multicastAddr(group_name)
+                        out_msg += f";{multicast_ip}:{multicast_port}"
+                        self.multicast_members.get(group_name, set()).discard(sender_name)
+                self.group_table[group_name].add(sender_name)
+                self.group_slots[group_name].assign(sender_name)
+                self.logEvent({"op": "join", "group": group_name, "name": sender_name})
+                if self.verbosity >= VERBOSE_EVENTS:
+                    print(f">>> Client {sender_name} joined group {group_name}")
+                if self.verbosity >= VERBOSE_TABLES:
+                    print(">>> Group table updated.")
+                    print(self.group_table)
+            else:
+                if self.verbosity >= VERBOSE_EVENTS:
+                    print(f">>> Client {sender_name} joining group {group_name} failed, group does not exist")
+                out_msg = "not exists"
+
+            out_packet = packetEncode(sender_listening_port=self.server_listen_port, sender_name="server", msg_type="ack", msg=out_msg, wire=wire, seq=seq)
+            self.serverAck(out_packet, sender_name, seq, sender_ip, sender_listening_port)
+
+        elif msg_type == "list_members":
+            group_name = in_msg
+            member_names = list(self.group_table.get(group_name, ()))
+            # check if sender still in group (because may be kick off before due to no-ack of grp-msg)
+            if group_name not in self.group_table:
+                out_msg = "not exists"
+            elif sender_name not in member_names:
+                out_msg = "already not in group"
+            else:
+                out_msg = ";".join(member_names)  # members in that group, names seperated by ;
+                if self.verbosity >= VERBOSE_TABLES:
                     print(f">>> Client {sender_name} requested listing members of group {group_name}:")
                     for member_name in member_names:
                         print(">>> " + member_name)
 
-                out_packet = packetFormat(sender_listening_port=self.server_listen_port, sender_name="server", msg_type="ack", msg=out_msg)
-                threading.Thread(target=self.serverRespond, args=(out_packet, sender_ip, sender_listening_port)).start()
-
-            elif msg_type == "leave_group":
-                # ADD: check if sender still in group (because may be kick off before due to no-ack of grp-msg)
-                group_name = in_msg
-                with self.group_lock:
-                    member_names = list(self.group_table[group_name])
+            out_packet = packetEncode(sender_listening_port=self.server_listen_port, sender_name="server", msg_type="ack", msg=out_msg, wire=wire, seq=seq)
+            self.serverAck(out_packet, sender_name, seq, sender_ip, sender_listening_port)
 
-                    # check if sender still in group (because may be kick off before due to no-ack of grp-msg)
-                    if sender_name not in member_names:
-                        out_msg = "already not in group"
-                    else:
-                        out_msg = None
-                        self.group_table[group_name].remove(sender_name)
-                        print(f">>> Client {sender_name} left group")
-                        print(">>> Group table updated.")
-                        print(self.group_table)
-
-                out_packet = packetFormat(sender_listening_port=self.server_listen_port, sender_name="server", msg_type="ack", msg=out_msg)
-                threading.Thread(target=self.serverRespond, args=(out_packet, sender_ip, sender_listening_port)).start()
+        elif msg_type == "leave_group":
+            # ADD: check if sender still in group (because may be kick off before due to no-ack of grp-msg)
+            group_name = in_msg
+            member_names = list(self.group_table.get(group_name, ()))
 
-            # server received acks from all other group members
-            elif msg_type == "ack":
-                grp_msg_receiver = sender_name
-                # the below two elements uniquely identify a grp msg
-                grp_msg_sender = in_msg.split(";")[0]
-                msg_time = in_msg.split(";")[1]
-                # print("Receved grp msg ack from" + grp_msg_receiver)
-                # print("grp_msg_sender is: " + grp_msg_sender)
-                # print("msg_time is: " + msg_time)
-
-                # update ack_dict, need to lock ack dict
-                with self.ack_lock:
-                    # print("Modify ack_dict")
-                    self.ack_dict[(grp_msg_sender, msg_time)][grp_msg_receiver] = True
-                    # print("ack_dict looks like")
-                    # print(self.ack_dict)
+            # check if sender still in group (because may be kick off before due to no-ack of grp-msg)
+            if group_name not in self.group_table:
+                out_msg = "not exists"
+            elif sender_name not in member_names:
+                out_msg = "already not in group"
+            else:
+                out_msg = None
+                self.group_table[group_name].remove(sender_name)
+                self.group_slots[group_name].release(sender_name)
+                self.multicast_members.get(group_name, set()).discard(sender_name)
+                self.logEvent({"op": "leave", "group": group_name, "name": sender_name})
+                if self.verbosity >= VERBOSE_EVENTS:
+                    print(f">>> Client {sender_name} left group")
+                if self.verbosity >= VERBOSE_TABLES:
+                    print(">>> Group table updated.")
+                    print(self.group_table)
+
+            out_packet = packetEncode(sender_listening_port=self.server_listen_port, sender_name="server", msg_type="ack", msg=out_msg, wire=wire, seq=seq)
+            self.serverAck(out_packet, sender_name, seq, sender_ip, sender_listening_port)
+
+        elif msg_type == "multicast":
+            # group_name: the sender joined the multicast address of the group, send it the group's messages there
+            group_name = in_msg
+            if sender_name not in self.group_table.get(group_name, ()):
+                out_msg = "already not in group"
+            else:
+                out_msg = None
+                self.multicast_members.setdefault(group_name, set()).add(sender_name)
+            out_packet = packetEncode(sender_listening_port=self.server_listen_port, sender_name="server", msg_type="ack", msg=out_msg, wire=wire, seq=seq)
+            self.serverAck(out_packet, sender_name, seq, sender_ip, sender_listening_port)
+
+        elif msg_type == "history":
+            """
+            kept messages of a group the sender is in: group_name;first;last
+            (first < 0: the newest -first messages, last empty: up to the newest)
+            ack: {"seq": seq of the group's last message, "messages": [[seq, sender, text], ...]} of at most
+            HISTORY_BATCH_SIZE bytes, the client asks again for the rest
+            """
+            group_name, first, last = in_msg.split(";")
+            if sender_name not in self.group_table.get(group_name, ()):
+                out_msg = "already not in group"
+            else:
+                newest = self.group_seqs.get(group_name, 0)
+                first = int(first)
+                last = int(last) if last else newest
+                if first < 0:
+                    first = newest + first + 1
+                messages = []
+                size = 0
+                for group_seq, grp_msg_sender, text in self.group_history.get(group_name, ()):
+                    if first <= group_seq <= last:
+                        size += len(grp_msg_sender) + len(text) + 32
+                        if messages and size > HISTORY_BATCH_SIZE:
+                            break
+                        messages.append([group_seq, grp_msg_sender, text])
+                out_msg = json.dumps({"seq": newest, "messages": messages})
+            out_packet = packetEncode(sender_listening_port=self.server_listen_port, sender_name="server", msg_type="ack", msg=out_msg, wire=wire, seq=seq)
+            self.serverAck(out_packet, sender_name, seq, sender_ip, sender_listening_port)
+
+        # server received acks from all other group members
+        elif msg_type == "ack":
+            grp_msg_receiver = sender_name
+            # the client echoes "sender;msg_id" of the grp msg, msg_id alone identifies it
+            grp_msg_sender, msg_id = in_msg.split(";", maxsplit=1)
+
+            # update the ack requirements
+            self.ack_misses.pop(grp_msg_receiver, None)
+            self.group_acked[grp_msg_receiver] = time.monotonic()
+            try:
+                self.ack_wheel.ack(int(msg_id), grp_msg_receiver)
+            except ValueError:
+                self.metrics.count("unknown_acks") # not an id given by this server
 
 
-            elif msg_type == "send_group":
-                """
-                group_name;long_group_messages...
-                """
-                group_name = in_msg.split(";", maxsplit=1)[0]
-                group_msg = in_msg.split(";", maxsplit=1)[1]
+        elif msg_type == "send_group":
+            """
+            group_name;long_group_messages...
+            """
+            group_name, group_msg = in_msg.split(";", maxsplit=1)
+            if self.verbosity >= VERBOSE_TABLES:
                 print(f">>> Client {sender_name} sent group message: {group_msg}")
 
-                with self.group_lock:
-                    member_names = list(self.group_table[group_name])
-                    # list of recipients, except sender.
-                    # My def of recipients: all members in the group table, regardless of their online status
-                    # Reason: since I disallow duplicated names, won't hurt if server tries to send to an offline client
-                    # besides, this def allows server delete the offline client from group table, if no ack received
-                    recipients = [member for member in self.group_table[group_name] if member != sender_name]
-
-                # check if sender still in group (because may be kick off before due to no-ack of grp-msg)
-                if sender_name not in member_names:
-                    out_packet = packetFormat(sender_listening_port=self.server_listen_port, sender_name="server", msg_type="ack", msg="already not in group")
-                    threading.Thread(target=self.serverRespond, args=(out_packet, sender_ip, sender_listening_port)).start()
+            if group_name not in self.group_table:
+                out_packet = packetEncode(sender_listening_port=self.server_listen_port, sender_name="server", msg_type="ack", msg="not exists", wire=wire, seq=seq)
+                self.serverAck(out_packet, sender_name, seq, sender_ip, sender_listening_port)
+                return msg_type
+
+            member_names = list(self.group_table[group_name])
+            # list of recipients, except sender.
+            # My def of recipients: all members in the group table, regardless of their online status
+            # Reason: since I disallow duplicated names, won't hurt if server tries to send to an offline client
+            # besides, this def allows server delete the offline client from group table, if no ack received
+            recipients = [member for member in self.group_table[group_name] if member != sender_name]
+            # a member without a client_table entry here (its replicated entry was lost, sharded server) gets nothing
+            # and owes no ack, its entry is asked for again; it catches up when it gets the next message
+            missing = [member for member in recipients if member not in self.client_table]
+            if missing:
+                recipients = [member for member in recipients if member in self.client_table]
+                self.metrics.count("missing_recipients", len(missing))
+                self.resyncClients(missing)
+            if sender_name in member_names:
+                recipients_mask = self.group_slots[group_name].mask(recipients)
+
+            # check if sender still in group (because may be kick off before due to no-ack of grp-msg)
+            if sender_name not in member_names:
+                out_packet = packetEncode(sender_listening_port=self.server_listen_port, sender_name="server", msg_type="ack", msg="already not in group", wire=wire, seq=seq)
+                self.serverAck(out_packet, sender_name, seq, sender_ip, sender_listening_port)
+                return msg_type
+
+            # the next seq of the group, kept in its history
+            group_seq = self.group_seqs[group_name] = self.group_seqs.get(group_name, 0) + 1
+            if self.store is not None and group_seq > self.group_seqs_reserved.get(group_name, 0):
+                self.group_seqs_reserved[group_name] = group_seq + GROUP_SEQ_RESERVE - 1
+                self.logEvent({"op": "seqs", "group": group_name, "upto": self.group_seqs_reserved[group_name]})
+            self.group_history.setdefault(group_name, collections.deque(maxlen=GROUP_HISTORY_SIZE)).append((group_seq, sender_name, group_msg))
+
+            # if sender still in group, reply ack to sender (with the seq of its message, so it does not take it for a gap)
+            out_msg = str(group_seq) if CAP_GROUP_SEQ in self.client_caps.get(sender_name, ()) else None
+            out_packet = packetEncode(sender_listening_port=self.server_listen_port, sender_name="server", msg_type="ack", msg=out_msg, wire=wire, seq=seq)
+            self.serverAck(out_packet, sender_name, seq, sender_ip, sender_listening_port)
+
+            # add ack requirements into the wheel, uniquely identify a grp_msg by an id from the server
+            # wait for 0.5 sec, then remove the nonresponsive clients from group
+            # expect ack only from online clients (Q: def of online??)
+            msg_id = next(self.msg_ids)
+            self.ack_wheel.add(msg_id, group_name, recipients_mask, GROUP_ACK_TIMEOUT)
+            self.metrics.fanout_size.record(len(recipients))
+
+            # broadcast group message to all group members except sender
+            out_msgs = {
+                "grp_msg": ";".join([sender_name, str(msg_id), group_msg]),
+                "grp_seq": ";".join([sender_name, str(msg_id), group_name, str(group_seq), group_msg]),
+            }
+            """
+            grp_msg: sender_name;msg_id;long_group_messages...
+            grp_seq: sender_name;msg_id;group_name;group_seq;long_group_messages... (CAP_GROUP_SEQ)
+            """
+            # one binary datagram to the multicast members, if it fits one (only whole packets are multicast)
+            multicast_recipients = self.multicast_members.get(group_name, set()).intersection(recipients)
+            if multicast_recipients:
+                out_packet = packetEncode(sender_listening_port=self.server_listen_port, sender_name="server", msg_type="grp_seq", msg=out_msgs["grp_seq"], wire=WIRE_BINARY)
+                if len(out_packet) <= MAX_DATAGRAM:
+                    self.serverFanout(out_packet, [self.multicastAddr(group_name)])
+                    self.metrics.count("multicast_sends")
+                else:
+                    multicast_recipients = ()
+
+            # encode once per wire format (and compression, and message type), not once per recipient
+            addrs = collections.defaultdict(list)
+            for recipient in recipients:
+                if recipient in multicast_recipients:
+                    continue
+                recipient_type = "grp_seq" if CAP_GROUP_SEQ in self.client_caps.get(recipient, ()) else "grp_msg"
+                addrs[(self.wireOf(recipient), self.compressorOf(recipient), recipient_type)].append((self.client_table[recipient]["ip"], self.client_table[recipient]["port"]))
+            for (recipient_wire, compressor, recipient_type), recipient_addrs in addrs.items():
+                out_packet = packetEncode(sender_listening_port=self.server_listen_port, sender_name="server", msg_type=recipient_type, msg=out_msgs[recipient_type], wire=recipient_wire, compressor=compressor)
+                self.serverFanout(out_packet, recipient_addrs)
+
+            # the main thread continue sitting and listening to incoming msg
+            # possible incoming msg including ack from group-member recipients
+
+        return msg_type
+
+    def resyncClients(self, names):
+        # client_table entries that should be here but are not; the only copy of the table is this one
+        pass
+
+    def retireOffline(self, name):
+        # remember an account that went offline, compact all of them once there are compact_offline
+        if self.compact_offline is None:
+            return
+        self.offline_names.append(name)
+        if len(self.offline_names) < self.compact_offline:
+            return
+        retired = {name for name in self.offline_names if name in self.client_table and not self.client_table[name]["online"]}
+        self.offline_names = []
+        for name in retired:
+            del self.client_table[name]
+            self.client_caps.pop(name, None)
+            self.reply_cache.pop(name, None)
+            self.ack_misses.pop(name, None)
+            self.group_acked.pop(name, None)
+            # its name is never registered again, nothing left to push to its subscribers
+            for subscriber in self.subscribers.pop(name, ()):
+                self.subscriptions[subscriber].discard(name)
+            if self.spool is not None:
+                self.spool.drop(name)
+        self.tombstones |= retired
+        self.logEvent({"op": "compact", "names": sorted(retired)})
+        # offline members would only be evicted after their next missed group message
+        for group_name, members in self.group_table.items():
+            for name in members & retired:
+                members.discard(name)
+                self.group_slots[group_name].release(name)
+        if self.verbosity >= VERBOSE_EVENTS:
+            print(f">>> Compacted {len(retired)} offline accounts, {len(self.tombstones)} tombstones")
+
+    def heartbeatRound(self, now):
+        """
+        one heartbeat round: a client heard from since the last round is fine, one pinged in the last round that did not
+        answer misses one more ping, the others get a ping now; the pings are encoded once per wire format and sent
+        as one batch by the fan-out worker
+        """
+        self.heartbeat_at = now + self.heartbeat_interval
+        probed, self.probed = self.probed, set()
+        gone = []
+        addrs = collections.defaultdict(list) # wire -> addresses to ping
+        for name, seen in self.last_seen.items():
+            if seen >= self.heartbeat_round:
+                continue
+            if name in probed:
+                self.suspects[name] = self.suspects.get(name, 0) + 1
+                if self.suspects[name] >= self.heartbeat_misses:
+                    gone.append(name)
+                    continue
+            self.probed.add(name)
+            addrs[self.wireOf(name)].append((self.client_table[name]["ip"], self.client_table[name]["port"]))
+        self.heartbeat_round = now
+        for wire, wire_addrs in addrs.items():
+            out_packet = packetEncode(sender_listening_port=self.server_listen_port, sender_name="server", msg_type="ping", msg=None, wire=wire)
+            self.serverFanout(out_packet, wire_addrs)
+            self.metrics.count("heartbeat_pings", len(wire_addrs))
+        for name in gone:
+            if self.verbosity >= VERBOSE_EVENTS:
+                print(f">>> Client {name} missed {self.heartbeat_misses} heartbeats, set offline")
+            self.metrics.count("heartbeat_offline")
+            self.markOffline(name)
+
+    def isAlive(self, name):
+        # client answers heartbeats and is neither offline nor suspected (other sharded workers only know "offline")
+        info = self.client_table.get(name)
+        return CAP_HEARTBEAT in self.client_caps.get(name, ()) and info is not None and info["online"] and name not in self.suspects
+
+    def markOffline(self, name):
+        # online client "name" stopped answering its peers (kick, resolve) or the server's pings
+        self.client_table[name]["online"] = False
+        self.onlineMembers.remove(name)
+        self.online_addrs.pop((self.client_table[name]["ip"], self.client_table[name]["port"]), None)
+        self.last_seen.pop(name, None)
+        self.suspects.pop(name, None)
+        self.logEvent({"op": "offline", "name": name})
+        if self.verbosity >= VERBOSE_TABLES:
+            print(">>> Client table updated.")
+            print(self.client_table)
+
+        # broadcast client_table
+        self.broadcastTableChange("status", name)
+        self.dropSubscriptions(name)
+        self.retireOffline(name)
+
+    def dropSubscriptions(self, name):
+        # client "name" went offline, it subscribes again after it registered
+        for target_name in self.subscriptions.pop(name, ()):
+            subscribers = self.subscribers.get(target_name)
+            if subscribers is not None:
+                subscribers.discard(name)
+                if not subscribers:
+                    del self.subscribers[target_name]
+
+    def wireOf(self, name):
+        # wire format the server uses when it sends to client "name" on its own initiative
+        return WIRE_BINARY if CAP_BINARY in self.client_caps.get(name, ()) else WIRE_TEXT
+
+    def compressorOf(self, name):
+        # Compressor for the packets to client "name", None if it did not ask for compression
+        caps = self.client_caps.get(name, ())
+        return self.compressor if CAP_BINARY in caps and CAP_ZLIB in caps else None
+
+    def snapshotPacket(self, wire, compressor=None):
+        out_msg = json.dumps({"version": self.table_version, "table": self.client_table})
+        return packetEncode(sender_listening_port=self.server_listen_port, sender_name="server", msg_type="snapshot", msg=out_msg, wire=wire, compressor=compressor)
+
+    def broadcastTableChange(self, op, name):
+        """
+        bump table_version and tell every online member about the change of client "name"
+        op: "add" (new registration) or "status" (online status changed)
+        with table_window, changes are collected and broadcast together (flushTableChanges) once no change came
+        for table_window seconds, but at the latest table_max_stale seconds after the first of them
+        """
+        self.table_version += 1
+        change = {"version": self.table_version, "op": op, "name": name, "info": dict(self.client_table[name])}
+        if not self.table_window:
+            self.sendTableChanges([change])
+            return
+        now = time.monotonic()
+        if not self.table_changes:
+            self.table_changes_since = now
+        self.table_changes.append(change)
+        self.table_flush_at = min(now + self.table_window, self.table_changes_since + self.table_max_stale)
+        self.scheduleTableFlush()
+
+    # the threaded engines' state thread waits for table_flush_at on its own, see serverState
+    def scheduleTableFlush(self):
+        pass
+
+    def flushTableChanges(self):
+        changes, self.table_changes = self.table_changes, []
+        self.table_flush_at = None
+        if changes:
+            self.metrics.count("table_flushes")
+            self.metrics.count("table_changes", len(changes))
+            self.sendTableChanges(changes)
+
+    def sendTableChanges(self, changes):
+        """
+        one broadcast of the changes (in version order) to every online member
+        clients with CAP_DELTA get a small delta (one that registered meanwhile gets a snapshot instead),
+        several changes go out as one batch delta to clients with CAP_BATCH and as one delta per change to the others,
+        the others still get the whole client_table; each packet is built (and compressed) only once
+        clients with CAP_PRESENCE get none of these, only one "presence" push with the changes they subscribed to
+        """
+        packets = {} # (kind, wire, compressor) -> list of encoded packets
+        added = {change["name"] for change in changes if change["op"] == "add"}
+        for onlineMember in self.onlineMembers:
+            wire = self.wireOf(onlineMember)
+            compressor = self.compressorOf(onlineMember)
+            caps = self.client_caps.get(onlineMember, ())
+            if CAP_PRESENCE in caps:
+                continue
+            if CAP_DELTA not in caps:
+                kind = "table"
+            elif onlineMember in added:
+                kind = "snapshot"
+            elif CAP_BATCH in caps and len(changes) > 1:
+                kind = "batch"
+            else:
+                kind = "delta"
+            key = (kind, wire, compressor)
+            if key not in packets and kind == "snapshot":
+                packets[key] = [self.snapshotPacket(wire, compressor)]
+            elif key not in packets:
+                if kind == "table":
+                    out_msgs = [("table", json.dumps(self.client_table))]  # dict -> string
+                elif kind == "batch":
+                    # only the last state of every changed client, valid for any client between base and version
+                    merged = {change["name"]: change["info"] for change in changes}
+                    out_msgs = [("delta", json.dumps({"version": changes[-1]["version"], "base": changes[0]["version"] - 1, "changes": merged}))]
+                else:
+                    out_msgs = [("delta", json.dumps(change)) for change in changes]
+                packets[key] = [packetEncode(sender_listening_port=self.server_listen_port, sender_name="server", msg_type=msg_type, msg=out_msg, wire=wire, compressor=compressor)
+                                for msg_type, out_msg in out_msgs]
+            for out_packet in packets[key]:
+                self.serverReply(out_packet, self.client_table[onlineMember]["ip"], self.client_table[onlineMember]["port"])
+
+        pushes = collections.defaultdict(dict) # subscriber -> {name: info} of the changed names it subscribed to
+        for change in changes:
+            for subscriber in self.subscribers.get(change["name"], ()):
+                pushes[subscriber][change["name"]] = change["info"]
+        for subscriber, infos in pushes.items():
+            if subscriber not in self.onlineMembers:
+                continue
+            out_packet = packetEncode(sender_listening_port=self.server_listen_port, sender_name="server", msg_type="presence", msg=json.dumps(infos),
+                                      wire=self.wireOf(subscriber), compressor=self.compressorOf(subscriber))
+            self.serverReply(out_packet, self.client_table[subscriber]["ip"], self.client_table[subscriber]["port"])
+            self.metrics.count("presence_pushes")
+
+    # reply to a request, remembered for retransmissions of the same request
+    def serverAck(self, out_packet, sender_name, seq, target_ip, target_port):
+        if seq:
+            replies = self.reply_cache.setdefault(sender_name, collections.OrderedDict())
+            replies[seq] = out_packet
+            if len(replies) > REPLY_CACHE_SIZE:
+                replies.popitem(last=False)
+        self.serverReply(out_packet, target_ip, target_port)
+
+    # reply to one client; the threaded engine hands each reply to the reply worker
+    # so that the state thread can move on to the next request while the reply is sent
+    def serverReply(self, out_packet, target_ip, target_port):
+        for datagram in self.fragments.split(out_packet):
+            self.sendDatagram(datagram, (target_ip, target_port))
+
+    # send the same group message to every recipient address
+    # the packet is encoded once, the fan-out worker sends it, the state thread continues right away
+    def serverFanout(self, out_packet, addrs):
+        for datagram in self.fragments.split(out_packet):
+            self.fanout_worker.submit(datagram, addrs)
+
+    # fragments, nacks and retransmitted fragments (FragmentLayer) are sent from here as well
+    def sendDatagram(self, datagram, addr):
+        self.reply_worker.submit(datagram, [addr])
+
+
+    def multicastAddr(self, group_name):
+        # the group's multicast (ip, port), the same on every worker of a sharded server
+        group_hash = zlib.crc32(group_name.encode()) & 0xFFFF
+        return (f"{MULTICAST_NET}.{group_hash >> 8}.{group_hash & 0xFF}", self.multicast_port)
+
+    def slotOf(self, group_name, member_name):
+        return self.group_slots[group_name].slot_of.get(member_name)
+
+    # called by ack_wheel when a group message was not acked by everyone in time
+    def evictNonresponsive(self, group_name, nonresponsive_mask):
+        # delete nonresponsive clients
+        self.metrics.count("ack_timeouts")
+        nonresponsive_receivers = self.group_slots[group_name].names(nonresponsive_mask)
+        fallbacks = nonresponsive_receivers & self.multicast_members.get(group_name, set())
+        if fallbacks:
+            # the multicast datagram did not reach them (or multicast does not work for them at all): unicast from now on,
+            # they fetch the lost message from the group's history
+            self.metrics.count("multicast_fallbacks", len(fallbacks))
+            self.multicast_members[group_name] -= fallbacks
+            nonresponsive_receivers -= fallbacks
+        if self.heartbeat_interval:
+            # heartbeats tell who is gone: a member known to be alive only lost this group message, it stays
+            nonresponsive_receivers = {name for name in nonresponsive_receivers if not self.isAlive(name)}
+        now = time.monotonic()
+        for name in list(nonresponsive_receivers):
+            if CAP_GROUP_SEQ in self.client_caps.get(name, ()):
+                # it fetches a lost message from the group's history, only evicted when it keeps missing them
+                # (an ack of another message while this one waited shows it is alive, only this one was lost)
+                if self.group_acked.get(name, 0) >= now - GROUP_ACK_TIMEOUT - self.ack_wheel.tick:
+                    nonresponsive_receivers.discard(name)
                     continue
+                self.ack_misses[name] = self.ack_misses.get(name, 0) + 1
+                if self.ack_misses[name] < GROUP_MAX_MISSES:
+                    nonresponsive_receivers.discard(name)
+                else:
+                    del self.ack_misses[name]
+        self.group_table[group_name] = self.group_table[group_name] - nonresponsive_receivers
+        for nonresponsive_receiver in nonresponsive_receivers:
+            self.group_slots[group_name].release(nonresponsive_receiver)
+        if not nonresponsive_receivers:
+            return # they all left the group in the meantime
+        self.logEvent({"op": "evict", "group": group_name, "names": sorted(nonresponsive_receivers)})
+        self.metrics.count("evicted_members", len(nonresponsive_receivers))
+        if self.verbosity >= VERBOSE_EVENTS:
+            for nonresponsive_receiver in nonresponsive_receivers:
+                print(f">>> Client {nonresponsive_receiver} not responsive, removed from {group_name}")
+        if self.verbosity >= VERBOSE_TABLES:
+            print(">>> Group table updated.")
+            print(self.group_table)
 
-                # if sender still in group, reply ack to sender
-                out_packet = packetFormat(sender_listening_port=self.server_listen_port, sender_name="server", msg_type="ack", msg=None)
-                threading.Thread(target=self.serverRespond, args=(out_packet, sender_ip, sender_listening_port)).start()
 
-                # add ack requirements into ack_dict, uniquely identify a grp_msg by (sender, curr_time)
-                curr_time = str(time.time())
-                with self.ack_lock:
-                    # print("Modify ack_dict because someone send group msg")
-                    self.ack_dict[(sender_name, curr_time)] = {recipient: False for recipient in recipients}
-                    # print("ack_dict now looks like:")
-                    # print(self.ack_dict)
-
-                # broadcast group message to all group members except sender
-                # do not need the spawn multiple parallel threads for this [small] implementation
-                out_msg = ";".join([sender_name, curr_time, group_msg])
-                """
-                sender_name;curr_time;long_group_messages...
-                """
-                with self.send_lock:
-                    for recipient in recipients:
-                        out_packet = packetFormat(sender_listening_port=self.server_listen_port, sender_name="server", msg_type="grp_msg", msg=out_msg)
-                        self.server_send_socket.sendto(out_packet.encode(), (self.client_table[recipient]["ip"], self.client_table[recipient]["port"]))
+class ServerProtocol(asyncio.DatagramProtocol):
+    """
+    asyncio glue for AsyncServer: every datagram is handed to the shared serverDatagram
+    """
+    def __init__(self, server):
+        self.server = server
 
-                # a sub-thread, first wait for 0.5 sec, then check if all acks are received, remove the nonresponsive clients from group
-                # expect ack only from online clients (Q: def of online??)
-                threading.Thread(target=self.sleep_and_wait_for_acks, args=(group_name, sender_name, curr_time)).start()
+    def connection_made(self, transport):
+        self.server.transport = transport
 
-                # the main thread continue sitting and listening to incoming msg
-                # possible incoming msg including ack from group-member recipients
+    def datagram_received(self, data, addr):
+        self.server.serverDatagram(data, addr)
 
+    def error_received(self, exc):
+        # e.g. ICMP port unreachable from an offline client, nothing to do for UDP
+        pass
 
+    def pause_writing(self):
+        self.server.writing_paused = True
 
-    # sub thread: reply ack (with additional info) to client
-    # each time job finished, this sub thread will automatically close
-    def serverRespond(self, out_packet, target_ip, target_port):
-        # reason for lock: send_socket send reg_ack, broadcast table to multiple clients in seperate sub-threads
-        # print("Server respond thread start")
-        # print("the out_packet is:")
-        # print(out_packet)
-        with self.send_lock:
-            self.server_send_socket.sendto(out_packet.encode(), (target_ip, target_port))
-            # print("Server respond thread finish")
+    def resume_writing(self):
+        self.server.writing_paused = False
 
 
-    def sleep_and_wait_for_acks(self, group_name, sender_name, curr_time):
-        # sleep for 0.5 sec
-        time.sleep(0.5)
+class AsyncServer(Server):
+    """
+    Server engine running on one asyncio event loop instead of the state thread and its command queue.
+    The loop owns the state, replies are written straight to the datagram transport, group messages go to the
+    fan-out worker like in the threaded engine, and the ack wheel is moved by a loop timer,
+    so no thread is involved per request and memory stays bounded: while the transport's
+    write buffer is above its high-water mark, replies are dropped
+    (UDP gives no delivery guarantee anyway, clients retry on their own)
+    """
+    REPLY_THREADS = False # no receive ring, no reply worker: the transport reads and writes
 
-        # wake up, check if all acks are received
-        # need to lock ack dict
-        with self.ack_lock:
-            # print("check nonresponsive recipients")
-            nonresponsive_receivers = [receiver
-                                       for receiver, ackReceived
-                                       in self.ack_dict[(sender_name, curr_time)].items()
-                                       if not ackReceived]
-            # print("Nonresponsive:" + str(nonresponsive_receivers))
+    def __init__(self, server_listen_port, compact_offline=None, state_dir=None, spool_limit=0, stats_port=None, verbosity=VERBOSE_EVENTS, table_window=0, heartbeat=0, heartbeat_misses=3, rate_limit=0, group_rate_limit=0, multicast_port=0):
+        super().__init__(server_listen_port, compact_offline, state_dir, spool_limit, stats_port, verbosity, table_window, heartbeat, heartbeat_misses, rate_limit, group_rate_limit, multicast_port)
+        self.loop = None
+        self.transport = None
+        self.writing_paused = False
+        self.dropped_packets = 0
 
-        # delete nonresponsive clients
-        if nonresponsive_receivers:
-            with self.group_lock:
-                self.group_table[group_name] = self.group_table[group_name] - set(nonresponsive_receivers)
-            for nonresponsive_receiver in nonresponsive_receivers:
-                print(f">>> Client {nonresponsive_receiver} not responsive, removed from {group_name}")
-            print(">>> Group table updated.")
-            print(self.group_table)
+    def serverMode(self):
+        self.startStats() # its own thread, only reads the metrics
+        asyncio.run(self.serverLoop())
+
+    def serverSubmit(self, function, *args):
+        # the event loop owns the state, no queue in between
+        self.serverRun(function, *args)
+
+    def scheduleTableFlush(self):
+        # a later change moves table_flush_at, the timer of an earlier one then finds it is too early
+        self.loop.call_at(self.table_flush_at, self.checkTableFlush)
+
+    def checkTableFlush(self):
+        if self.table_flush_at is not None and self.loop.time() >= self.table_flush_at:
+            self.serverRun(self.flushTableChanges)
+
+    async def serverLoop(self):
+        self.loop = asyncio.get_running_loop()
+        # reuse the already bound listening socket, replies leave from it as well
+        self.server_listen_socket.setblocking(False)
+        await self.loop.create_datagram_endpoint(lambda: ServerProtocol(self), sock=self.server_listen_socket)
+        self.tickAckWheel()
+        if self.heartbeat_at is not None:
+            self.loop.call_at(self.heartbeat_at, self.tickHeartbeat)
+        await self.loop.create_future() # serve forever
+
+    def tickAckWheel(self):
+        # loop.time() is time.monotonic(), the clock of the wheel
+        self.serverRun(self.ack_wheel.advance, self.loop.time())
+        self.fragments.expire(self.loop.time()) # nacks and reassembly timeouts, on the same timer
+        self.loop.call_at(self.ack_wheel.next_tick, self.tickAckWheel)
+
+    def tickHeartbeat(self):
+        self.serverRun(self.heartbeatRound, self.loop.time())
+        self.loop.call_at(self.heartbeat_at, self.tickHeartbeat)
+
+    def serverReply(self, out_packet, target_ip, target_port):
+        for datagram in self.fragments.split(out_packet):
+            self.sendDatagram(datagram, (target_ip, target_port))
+
+    def statsGauges(self):
+        gauges = super().statsGauges()
+        gauges["dropped_packets"] = self.dropped_packets
+        gauges["writing_paused"] = self.writing_paused
+        if self.transport is not None:
+            gauges["write_buffer"] = self.transport.get_write_buffer_size()
+        return gauges
+
+    def sendDatagram(self, datagram, addr):
+        if self.writing_paused:
+            self.dropped_packets += 1
+            return
+        self.transport.sendto(datagram, addr)
+
+
+class ShardedServer(Server):
+    """
+    one worker process of the sharded server (serveSharded), all workers listen on the same port with SO_REUSEPORT,
+    the kernel spreads the clients over them (every datagram of one client socket reaches the same worker)
+    ownership of the state:
+    - a group (members, slots, ack wheel entries) lives on worker crc32(group_name) % num_shards,
+      the ids of its group messages are that worker's number modulo num_shards, so acks find it too
+    - client_table changes (reg, dereg, kick, resolve, snapshot_req) are made by worker 0, because its version
+      sequence is global; the new entry is replicated to the other workers, which need addresses to fan out.
+      the message spool, the presence subscriptions and the heartbeats live on worker 0 as well
+    - group names are replicated to every worker, so list_groups is answered where it arrives
+    a request for state owned by another worker is forwarded to it over the local peer sockets,
+    the owner runs it and replies to the client itself, after replicating what it changed
+    peer datagrams: b"F" + client ip (4 bytes) + client port + client packet (forwarded request)
+                    b"T" + json client table change, b"G" + new group name,
+                    b"R" + json {"shard": ..., "names": [...]} (entries a worker misses, worker 0 sends them again as b"T")
+    """
+    FORWARD_HEADER = struct.Struct("!c4sH")
+
+    def __init__(self, server_listen_port, shard_id, peer_sockets, compact_offline=None, state_dir=None, spool_limit=0, stats_port=None, verbosity=VERBOSE_EVENTS, table_window=0, heartbeat=0, heartbeat_misses=3, rate_limit=0, group_rate_limit=0, multicast_port=0):
+        # every worker answers on its own stats port: stats_port + shard_id
+        super().__init__(server_listen_port, compact_offline, spool_limit=spool_limit,
+                         stats_port=stats_port + shard_id if stats_port is not None else None, verbosity=verbosity, table_window=table_window,
+                         heartbeat=heartbeat, heartbeat_misses=heartbeat_misses, rate_limit=rate_limit, group_rate_limit=group_rate_limit,
+                         multicast_port=multicast_port)
+        self.shard_id = shard_id
+        self.num_shards = len(peer_sockets)
+        self.peer_socket = peer_sockets[shard_id]
+        self.peer_addrs = [peer_socket.getsockname() for peer_socket in peer_sockets]
+        self.msg_ids = itertools.count(shard_id + self.num_shards, self.num_shards)
+        # fragment ids are the worker's number modulo num_shards, like msg ids, so a nack finds the worker that sent them
+        self.fragments = FragmentLayer(server_listen_port, self.sendDatagram, id_start=shard_id, id_step=self.num_shards)
+        self.held_packets = None # packets to clients of the request being dispatched, see serverDispatch
+        if shard_id != 0:
+            self.heartbeat_at = None # heartbeats are sent by worker 0, the owner of client_table
+
+        # persistent state: every worker logs what it owns in <state_dir>/shard<id>,
+        # on start it also reads the client table of worker 0 and the group names of all other workers
+        if state_dir is not None:
+            if self.spool is not None:
+                self.spool = MessageSpool(spool_limit, path=os.path.join(state_dir, f"shard{shard_id}", "spool"))
+            self.store = StateStore(os.path.join(state_dir, f"shard{shard_id}"))
+            started_at = time.monotonic()
+            state = self.store.load()
+            for other_id in range(self.num_shards):
+                if other_id == shard_id:
+                    continue
+                other_state = StateStore(os.path.join(state_dir, f"shard{other_id}")).load()
+                if other_id == 0:
+                    state["version"], state["clients"], state["tombstones"] = other_state["version"], other_state["clients"], other_state["tombstones"]
+                for group_name in other_state["groups"]:
+                    state["groups"].setdefault(group_name, [])
+            self.restoreState(state)
+            print(f">>> Restored {len(self.client_table)} clients and {len(self.group_table)} groups in {time.monotonic() - started_at:.3f}s")
+
+    def logEvent(self, event):
+        # client table events are logged by worker 0 only, the others replicate them
+        if event["op"] in ("reg", "offline", "compact") and self.shard_id != 0:
+            return
+        super().logEvent(event)
+
+    def dumpState(self):
+        state = super().dumpState()
+        if self.shard_id != 0:
+            state["clients"], state["tombstones"] = {}, []
+        state["groups"] = {group_name: members for group_name, members in state["groups"].items() if self.shardOf(group_name) == self.shard_id}
+        state["group_seqs"] = {group_name: upto for group_name, upto in state["group_seqs"].items() if self.shardOf(group_name) == self.shard_id}
+        return state
+
+    def bindListenSocket(self):
+        listen_socket = socket(AF_INET, SOCK_DGRAM)
+        listen_socket.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
+        listen_socket.bind((self.host, self.server_listen_port))
+        return listen_socket
 
-        # delete the requirement pair, save space
-        with self.ack_lock:
-            del self.ack_dict[(sender_name, curr_time)]
+    def serverMode(self):
+        threading.Thread(target=self.serverState, daemon=True).start()
+        self.fragments.start()
+        self.startStats()
+        while True:
+            readable, _, _ = select.select([self.server_listen_socket, self.peer_socket], [], [])
+            if self.peer_socket in readable:
+                self.peerReceive(self.peer_socket.recv(65535))
+            if self.server_listen_socket in readable:
+                for data, addr in self.receiver.receive():
+                    self.serverDatagram(data, addr)
+
+    def serverDatagram(self, data, addr, forwarded=False):
+        # a client's nack reaches the worker its socket is hashed to, not necessarily the one that sent the fragments
+        if data[:1] == bytes([FRAGMENT_MAGIC]) and len(data) >= FRAGMENT_HEADER.size:
+            _, kind, frag_id, _, _, _ = FRAGMENT_HEADER.unpack_from(data)
+            owner = frag_id % self.num_shards
+            if kind == FRAGMENT_NACK and owner != self.shard_id:
+                header = self.FORWARD_HEADER.pack(b"F", inet_aton(addr[0]), addr[1])
+                self.peer_socket.sendto(header + data, self.peer_addrs[owner])
+                return
+        super().serverDatagram(data, addr, forwarded)
+
+    def limitsGroup(self, group_name):
+        return self.shardOf(group_name) == self.shard_id
+
+    def statsGauges(self):
+        gauges = super().statsGauges()
+        gauges["shard_id"] = self.shard_id
+        return gauges
+
+    def shardOf(self, name):
+        return zlib.crc32(name.encode()) % self.num_shards
+
+    def ownerOf(self, msg_type, in_msg):
+        if msg_type in ("reg", "dereg", "kick", "snapshot_req", "spool", "spool_req", "subscribe", "unsubscribe", "resolve", "pong"):
+            return 0
+        if msg_type in ("create_group", "join_group", "list_members", "leave_group", "multicast"):
+            return self.shardOf(in_msg)
+        if msg_type in ("send_group", "history"):
+            return self.shardOf(in_msg.split(";", maxsplit=1)[0])
+        if msg_type == "ack":
+            try:
+                return int(in_msg.split(";", maxsplit=1)[1]) % self.num_shards
+            except (IndexError, ValueError):
+                pass
+        return self.shard_id
+
+    def serverDispatch(self, in_packet, addr, fields=None):
+        if fields is None:
+            fields = packetDecode(in_packet)
+        _, _, msg_type, in_msg, _ = fields
+        owner = self.ownerOf(msg_type, in_msg)
+        if owner != self.shard_id:
+            header = self.FORWARD_HEADER.pack(b"F", inet_aton(addr[0]), addr[1])
+            self.peer_socket.sendto(header + in_packet, self.peer_addrs[owner])
+            self.metrics.count("forwarded")
+            return
+
+        # the packets to clients leave (in their order) after the other workers got the change,
+        # so a client's next request, whichever worker gets it, already sees it
+        self.held_packets = []
+        new_group = msg_type == "create_group" and in_msg not in self.group_table
+        try:
+            super().serverDispatch(in_packet, addr, fields)
+            if new_group and in_msg in self.group_table:
+                self.peerBroadcast(b"G" + in_msg.encode())
+        finally:
+            # also when the request failed (serverRun), or later packets of the worker would be held forever
+            held_packets, self.held_packets = self.held_packets, None
+            for send, args in held_packets:
+                send(*args)
+
+    def serverReply(self, out_packet, target_ip, target_port):
+        if self.held_packets is not None:
+            self.held_packets.append((super().serverReply, (out_packet, target_ip, target_port)))
+            return
+        super().serverReply(out_packet, target_ip, target_port)
+
+    def serverFanout(self, out_packet, addrs):
+        if self.held_packets is not None:
+            self.held_packets.append((super().serverFanout, (out_packet, addrs)))
+            return
+        super().serverFanout(out_packet, addrs)
+
+    def broadcastTableChange(self, op, name):
+        super().broadcastTableChange(op, name)
+        self.peerBroadcast(self.peerTableChange(name))
+
+    def peerTableChange(self, name):
+        change = {"version": self.table_version, "name": name, "info": self.client_table[name], "caps": list(self.client_caps[name])}
+        return b"T" + json.dumps(change).encode()
+
+    def resyncClients(self, names):
+        # a replicated table change got lost: worker 0, the owner of client_table, sends the entries again
+        if self.shard_id != 0:
+            self.peer_socket.sendto(b"R" + json.dumps({"shard": self.shard_id, "names": names}).encode(), self.peer_addrs[0])
+
+    def peerBroadcast(self, data):
+        for shard_id, peer_addr in enumerate(self.peer_addrs):
+            if shard_id != self.shard_id:
+                self.peer_socket.sendto(data, peer_addr)
+
+    def peerReceive(self, data):
+        # receive thread: a forwarded request is decoded here like one from a client, changes go to the state thread
+        if data[:1] == b"F":
+            _, ip, port = self.FORWARD_HEADER.unpack_from(data)
+            self.serverDatagram(data[self.FORWARD_HEADER.size:], (inet_ntoa(ip), port), forwarded=True)
+        else:
+            self.serverSubmit(self.peerApply, data)
+
+    def peerApply(self, data):
+        kind = data[:1]
+        if kind == b"T":
+            change = json.loads(data[1:])
+            name, info = change["name"], change["info"]
+            if info["online"] and name not in self.onlineMembers:
+                # registered (again) on worker 0: its seqs start anew here as well
+                self.reply_cache.pop(name, None)
+            self.table_version = change["version"]
+            self.client_table[name] = info
+            self.client_caps[name] = set(change["caps"])
+            if info["online"]:
+                self.onlineMembers.add(name)
+                self.online_addrs[(info["ip"], info["port"])] = name
+            else:
+                self.onlineMembers.discard(name)
+                self.online_addrs.pop((info["ip"], info["port"]), None)
+                # worker 0 compacts after the same changes, so the replicas stay the same
+                self.retireOffline(name)
+        elif kind == b"G":
+            # only the name, members of the group stay with its owner
+            self.group_table.setdefault(data[1:].decode(), set())
+        elif kind == b"R":
+            request = json.loads(data[1:])
+            for name in request["names"]:
+                if name in self.client_table:
+                    self.peer_socket.sendto(self.peerTableChange(name), self.peer_addrs[request["shard"]])
+
+
+def serveSharded(server_listen_port, workers, compact_offline=None, state_dir=None, spool_limit=0, stats_port=None, verbosity=VERBOSE_EVENTS, table_window=0, heartbeat=0, heartbeat_misses=3, rate_limit=0, group_rate_limit=0, multicast_port=0):
+    # start one ShardedServer process per worker, they all share the listening port
+    if state_dir is not None:
+        # groups are owned by crc32(name) % workers, a stored state only fits the same number of workers
+        os.makedirs(state_dir, exist_ok=True)
+        workers_path = os.path.join(state_dir, "workers")
+        if os.path.exists(workers_path):
+            with open(workers_path) as f:
+                stored_workers = int(f.read())
+            if stored_workers != workers:
+                print(f"State in {state_dir} was written by {stored_workers} workers, start with --workers {stored_workers}")
+                sys.exit(1)
+        with open(workers_path, "w") as f:
+            f.write(str(workers))
+    peer_sockets = []
+    for _ in range(workers):
+        peer_socket = socket(AF_INET, SOCK_DGRAM)
+        peer_socket.bind(("127.0.0.1", 0))
+        peer_sockets.append(peer_socket)
+    context = multiprocessing.get_context("fork") # the peer sockets are inherited
+    processes = [context.Process(target=runShard, args=(server_listen_port, shard_id, peer_sockets, compact_offline, state_dir, spool_limit, stats_port, verbosity, table_window, heartbeat, heartbeat_misses, rate_limit, group_rate_limit, multicast_port), daemon=True) for shard_id in range(workers)]
+    for process in processes:
+        process.start()
+    # stopping the main process (ctrl+C, kill) stops the workers too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            process.terminate()
+
+
+def runShard(server_listen_port, shard_id, peer_sockets, compact_offline, state_dir, spool_limit, stats_port, verbosity, table_window, heartbeat, heartbeat_misses, rate_limit, group_rate_limit, multicast_port):
+    ShardedServer(server_listen_port, shard_id, peer_sockets, compact_offline, state_dir, spool_limit, stats_port, verbosity, table_window, heartbeat, heartbeat_misses, rate_limit, group_rate_limit, multicast_port).serverMode()
+
+
+class RttEstimator:
+    """
+    round trip time estimate of one peer (Jacobson/Karels, as in TCP)
+    srtt += (rtt - srtt) / 8, rttvar += (|rtt - srtt| - rttvar) / 4, rto = srtt + 4 * rttvar
+    rto never exceeds the old fixed 0.5 sec wait, so giving up on a peer never takes longer than before
+    """
+    INITIAL_RTO = 0.5
+    MIN_RTO = 0.05
+    MAX_RTO = 0.5
+
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = self.INITIAL_RTO
+
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(self.MAX_RTO, max(self.MIN_RTO, self.srtt + 4 * self.rttvar))
+
+
+class DeliveryError(Exception):
+    """
+    a request of the client API could not be delivered: no ack after all attempts, unknown user, or refused registration
+    """
+
+
+class PendingRequest:
+    """
+    one request waiting for its ack, identified by its seq
+    future gets the additional info of the ack as result, or a DeliveryError when all attempts failed
+    """
+    __slots__ = ("seq", "target_name", "addr", "out_packet", "sent_at", "deadline", "timeout", "attempts", "max_attempts",
+                 "future")
+
+    def __init__(self, seq, target_name, addr, out_packet, timeout, max_attempts):
+        self.seq = seq
+        self.target_name = target_name
+        self.addr = addr
+        self.out_packet = out_packet
+        self.sent_at = time.monotonic()
+        self.timeout = timeout
+        self.deadline = self.sent_at + timeout
+        self.attempts = 1
+        self.max_attempts = max_attempts
+        self.future = concurrent.futures.Future()
+
+
+PRESENCE_TTL = 60 # sec a presence client trusts an address it looked up, looked up again after that
+PEER_CACHE_SIZE = 256 # peers a presence client keeps addresses of, the least recently used one is dropped first
 
 
 class Client():
-    def __init__(self, name, server_ip, server_listen_port, client_listen_port):
+    def __init__(self, name, server_ip, server_listen_port, client_listen_port, wire=WIRE_BINARY, presence=False):
         self.name = name
         self.host = server_ip # assume client and server are always on the same machine
 
         self.client_listen_port = client_listen_port
         self.client_listen_socket = socket(AF_INET, SOCK_DGRAM)
         self.client_listen_socket.bind((self.host, self.client_listen_port))
+        self.receiver = BatchReceiver(self.client_listen_socket)
 
         self.client_send_socket = socket(AF_INET, SOCK_DGRAM) # randomly assign a port number
 
         self.server_ip = server_ip
         self.server_listen_port = server_listen_port
 
-        self.client_table = {}
+        self.client_table = {} if not presence else collections.OrderedDict()
+        self.table_version = 0 # version of the last applied snapshot/delta from server
+        self.snapshot_requested_at = 0 # avoid asking server for snapshots on every delta of a burst
+        # presence (CAP_PRESENCE): no table broadcasts, client_table only holds the peers looked up with "subscribe",
+        # kept up to date by the server's "presence" pushes and trusted for PRESENCE_TTL sec after the last of them;
+        # it is an LRU cache of at most PEER_CACHE_SIZE peers (unsubscribed when dropped)
+        # any client asks the server with "resolve" for a peer missing in client_table, or one that did not ack
+        self.presence = presence
+        self.table_expiry = {} # name -> time.monotonic() when its entry has to be looked up again
         self.groupMode = False
         self.groupName = None
+        # group messages numbered per group ("grp_seq", CAP_GROUP_SEQ) are shown in seq order; a gap is filled with
+        # one "history" request for the missing range, messages the server no longer keeps are skipped
+        self.group_seqs = {} # group name -> seq of the last group message shown (or sent by us)
+        self.group_held = {} # group name -> {seq: (sender, text), None for our own} arrived after a gap
+        self.group_fetching = set() # groups with a history request in flight
+        self.group_lock = threading.RLock() # listening thread, and whoever gets the ack of a history request
+        # multicast addresses of our groups (CAP_MULTICAST), all received on one socket by the multicast thread
+        self.multicast_socket = None
+        self.multicast_groups = {} # group name -> (ip, port) joined
         self.pri_msg_queue = queue.Queue()
         """
         [(client1Name, msg1), (client2Name, msg2), ...]
         """
 
-        # who send ack to this client, within the 0.5 sec time limit
-        # only use port number to identify client
-        # under assumption: everything on the same machine
-        self.ack_dict = {} # need to update for each time of broadcast client_table
+        # requests waiting for their ack, any number of them at a time, each identified by its seq
+        # acks from a peer are matched by the seq it echoes (a text peer echoes none: oldest request to that peer)
+        # a request is retransmitted when its own timeout (the peer's rto, doubled on every retry) expires
+        self.last_seq = 0
+        self.pending = {} # in seq order, the first one is the oldest request in flight
         """
         {
-            "server": {
-                "ack": False, 
-                "info": "additional info"
-            },
-            "client1Name": {
-                "ack": False, 
-                "info": "additional info"
-            },
-            "client2Name": {
-                "ack": False, 
-                "info": "additional info"
-            },
+            seq1: PendingRequest(target_name="server", attempts=1, ...),
+            seq2: PendingRequest(target_name="client1Name", attempts=2, ...),
             ...
         }
         """
+        self.deadlines = [] # heap of (deadline, seq), entries of finished/retransmitted requests are skipped
+        self.rtt = {} # target name -> RttEstimator
+        # a target that answered "slow_down <msec>" gets our requests paced, one every msec, until the pace runs out
+        self.paced = {} # target name -> [time.monotonic() of the next request, interval in sec]
+        self.recent_seqs = {} # sender name -> (deque, set) of the last seqs of private messages, drop duplicates
+
+        # wire format: self.wire is what this client would like to speak (WIRE_TEXT turns binary off),
+        # peer_wire is what the server / each peer was last seen speaking
+        self.wire = wire
+        self.peer_wire = {}
 
         self.ack_lock = threading.Lock()
+        self.ack_cond = threading.Condition(self.ack_lock) # wakes the retransmit thread up
         self.send_lock = threading.Lock()
 
+        # long messages (binary packets above MAX_DATAGRAM) are sent and received as fragments
+        self.fragments = FragmentLayer(self.client_listen_port, self.sendDatagram)
+
+        # programmatic use (bots, bridges): nothing is printed, nothing exits the process,
+        # incoming messages go to on_message(msg_type, sender_name, text) instead; clientMode turns interactive on
+        self.interactive = False
+        self.on_message = None
+        self.registration = concurrent.futures.Future() # result: reg_ack message, DeliveryError when refused
+        # window of the API: a request only gets its seq once the oldest request in flight is less than REPLY_CACHE_SIZE
+        # seqs older, so the server (reply_cache) and a peer (isDuplicate) still remember the oldest one when it is
+        # retransmitted, and never run it twice however many newer requests were answered meanwhile
+        self.window = threading.Condition(self.ack_lock)
+        self.stopped = False
+        self.malformed_packets = 0 # dropped, packetDecode could not read them
+
+    def wireFor(self, target_name):
+        # only speak binary to the server / a client once it spoke binary to us
+        if self.wire == WIRE_TEXT:
+            return WIRE_TEXT
+        return self.peer_wire.get(target_name, WIRE_TEXT)
+
+    def sendReliable(self, target_name, target_ip, target_port, msg_type, out_msg, max_attempts=5):
+        """
+        send a request and block until its ack arrives, or until all attempts timed out
+        return: (ackReceived, additional info of the ack)
+        """
+        pending = self.sendRequest(target_name, target_ip, target_port, msg_type, out_msg, max_attempts)
+        try:
+            return True, pending.future.result()
+        except DeliveryError:
+            return False, None
+
+    def sendRequest(self, target_name, target_ip, target_port, msg_type, out_msg, max_attempts=5, wait=False):
+        # send without waiting, the retransmit thread takes care of it until it is acked or given up
+        # wait: first wait while the window is full
+        with self.ack_cond:
+            while wait and self.pending and self.last_seq + 1 - next(iter(self.pending)) >= REPLY_CACHE_SIZE:
+                self.window.wait()
+            # seqs are given out under ack_lock, so pending stays in seq order
+            self.last_seq += 1
+            seq = self.last_seq
+            out_packet = packetEncode(sender_listening_port=self.client_listen_port, sender_name=self.name, msg_type=msg_type, msg=out_msg, wire=self.wireFor(target_name), seq=seq)
+            if len(out_packet) > MAX_DATAGRAM and self.wire != WIRE_TEXT and packetWire(out_packet) == WIRE_TEXT:
+                # only binary packets can be fragmented, and a text packet this long would not fit a legacy recvfrom anyway
+                out_packet = packetEncode(sender_listening_port=self.client_listen_port, sender_name=self.name, msg_type=msg_type, msg=out_msg, wire=WIRE_BINARY, seq=seq)
+            # create the ack requirement before sending, the ack may come back before sendto returns
+            rtt = self.rtt.setdefault(target_name, RttEstimator())
+            pending = PendingRequest(seq, target_name, (target_ip, target_port), out_packet, rtt.rto, max_attempts)
+            self.pending[seq] = pending
+            held = self.paceRequest(pending, pending.sent_at)
+            heapq.heappush(self.deadlines, (pending.deadline, seq))
+            self.ack_cond.notify()
+        if not held:
+            self.sendPacket(out_packet, pending.addr)
+        return pending
+
+    def paceRequest(self, pending, now):
+        # while its target asked us to slow down, a request waits for its turn, the retransmit thread sends it then
+        # return: True if held back; hold ack_lock
+        pace = self.paced.get(pending.target_name)
+        if pace is None:
+            return False
+        if now >= pace[0]:
+            del self.paced[pending.target_name] # caught up
+            return False
+        pending.attempts -= 1 # sending it later is its first attempt
+        pending.deadline = pace[0]
+        pace[0] += pace[1]
+        return True
+
+    def sendPacket(self, out_packet, addr):
+        for datagram in self.fragments.split(out_packet):
+            self.sendDatagram(datagram, addr)
+
+    def sendDatagram(self, datagram, addr):
+        with self.send_lock:
+            if self.stopped:
+                return # retransmissions of requests still in flight when stop() closed the socket
+            self.client_send_socket.sendto(datagram, addr)
 
-    # main thread: take in user command
-    def clientMode(self):
+    # sub thread: retransmit every request whose own timeout expired, give up after its last attempt
+    def clientRetransmit(self):
+        while True:
+            resend = []
+            failed = []
+            with self.ack_cond:
+                now = time.monotonic()
+                while self.deadlines and self.deadlines[0][0] <= now:
+                    deadline, seq = heapq.heappop(self.deadlines)
+                    pending = self.pending.get(seq)
+                    if pending is None or pending.deadline != deadline:
+                        continue # acked meanwhile
+                    if pending.attempts >= pending.max_attempts:
+                        del self.pending[seq]
+                        self.window.notify_all()
+                        failed.append(pending)
+                        continue
+                    if pending.attempts == 0:
+                        pending.sent_at = now # held back by slow_down until now, its rtt counts from here
+                    # exponential backoff, but never longer than the old fixed wait
+                    pending.attempts += 1
+                    pending.timeout = min(pending.timeout * 2, RttEstimator.MAX_RTO)
+                    pending.deadline = now + pending.timeout
+                    heapq.heappush(self.deadlines, (pending.deadline, seq))
+                    resend.append(pending)
+                if not resend and not failed:
+                    self.ack_cond.wait(self.deadlines[0][0] - now if self.deadlines else None)
+                    continue
+            for pending in resend:
+                self.sendPacket(pending.out_packet, pending.addr)
+            for pending in failed:
+                pending.future.set_exception(DeliveryError(f"No ACK from {pending.target_name} after {pending.attempts} attempts"))
+
+    def matchPending(self, sender_name, seq):
+        # the request an ack from sender_name answers, None if nobody waits for it; hold ack_lock
+        if seq:
+            pending = self.pending.get(seq)
+            return pending if pending is not None and pending.target_name == sender_name else None
+        # text peer: oldest request to that peer
+        for pending in self.pending.values():
+            if pending.target_name == sender_name:
+                return pending
+        return None
+
+    def isDuplicate(self, sender_name, seq):
+        # a retransmitted private message we already got (its ack was lost or late)
+        if not seq:
+            return False
+        recent_list, recent_set = self.recent_seqs.setdefault(sender_name, (collections.deque(), set()))
+        if seq in recent_set:
+            return True
+        recent_list.append(seq)
+        recent_set.add(seq)
+        if len(recent_list) > REPLY_CACHE_SIZE: # the sender's requests in flight are never further apart
+            recent_set.discard(recent_list.popleft())
+        return False
 
+    def startListening(self):
         # sub thread: sit aside, listening to all kinds of message (reg ack, broadcast table, group msg, private msg, all ack)
-        self.thread_recv = threading.Thread(target=self.clientListen)
+        self.thread_recv = threading.Thread(target=self.clientListen, daemon=True)
         self.thread_recv.start()
+        self.thread_retransmit = threading.Thread(target=self.clientRetransmit, daemon=True)
+        self.thread_retransmit.start()
+        self.fragments.start()
+
+    def register(self):
+        # send registration request to the server, the returned future is resolved by its reg_ack
+        # always in text, so that a legacy server understands it too
+        caps = [CAP_DELTA, CAP_BATCH, CAP_HEARTBEAT, CAP_GROUP_SEQ, CAP_SLOW_DOWN]
+        if self.wire != WIRE_TEXT:
+            caps += [CAP_BINARY, CAP_ZLIB, CAP_MULTICAST]
+        if self.presence:
+            caps.append(CAP_PRESENCE)
+        out_packet = packetEncode(sender_listening_port=self.client_listen_port, sender_name=self.name, msg_type="reg", msg=",".join(caps), wire=WIRE_TEXT)
+        with self.send_lock:
+            self.client_send_socket.sendto(out_packet, (self.server_ip, self.server_listen_port))
+        return self.registration
+
+    def start(self, timeout=2):
+        # client API: listen, register, and wait until the server accepted us (raises DeliveryError otherwise)
+        self.startListening()
+        try:
+            self.register().result(timeout)
+        except concurrent.futures.TimeoutError:
+            raise DeliveryError("Server not responding")
+        return self
+
+    def stop(self):
+        # client API: stop the listening thread and release both sockets
+        self.fragments.stop()
+        with self.send_lock:
+            self.stopped = True
+            self.client_send_socket.sendto(b"", (self.host, self.client_listen_port)) # wake up recvfrom
+        self.thread_recv.join()
+        self.client_listen_socket.close()
+        with self.send_lock:
+            self.client_send_socket.close()
+        with self.group_lock:
+            multicast_socket = self.multicast_socket
+        if multicast_socket is not None:
+            # not under group_lock, the multicast thread may wait for it with a group message
+            self.multicast_receiver.close()
+            self.thread_multicast.join()
+            multicast_socket.close()
+
+    def submit(self, target_name, msg_type, out_msg, max_attempts=5):
+        """
+        client API: send a request to the server or a private message to a client without waiting for it
+        any number of requests may be in flight, each is matched to its ack by its seq
+        return: Future, result is the additional info of the ack, DeliveryError if it was never acked
+        blocks only while the window of in-flight requests is full (never on the listening and retransmit threads, which move it)
+        """
+        if target_name == "server":
+            target_ip, target_port = self.server_ip, self.server_listen_port
+        else:
+            try:
+                target_ip = self.client_table[target_name]["ip"]
+                target_port = self.client_table[target_name]["port"]
+            except KeyError:
+                future = concurrent.futures.Future()
+                future.set_exception(DeliveryError(f"User {target_name} does not exist"))
+                return future
+        # requests chained to a lookup or a failed delivery (sendPrivate) are sent from the listening / retransmit thread,
+        # which never wait for the window (they are the ones that move it)
+        wait = threading.current_thread() not in (getattr(self, "thread_recv", None), getattr(self, "thread_retransmit", None))
+        return self.sendRequest(target_name, target_ip, target_port, msg_type, out_msg, max_attempts, wait=wait).future
+
+    def chain(self, future, then, otherwise=None):
+        # Future of then(result of future), then() returns a value or another Future; DeliveryErrors are passed on,
+        # or replaced by otherwise(error) (a value or a Future as well)
+        chained = concurrent.futures.Future()
+        def resolved(future):
+            try:
+                try:
+                    result = then(future.result())
+                except DeliveryError as e:
+                    if otherwise is None or future.exception() is None:
+                        raise
+                    result = otherwise(e)
+            except DeliveryError as e:
+                chained.set_exception(e)
+                return
+            if not isinstance(result, concurrent.futures.Future):
+                chained.set_result(result)
+                return
+            result.add_done_callback(lambda result: chained.set_exception(result.exception()) if result.exception() is not None else chained.set_result(result.result()))
+        future.add_done_callback(resolved)
+        return chained
+
+    def isFresh(self, target_name):
+        # the client_table entry of target_name can be used as it is (a presence client's only until it expires)
+        if target_name not in self.client_table:
+            return False
+        if not self.presence:
+            return True
+        if time.monotonic() >= self.table_expiry.get(target_name, 0):
+            return False
+        try:
+            self.client_table.move_to_end(target_name) # most recently used
+        except KeyError:
+            return False # dropped by the listening thread meanwhile
+        return True
+
+    def learnPeer(self, target_name, info):
+        # remember a looked up / pushed entry, a presence client for PRESENCE_TTL
+        self.client_table[target_name] = info
+        if info["online"]:
+            # (back) online: its seqs start anew
+            self.recent_seqs.pop(target_name, None)
+        if not self.presence:
+            return
+        self.client_table.move_to_end(target_name)
+        self.table_expiry[target_name] = time.monotonic() + PRESENCE_TTL
+        while len(self.client_table) > PEER_CACHE_SIZE:
+            evicted, _ = self.client_table.popitem(last=False)
+            self.table_expiry.pop(evicted, None)
+            self.submit("server", "unsubscribe", evicted) # no more pushes about it
+
+    def lookUp(self, target_name, unreachable=None):
+        """
+        ask the server for the client_table entry of target_name: "subscribe" for a presence client, "resolve" otherwise
+        unreachable: (ip, port) where target_name did not ack, the server sets it offline if it is still there
+        return: Future, result is the entry, None if there is no such client
+        """
+        if unreachable is None and self.presence:
+            return self.subscribe(target_name)
+        out_msg = target_name if unreachable is None else ";".join([target_name, unreachable[0], str(unreachable[1])])
+        def looked_up(out_msg):
+            if out_msg is None:
+                return None
+            info = json.loads(out_msg)
+            if not self.presence or target_name in self.client_table:
+                self.learnPeer(target_name, info)
+            return info
+        return self.chain(self.submit("server", "resolve", out_msg), looked_up)
+
+    def subscribe(self, target_name):
+        """
+        client API: look up client target_name at the server, which pushes its later changes to us from then on
+        return: Future, result is its client_table entry {"ip", "port", "online"}, None if there is no such client
+        """
+        def looked_up(out_msg):
+            if out_msg is None:
+                return None
+            info = json.loads(out_msg)
+            self.learnPeer(target_name, info)
+            return info
+        return self.chain(self.submit("server", "subscribe", target_name), looked_up)
+
+    def unsubscribe(self, target_name):
+        # client API: no more pushes about target_name, its entry is forgotten
+        self.client_table.pop(target_name, None)
+        self.table_expiry.pop(target_name, None)
+        return self.submit("server", "unsubscribe", target_name)
+
+    def sendPrivate(self, target_name, text):
+        info = self.client_table.get(target_name) if self.isFresh(target_name) else None
+        if info is None:
+            # not in client_table (or expired): look the peer up first, DeliveryError "does not exist" if there is no such client
+            def looked_up(info):
+                if info is None:
+                    raise DeliveryError(f"User {target_name} does not exist")
+                return self.sendPrivate(target_name, text)
+            return self.chain(self.lookUp(target_name), looked_up)
+        # to a client known to be offline: kept by the server, result "queued" (or "full", "not queued")
+        if not info["online"]:
+            return self.spoolPrivate(target_name, text)
+        addr = (info["ip"], info["port"])
+        return self.chain(self.submit(target_name, "pri_msg", text), lambda result: result,
+                          otherwise=lambda error: self.redeliver(target_name, addr, text, error))
+
+    def redeliver(self, target_name, addr, text, error):
+        # a private message target_name never acked at addr: one "resolve" tells whether it registered again elsewhere
+        # (sent there once more) or is offline now (kept by the server, result "queued"), error again otherwise
+        def resolved(info):
+            if info is None:
+                raise error
+            if not info["online"]:
+                return self.spoolPrivate(target_name, text)
+            if (info["ip"], info["port"]) != addr:
+                return self.submit(target_name, "pri_msg", text)
+            raise error
+        return self.chain(self.lookUp(target_name, unreachable=addr), resolved)
+
+    def spoolPrivate(self, target_name, text):
+        # leave a private message for an offline client with the server, sent to the client itself if it is back
+        return self.chain(self.submit("server", "spool", target_name + ";" + text), lambda result: self.spooled(target_name, text, result))
+
+    def spooled(self, target_name, text, result):
+        # ack of spool: "online;<ip>;<port>" when target_name registered again and our table did not know yet,
+        # then the message goes to it directly (a Future of that), the ack's result otherwise
+        if result is None or not result.startswith("online;"):
+            return result
+        _, ip, port = result.split(";")
+        self.learnPeer(target_name, {"ip": ip, "port": int(port), "online": True})
+        return self.submit(target_name, "pri_msg", text)
+
+    def sendGroup(self, group_name, text):
+        # result "already not in group" if the server dropped us from the group, "not exists" if there is no such group
+        return self.chain(self.submit("server", "send_group", group_name + ";" + text), lambda result: self.sentToGroup(group_name, result))
+
+    def createGroup(self, group_name):
+        return self.submit("server", "create_group", group_name) # result "created" / "exists"
+
+    def listGroups(self):
+        return self.submit("server", "list_groups", None) # result "grp1;grp2;..." or None
+
+    def joinGroup(self, group_name):
+        return self.chain(self.submit("server", "join_group", group_name), lambda result: self.joinedGroup(group_name, result)) # result "joined" / "not exists"
+
+    def listMembers(self, group_name):
+        return self.submit("server", "list_members", group_name) # result "name1;name2;..." / "already not in group" / "not exists"
+
+    def leaveGroup(self, group_name):
+        return self.chain(self.submit("server", "leave_group", group_name), lambda result: self.leftGroup(group_name, result))
+
+    def groupHistory(self, group_name, first, last=None):
+        """
+        client API: the messages of a group we are in that the server still keeps, seq first..last
+        (first < 0: the newest -first messages, last None: up to the newest), fetched in as many requests as needed
+        return: Future, result is [[seq, sender, text], ...], None if we are not in the group
+        """
+        collected = []
+        def fetch(first, last):
+            out_msg = ";".join([group_name, str(first), "" if last is None else str(last)])
+            return self.chain(self.submit("server", "history", out_msg), lambda reply: received(reply, last))
+        def received(reply, last):
+            if reply == "already not in group":
+                return None
+            reply = json.loads(reply)
+            collected.extend(reply["messages"])
+            end = reply["seq"] if last is None else min(last, reply["seq"])
+            if reply["messages"] and reply["messages"][-1][0] < end:
+                return fetch(reply["messages"][-1][0] + 1, end) # the rest did not fit into one reply
+            return collected
+        return fetch(first, last)
+
+    def joinedGroup(self, group_name, result):
+        # "joined;<seq>" from a server numbering group messages: the messages we see start after that seq
+        # "joined;<seq>;<ip>:<port>" from a server multicasting them as well: the group's multicast address
+        if result is None or not result.startswith("joined"):
+            return result
+        fields = result.split(";")
+        with self.group_lock:
+            self.group_held.pop(group_name, None)
+            if len(fields) > 1:
+                self.group_seqs[group_name] = int(fields[1])
+        if len(fields) > 2:
+            self.joinMulticast(group_name, fields[2])
+        return "joined"
+
+    def leftGroup(self, group_name, result):
+        with self.group_lock:
+            self.group_seqs.pop(group_name, None)
+            self.group_held.pop(group_name, None)
+            self.leaveMulticast(group_name)
+        return result
+
+    def sentToGroup(self, group_name, result):
+        # ack of send_group: the seq of our own message, not a gap when the next message of the group arrives
+        if result in ("already not in group", "not exists"):
+            return self.leftGroup(group_name, result)
+        if result is not None:
+            self.groupReceived(group_name, int(result), None)
+        return None
+
+    def groupReceived(self, group_name, group_seq, entry):
+        # a numbered group message (sender, text), None for our own: shown once every message before it was
+        with self.group_lock:
+            last = self.group_seqs.get(group_name)
+            if last is None:
+                # joined before this client started numbering (e.g. through another client): start here
+                last = self.group_seqs[group_name] = group_seq - 1
+            if group_seq <= last:
+                return # duplicate, or skipped as lost
+            self.group_held.setdefault(group_name, {})[group_seq] = entry
+            gap = self.flushGroup(group_name)
+        self.fetchGap(group_name, gap)
+
+    def flushGroup(self, group_name):
+        # show the held messages that follow without a gap; hold group_lock
+        # return: (first, end) of the missing messages before the others if they are to be fetched now, None otherwise
+        held = self.group_held.get(group_name, {})
+        last = self.group_seqs[group_name]
+        while last + 1 in held:
+            last += 1
+            entry = held.pop(last)
+            if entry is not None:
+                self.showGroup(*entry)
+        self.group_seqs[group_name] = last
+        if held and group_name not in self.group_fetching:
+            # messages last + 1 .. first held - 1 were lost (or are late): fetch all of them in one request
+            self.group_fetching.add(group_name)
+            return last + 1, min(held) - 1
+        return None
+
+    def fetchGap(self, group_name, gap):
+        # history request for a gap found by flushGroup, sent after releasing group_lock: submit may wait for the
+        # window, and the listening thread that moves it needs group_lock for every group message
+        if gap is None:
+            return
+        first, end = gap
+        self.groupHistory(group_name, first, end).add_done_callback(lambda future: self.gapFetched(group_name, end, future))
+
+    def gapFetched(self, group_name, end, future):
+        with self.group_lock:
+            self.group_fetching.discard(group_name)
+            try:
+                messages = future.result() or []
+            except DeliveryError:
+                messages = []
+            last = self.group_seqs.get(group_name)
+            if last is None:
+                return # left the group meanwhile
+            held = self.group_held.setdefault(group_name, {})
+            for group_seq, grp_msg_sender, text in messages:
+                if group_seq > last and group_seq not in held:
+                    held[group_seq] = (grp_msg_sender, text) if grp_msg_sender != self.name else None
+            # show what we have up to end in order; what is still missing is no longer kept by the server
+            # (or there was no answer): skip it, a gap after end opened while fetching and gets its own request
+            for group_seq in sorted(group_seq for group_seq in held if group_seq <= end):
+                entry = held.pop(group_seq)
+                if entry is not None:
+                    self.showGroup(*entry)
+            self.group_seqs[group_name] = max(last, end)
+            gap = self.flushGroup(group_name)
+        self.fetchGap(group_name, gap)
+
+    def dereg(self):
+        return self.submit("server", "dereg", None)
+
+    # main thread: take in user command
+    def clientMode(self):
+        self.interactive = True
+        self.startListening()
         print(">>> Client start listening", end="")
 
-        # send registration request to the server
-        out_packet = packetFormat(sender_listening_port=self.client_listen_port, sender_name=self.name, msg_type="reg", msg=None)
-        self.client_send_socket.sendto(out_packet.encode(), (self.server_ip, self.server_listen_port))
+        self.register()
         print("\n>>> Registration request sent", end="")
 
 
@@ -504,6 +3066,14 @@ class Client():
             if command == "send":
                 # send private message
                 target_name = input_list[1]
+                if not self.isFresh(target_name):
+                    # not in client_table (or expired): look the peer up at the server first
+                    try:
+                        self.lookUp(target_name).result()
+                    except DeliveryError:
+                        print("\n>>> Server not responding", end="")
+                        print("\n>>> Exiting", end="")
+                        os._exit(1)
                 try:
                     target_ip = self.client_table[target_name]["ip"]
                     target_port = self.client_table[target_name]["port"]
@@ -530,6 +3100,13 @@ class Client():
                 for i in range(2, len(input_list)):
                     out_msg = out_msg + input_list[i] + " "
                 msg_type = "pri_msg"
+                if not self.client_table[target_name]["online"]:
+                    # known to be offline: leave the message with the server instead of waiting for acks that never come
+                    out_msg = target_name + ";" + out_msg
+                    msg_type = "spool"
+                    target_name = "server"
+                    target_ip = self.server_ip
+                    target_port = self.server_listen_port
 
             elif command == "dereg":
                 try:
@@ -608,152 +3185,167 @@ class Client():
                 out_msg = self.groupName
                 msg_type = "leave_group"
 
+            elif command == "history":
+                """
+                history [<number>]: the last messages of the group (default 10) the server still keeps
+                """
+                if not self.groupMode:
+                    print("\n>>> Invalid command", end="")
+                    continue
+                try:
+                    count = int(input_list[1]) if len(input_list) > 1 else 10
+                except ValueError:
+                    count = 0
+                if count < 1:
+                    print(f"\n>>> ({self.groupName}) Invalid command", end="")
+                    continue
+                try:
+                    messages = self.groupHistory(self.groupName, -count).result()
+                except DeliveryError:
+                    print(f"\n>>> ({self.groupName}) Server not responding", end="")
+                    print(f"\n>>> ({self.groupName}) Exiting", end="")
+                    os._exit(1)
+                if messages is None:
+                    print("\n>>> You're already not in the group, because the Server didn't receive your previous ack to a group message.", end="")
+                    self.groupMode = False
+                    self.groupName = None
+                elif not messages:
+                    print(f"\n>>> ({self.groupName}) No kept messages", end="")
+                for _, grp_msg_sender, msg_content in messages or []:
+                    print(f"\n>>> ({self.groupName}) History " + grp_msg_sender + ": " + msg_content, end="")
+                continue
+
             else:
                 # other user inputs that cannot be recognized
                 print("\n>>> Invalid command", end="") if not self.groupMode else print(f"\n>>> ({self.groupName}) Invalid command", end="")
                 continue
 
 
-            # send request/message to server/other_client, retry for 5 times
-            num_retries = 0
-            while num_retries < 5:
-                out_packet = packetFormat(sender_listening_port=self.client_listen_port, sender_name=self.name, msg_type=msg_type, msg=out_msg)
-                with self.send_lock:
-                    self.client_send_socket.sendto(out_packet.encode(), (target_ip, target_port))
-
-                # create the ack requirement
-                with self.ack_lock:
-                    self.ack_dict[target_name] = {"ack": False, "info": None}
+            # send request/message to server/other_client, retransmitted up to 5 times,
+            # returns as soon as the ack arrives
+            ackReceived, additional_info = self.sendReliable(target_name, target_ip, target_port, msg_type, out_msg)
+            if ackReceived and msg_type == "join_group":
+                additional_info = self.joinedGroup(group_name, additional_info)
+            elif ackReceived and msg_type == "send_group":
+                # our own group message, not a gap
+                additional_info = self.sentToGroup(self.groupName, additional_info)
+            elif ackReceived and msg_type == "leave_group":
+                additional_info = self.leftGroup(self.groupName, additional_info)
+            if ackReceived:
+                # based on command, print corresponding msg
+                if command == "send" and msg_type == "spool":
+                    self.printSpooled(input_list[1], self.spooled(input_list[1], out_msg.split(";", maxsplit=1)[1], additional_info))
+
+                elif command == "send":
+                    print(f"\n>>> Message received by {target_name}.", end="")
+
+                elif command == "dereg":
+                    print("\n>>> You are Offline. Bye.", end="")
+                    while not self.pri_msg_queue.empty():
+                        pri_sender, cached_msg = self.pri_msg_queue.get()
+                        print("\n>>> " + pri_sender + ": " + cached_msg, end="")
 
-                # sleep for 0.5 sec
-                time.sleep(0.5)
+                    os._exit(1)
 
-                # wake up, check the ack dict whether ack is received
-                # client only has to deal with single ack at a time
-                with self.ack_lock:
-                    ackReceived = self.ack_dict[target_name]["ack"]
-                    additional_info = self.ack_dict[target_name]["info"]
-                if ackReceived:
-                    # change the flag back to False, for future ack to use
-                    self.ack_dict[target_name] = {"ack": False, "info": None}
-
-                    # based on command, print corresponding msg
-                    if command == "send":
-                        print(f"\n>>> Message received by {target_name}.", end="")
-
-                    elif command == "dereg":
-                        print("\n>>> You are Offline. Bye.", end="")
+                elif command == "create_group":
+                    if additional_info == "created":
+                        print(f"\n>>> Group {group_name} created by Server.", end="")
+                    elif additional_info == "exists":
+                        print(f"\n>>> Group {group_name} already exists.", end="")
+
+                elif command == "list_groups":
+                    if additional_info:
+                        # if addition_info is not None
+                        grp_names = additional_info.split(";")
+                        print("\n>>> Available group chats:", end="")
+                        for grp_name in grp_names:
+                            print("\n>>> " + grp_name, end="")
+                    else:
+                        print("\n>>> No available group right now", end="")
+
+                elif command == "join_group":
+                    if additional_info == "joined":
+                        self.groupMode = True
+                        self.groupName = group_name
+                        print(f"\n>>> Entered group {group_name} successfully", end="")
+                    elif additional_info == "not exists":
+                        print(f"\n>>> Group {group_name} does not exist", end="")
+
+                elif command == "send_group":
+                    if additional_info == "already not in group":
+                        print("\n>>> You're already not in the group, because the Server didn't receive your previous ack to a group message.", end="")
+                        self.groupMode = False
+                        self.groupName = None
+                        # check if pri_msg_queue is empty, if not, print out all msg
                         while not self.pri_msg_queue.empty():
                             pri_sender, cached_msg = self.pri_msg_queue.get()
                             print("\n>>> " + pri_sender + ": " + cached_msg, end="")
+                    else:
+                        print(f"\n>>> ({self.groupName}) Message received by Server.", end="")
 
-                        os._exit(1)
-
-                    elif command == "create_group":
-                        if additional_info == "created":
-                            print(f"\n>>> Group {group_name} created by Server.", end="")
-                        elif additional_info == "exists":
-                            print(f"\n>>> Group {group_name} already exists.", end="")
-
-                    elif command == "list_groups":
-                        if additional_info:
-                            # if addition_info is not None
-                            grp_names = additional_info.split(";")
-                            print("\n>>> Available group chats:", end="")
-                            for grp_name in grp_names:
-                                print("\n>>> " + grp_name, end="")
-                        else:
-                            print("\n>>> No available group right now", end="")
-
-                    elif command == "join_group":
-                        if additional_info == "joined":
-                            self.groupMode = True
-                            self.groupName = group_name
-                            print(f"\n>>> Entered group {group_name} successfully", end="")
-                        elif additional_info == "not exists":
-                            print(f"\n>>> Group {group_name} does not exist", end="")
-
-                    elif command == "send_group":
-                        if additional_info == "already not in group":
-                            print("\n>>> You're already not in the group, because the Server didn't receive your previous ack to a group message.", end="")
-                            self.groupMode = False
-                            self.groupName = None
-                            # check if pri_msg_queue is empty, if not, print out all msg
-                            while not self.pri_msg_queue.empty():
-                                pri_sender, cached_msg = self.pri_msg_queue.get()
-                                print("\n>>> " + pri_sender + ": " + cached_msg, end="")
-                        else:
-                            print(f"\n>>> ({self.groupName}) Message received by Server.", end="")
-
-                    elif command == "list_members":
-                        if additional_info == "already not in group":
-                            print("\n>>> You're already not in the group, because the Server didn't receive your previous ack to a group message.", end="")
-                            self.groupMode = False
-                            self.groupName = None
-                            # check if pri_msg_queue is empty, if not, print out all msg
-                            while not self.pri_msg_queue.empty():
-                                pri_sender, cached_msg = self.pri_msg_queue.get()
-                                print("\n>>> " + pri_sender + ": " + cached_msg, end="")
-                        else:
-                            print(f"\n>>> ({self.groupName}) Members in the group {self.groupName}:", end="")
-                            member_names = additional_info.split(";")
-                            for member_name in member_names:
-                                print(f"\n>>> ({self.groupName}) " + member_name, end="")
-
-                    elif command == "leave_group":
-                        if additional_info == "already not in group":
-                            print("\n>>> You're already not in the group, because the Server didn't receive your previous ack to a group message.", end="")
-                            self.groupMode = False
-                            self.groupName = None
-                        else:
-                            print(f"\n>>> Leave group chat {self.groupName}", end="")
-                            self.groupMode = False
-                            self.groupName = None
-
+                elif command == "list_members":
+                    if additional_info == "already not in group":
+                        print("\n>>> You're already not in the group, because the Server didn't receive your previous ack to a group message.", end="")
+                        self.groupMode = False
+                        self.groupName = None
                         # check if pri_msg_queue is empty, if not, print out all msg
                         while not self.pri_msg_queue.empty():
                             pri_sender, cached_msg = self.pri_msg_queue.get()
                             print("\n>>> " + pri_sender + ": " + cached_msg, end="")
+                    else:
+                        print(f"\n>>> ({self.groupName}) Members in the group {self.groupName}:", end="")
+                        member_names = additional_info.split(";")
+                        for member_name in member_names:
+                            print(f"\n>>> ({self.groupName}) " + member_name, end="")
+
+                elif command == "leave_group":
+                    if additional_info == "already not in group":
+                        print("\n>>> You're already not in the group, because the Server didn't receive your previous ack to a group message.", end="")
+                        self.groupMode = False
+                        self.groupName = None
+                    else:
+                        print(f"\n>>> Leave group chat {self.groupName}", end="")
+                        self.groupMode = False
+                        self.groupName = None
 
-                    break
-
-                num_retries += 1
+                    # check if pri_msg_queue is empty, if not, print out all msg
+                    while not self.pri_msg_queue.empty():
+                        pri_sender, cached_msg = self.pri_msg_queue.get()
+                        print("\n>>> " + pri_sender + ": " + cached_msg, end="")
 
-            if num_retries == 5: # this judgement seems unnecessary
-                if command == "send":
+            else:
+                if command == "send" and msg_type == "pri_msg":
                     # receiver-side client no respond, already offline
                     print(f"\n>>> No ACK from {target_name}, message not delivered", end="")
 
                     print("\n>>> Report this issue to server", end="")
-                    # report to server, server have to update and broadcast client table, do not need ack
-                    out_packet = packetFormat(sender_listening_port=self.client_listen_port, sender_name=self.name, msg_type="kick", msg=target_name)
-                    with self.send_lock:
-                        self.client_send_socket.sendto(out_packet.encode(), (self.server_ip, self.server_listen_port))
-
-                    # should expect an ack of kick from server, because if server already offline, the client should know and exit;
-                    # if server still online, we can therefore ensure client's client_table is updated
-                    # otherwise, when server and clientY are both offline,  client X's table will never be updated and keep trying to send msg to Y
-
-                    # create the ack requirement
-                    with self.ack_lock:
-                        self.ack_dict["server"] = {"ack": False, "info": None}
-
-                    # sleep for 0.5 sec
-                    time.sleep(0.5)
-
-                    # wake up, check the ack dict whether ack is received
-                    # client only has to deal with single ack at a time
-                    with self.ack_lock:
-                        ackReceived = self.ack_dict["server"]["ack"]
+                    # report to server with "resolve": in one round trip the server sets target offline if it is still
+                    # at this address (and broadcasts that), or tells us where it registered again meanwhile
+                    # should expect an ack from server, because if server already offline, the client should know and exit
+
+                    try:
+                        info = self.lookUp(target_name, unreachable=(target_ip, target_port)).result()
+                        ackReceived = True
+                    except DeliveryError:
+                        ackReceived = False
+                    if ackReceived and info is not None and info["online"]:
+                        ackReceived, _ = self.sendReliable(target_name, info["ip"], info["port"], msg_type, out_msg)
+                        if ackReceived:
+                            print(f"\n>>> Message received by {target_name}.", end="")
+                        else:
+                            print(f"\n>>> No ACK from {target_name}, message not delivered", end="")
+                        ackReceived = True
+                    elif ackReceived:
+                        # the message is not lost: the server keeps it until target comes back
+                        ackReceived, additional_info = self.sendReliable("server", self.server_ip, self.server_listen_port, "spool", target_name + ";" + out_msg)
+                        if ackReceived:
+                            self.printSpooled(target_name, self.spooled(target_name, out_msg, additional_info))
                     if not ackReceived:
                         # server not respond
                         prefix = "(" + self.groupName + ") " if self.groupMode else ""
                         print("\n>>> " + prefix + "Server not responding", end="")
                         print("\n>>> " + prefix + "Exiting", end="")
                         os._exit(1)
-                    else:
-                        # change the flag back to False, for future ack
-                        self.ack_dict["server"] = {"ack": False, "info": None}
 
                 else:
                     # server not respond
@@ -773,18 +3365,164 @@ class Client():
                     # ADD: client kill itself (Q: how?)
 
 
+    def printSpooled(self, target_name, additional_info):
+        if isinstance(additional_info, concurrent.futures.Future):
+            # target was back online, the message went to it directly (spooled)
+            try:
+                additional_info.result()
+                print(f"\n>>> Message received by {target_name}.", end="")
+            except DeliveryError:
+                print(f"\n>>> No ACK from {target_name}, message not delivered", end="")
+        elif additional_info == "queued":
+            print(f"\n>>> {target_name} is offline, message kept by Server.", end="")
+        elif additional_info == "full":
+            print(f"\n>>> {target_name} is offline and Server keeps no more messages, message not delivered", end="")
+        else:
+            print(f"\n>>> {target_name} is offline, message not delivered", end="")
+
+    def showPrivate(self, sender_name, text):
+        if not self.interactive:
+            if self.on_message is not None:
+                self.on_message("pri_msg", sender_name, text)
+        elif self.groupMode:
+            # place private message in private message queue
+            self.pri_msg_queue.put((sender_name, text))
+        else:
+            # print out private message
+            print(f"\n>>> {sender_name}: " + text, end="")
+            print("\n>>> ", end="") if not self.groupMode else print(f"\n>>> ({self.groupName}) ", end="")
+
+    def showGroup(self, sender_name, text):
+        if not self.interactive:
+            if self.on_message is not None:
+                self.on_message("grp_msg", sender_name, text)
+        else:
+            print("\n>>> (" + self.groupName + ") Group_Message " + sender_name + ": " + text, end="")
+            print("\n>>> ", end="") if not self.groupMode else print(f"\n>>> ({self.groupName}) ", end="")
+
+    # sub thread: fetch the private messages the server kept for us while we were offline, batch by batch
+    def fetchSpool(self):
+        while True:
+            ackReceived, additional_info = self.sendReliable("server", self.server_ip, self.server_listen_port, "spool_req", None)
+            if not ackReceived or not additional_info:
+                return
+            for sender_name, text in json.loads(additional_info):
+                self.showPrivate(sender_name, text)
+
+    def groupMessage(self, msg_type, in_msg, sender_ip, sender_listening_port, wire):
+        # a group message from the server, by unicast (listening thread) or multicast (multicast thread)
+        if msg_type == "grp_seq":
+            grp_msg_sender, msg_id, group_name, group_seq, msg_content = in_msg.split(";", maxsplit=4)
+        else:
+            grp_msg_sender, msg_id, msg_content = in_msg.split(";", maxsplit=2)
+
+        # reply ack to server, regarding this specific group memessage (sender, id)
+        out_packet = packetEncode(sender_listening_port=self.client_listen_port, sender_name=self.name,
+                                  msg_type="ack", msg=grp_msg_sender + ";" + msg_id, wire=wire)
+        with self.send_lock:
+            self.client_send_socket.sendto(out_packet, (sender_ip, sender_listening_port))
+
+        # print out group message, a numbered one once the messages before it are shown
+        if msg_type == "grp_seq":
+            self.groupReceived(group_name, int(group_seq), (grp_msg_sender, msg_content))
+        else:
+            self.showGroup(grp_msg_sender, msg_content)
+
+    # sub thread: group messages the server sent to the multicast address of one of our groups
+    def clientMulticast(self):
+        for data, addr in self.multicast_receiver:
+            if self.stopped:
+                return
+            if addr[0] != self.server_ip or data[:1] != bytes([WIRE_MAGIC]):
+                continue # someone else on this host / LAN using the address
+            try:
+                sender_listening_port, sender_name, msg_type, in_msg, seq = packetDecode(data)
+            except DECODE_ERRORS:
+                continue
+            if msg_type != "grp_seq":
+                continue
+            grp_msg_sender, _, group_name, _ = in_msg.split(";", maxsplit=3)
+            # every multicast socket on the port gets what any of them joined: only our groups, not our own messages
+            if group_name in self.multicast_groups and grp_msg_sender != self.name:
+                self.groupMessage(msg_type, in_msg, addr[0], sender_listening_port, WIRE_BINARY)
+
+    def joinMulticast(self, group_name, multicast_addr):
+        # "<ip>:<port>" announced on join_group: join it, then tell the server to send the group's messages there
+        # if that does not work here, nothing is said and the messages keep coming by unicast
+        ip, port = multicast_addr.split(":")
+        address = (ip, int(port))
+        with self.group_lock:
+            try:
+                if self.multicast_socket is None:
+                    multicast_socket = socket(AF_INET, SOCK_DGRAM)
+                    multicast_socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1) # all clients on this host listen on the port
+                    multicast_socket.bind(("", address[1]))
+                    self.multicast_socket = multicast_socket
+                    self.multicast_receiver = BatchReceiver(multicast_socket)
+                    self.thread_multicast = threading.Thread(target=self.clientMulticast, daemon=True)
+                    self.thread_multicast.start()
+                elif self.multicast_socket.getsockname()[1] != address[1]:
+                    return
+                if address not in self.multicast_groups.values(): # two groups may share an address
+                    self.multicast_socket.setsockopt(IPPROTO_IP, IP_ADD_MEMBERSHIP, inet_aton(ip) + inet_aton(self.host))
+            except OSError:
+                return
+            self.multicast_groups[group_name] = address
+        self.submit("server", "multicast", group_name)
+
+    def leaveMulticast(self, group_name):
+        # hold group_lock
+        address = self.multicast_groups.pop(group_name, None)
+        if address is None or address in self.multicast_groups.values():
+            return
+        try:
+            self.multicast_socket.setsockopt(IPPROTO_IP, IP_DROP_MEMBERSHIP, inet_aton(address[0]) + inet_aton(self.host))
+        except OSError:
+            pass
+
+    def printTableUpdated(self):
+        if not self.interactive:
+            return
+        prefix = "(" + self.groupName + ") " if self.groupMode else ""
+        print("\n>>> "+ prefix + "Client table updated.", end="")
+        print("\n" + str(self.client_table), end="")
+        print("\n>>> ", end="") if not self.groupMode else print(f"\n>>> ({self.groupName}) ", end="")
+        # because you don't know the next print would be input command or sth triggered by incoming msg
+        # maybe the ">>>" from input command already printed out before
 
     # keep listening on messages (broadcast table, group msg, private msg, [ack])
     # if received ack, modify global ack dictionary
     def clientListen(self):
-        while True:
-            data, addr = self.client_listen_socket.recvfrom(4096)
-            sender_listening_port, sender_name, msg_type, in_msg = packetResolve(data)
+        # a burst (table deltas, group messages, acks of pipelined requests) is taken in with one syscall
+        for data, addr in self.receiver:
+            if self.stopped:
+                return
+            data = self.fragments.receive(data, addr)
+            if data is None:
+                continue # fragment of a packet still incomplete, or a nack
+            try:
+                sender_listening_port, sender_name, msg_type, in_msg, seq = packetDecode(data)
+            except DECODE_ERRORS:
+                self.malformed_packets += 1
+                continue
+            # answer in the same format, and remember it for later requests to this sender
+            wire = packetWire(data)
+            if self.wire != WIRE_TEXT:
+                self.peer_wire[sender_name] = wire
             sender_ip = addr[0]
             sender_sending_port = addr[1]
 
             if msg_type == "reg_ack":
-                if in_msg == "Successfully registered.":
+                if not self.registration.done():
+                    if in_msg == "Successfully registered.":
+                        self.registration.set_result(in_msg)
+                        # messages the server kept while we were offline, fetched off the listening thread
+                        threading.Thread(target=self.fetchSpool, daemon=True).start()
+                    else:
+                        self.registration.set_exception(DeliveryError(in_msg))
+                if not self.interactive:
+                    pass
+                elif in_msg == "Successfully registered.":
                     print("\n>>> Welcome, You are registered.", end="")
                 elif in_msg == "Name taken.":
                     print("\n>>> Someone has already used this name. Try another one.", end="")
@@ -796,56 +3534,101 @@ class Client():
             elif msg_type == "table":
                 # received from server, update local client table
                 self.client_table = json.loads(in_msg) # string to dict
-                prefix = "(" + self.groupName + ") " if self.groupMode else ""
-                print("\n>>> "+ prefix + "Client table updated.", end="")
-                print("\n" + str(self.client_table), end="")
-                print("\n>>> ", end="") if not self.groupMode else print(f"\n>>> ({self.groupName}) ", end="")
-                # because you don't know the next print would be input command or sth triggered by incoming msg
-                # maybe the ">>>" from input command already printed out before
-
-            elif msg_type == "grp_msg":
+                self.printTableUpdated()
+
+            elif msg_type == "snapshot":
+                # versioned full client table, received after registration or after asking for it
+                snapshot = json.loads(in_msg)
+                if snapshot["version"] >= self.table_version:
+                    self.table_version = snapshot["version"]
+                    self.client_table = snapshot["table"]
+                    self.printTableUpdated()
+
+            elif msg_type == "delta":
+                # one change of the client table, or a batch: the last state of every client changed after version "base"
+                delta = json.loads(in_msg)
+                base = delta.get("base", delta["version"] - 1)
+                changes = delta["changes"] if "changes" in delta else {delta["name"]: delta["info"]}
+                if base <= self.table_version < delta["version"]:
+                    self.table_version = delta["version"]
+                    for name, info in changes.items():
+                        self.client_table[name] = info
+                        if info["online"]:
+                            # (back) online: its seqs start anew
+                            self.recent_seqs.pop(name, None)
+                    self.printTableUpdated()
+                elif self.table_version < base:
+                    # missed at least one delta, ask server for the whole table
+                    if time.time() - self.snapshot_requested_at > 0.5:
+                        self.snapshot_requested_at = time.time()
+                        out_packet = packetEncode(sender_listening_port=self.client_listen_port, sender_name=self.name, msg_type="snapshot_req", msg=None, wire=self.wireFor("server"))
+                        with self.send_lock:
+                            self.client_send_socket.sendto(out_packet, (self.server_ip, self.server_listen_port))
+                # else: old or duplicated delta, already applied
+
+            elif msg_type == "presence":
+                # changes of the peers we subscribed to {name: info}, pushed by server to a presence client
+                for name, info in json.loads(in_msg).items():
+                    if name in self.table_expiry:
+                        self.learnPeer(name, info)
+                self.printTableUpdated()
+
+            elif msg_type == "ping":
+                # heartbeat of the server, answer at once, do not need ack
+                out_packet = packetEncode(sender_listening_port=self.client_listen_port, sender_name=self.name, msg_type="pong", msg=None, wire=wire)
+                with self.send_lock:
+                    self.client_send_socket.sendto(out_packet, (sender_ip, sender_listening_port))
+
+            elif msg_type in ("grp_msg", "grp_seq"):
                 # received from server
                 # print("receive grp msg from server")
                 # print("in_msg is:")
                 # print(in_msg)
-                grp_msg_sender = in_msg.split(";", maxsplit=2)[0]
-                msg_time = in_msg.split(";", maxsplit=2)[1]
-                msg_content = in_msg.split(";", maxsplit=2)[2]
-
-                # reply ack to server, regarding this specific group memessage (sender, time)
-                out_packet = packetFormat(sender_listening_port=self.client_listen_port, sender_name=self.name,
-                                          msg_type="ack", msg=grp_msg_sender + ";" + msg_time)
-                with self.send_lock:
-                    self.client_send_socket.sendto(out_packet.encode(), (sender_ip, sender_listening_port))
-
-                # print out group message
-                print("\n>>> (" + self.groupName + ") Group_Message " + grp_msg_sender + ": " + msg_content, end="")
-                print("\n>>> ", end="") if not self.groupMode else print(f"\n>>> ({self.groupName}) ", end="")
+                self.groupMessage(msg_type, in_msg, sender_ip, sender_listening_port, wire)
 
             elif msg_type == "pri_msg":
                 # send ack to sender client
                 # need to lock client_send_socket
-                out_packet = packetFormat(sender_listening_port=self.client_listen_port, sender_name=self.name,
-                                          msg_type="ack", msg=None)
+                out_packet = packetEncode(sender_listening_port=self.client_listen_port, sender_name=self.name,
+                                          msg_type="ack", msg=None, wire=wire, seq=seq)
                 with self.send_lock:
-                    self.client_send_socket.sendto(out_packet.encode(), (sender_ip, sender_listening_port))
+                    self.client_send_socket.sendto(out_packet, (sender_ip, sender_listening_port))
 
-                if self.groupMode:
-                    # place private message in private message queue
-                    self.pri_msg_queue.put((sender_name, in_msg))
+                if self.isDuplicate(sender_name, seq):
+                    # already shown, only the ack was lost
+                    pass
                 else:
-                    # print out private message
-                    print(f"\n>>> {sender_name}: " + in_msg, end="")
-                    print("\n>>> ", end="") if not self.groupMode else print(f"\n>>> ({self.groupName}) ", end="")
+                    self.showPrivate(sender_name, in_msg)
 
             elif msg_type == "ack":
                 # differentiate where this ack comes from, by sender_name
                 # update global ack table of that ack-sender
                 # need to lock act dict
                 with self.ack_lock:
-                    # write into ack_dict
-                    self.ack_dict[sender_name]["ack"] = True
-                    self.ack_dict[sender_name]["info"] = in_msg
+                    # ignore late acks nobody is waiting for
+                    pending = self.matchPending(sender_name, seq)
+                    if pending is not None:
+                        del self.pending[pending.seq]
+                        self.window.notify_all()
+                        # only a request sent once gives an unambiguous rtt sample (Karn's algorithm)
+                        if pending.attempts == 1:
+                            self.rtt[sender_name].sample(time.monotonic() - pending.sent_at)
+                if pending is not None:
+                    pending.future.set_result(in_msg)
+
+            elif msg_type == "slow_down":
+                # the server did not take this request (over a rate limit, or shedding load): it is sent again later,
+                # and our next requests to the server follow one every msec instead of all at once
+                interval = int(in_msg) / 1000
+                with self.ack_lock:
+                    now = time.monotonic()
+                    pace = self.paced.setdefault(sender_name, [now + interval, interval])
+                    pace[0] = max(pace[0], now + interval)
+                    pace[1] = interval
+                    pending = self.matchPending(sender_name, seq)
+                    if pending is not None and self.paceRequest(pending, now):
+                        heapq.heappush(self.deadlines, (pending.deadline, pending.seq))
+                        self.ack_cond.notify()
 
 
 
@@ -861,9 +3644,9 @@ if __name__ == "__main__":
     mode = sys.argv[1]
 
     if mode == '-s':
-        if len(sys.argv) != 3:
+        if len(sys.argv) not in (3, 5, 7, 9, 11, 13, 15, 17, 19, 21, 23, 25, 27, 29):
             print("Please use valid input like:")
-            print("python ChatApp.py -s <port>")
+            print("python ChatApp.py -s <port> [--engine threads|asyncio] [--workers <number>] [--compact <number>] [--state <directory>] [--spool <number>] [--stats <port>] [--verbose 0|1|2] [--coalesce <msec>] [--heartbeat <msec>] [--misses <number>] [--rate <number>] [--group-rate <number>] [--multicast <port>]")
             sys.exit(1)
 
         try:
@@ -875,14 +3658,143 @@ if __name__ == "__main__":
             print("Invalid server port number")
             sys.exit(1)
 
-        server = Server(server_listen_port)
-        server.serverMode()
+        # server engine: "threads" (a state thread owning the state, I/O threads around it) or "asyncio" (single event loop)
+        # workers: number of processes sharing the port (sharded server, threads engine in each of them)
+        # compact: drop offline accounts from the client table each time this many went offline (names stay taken)
+        # state: directory of the persistent state, accounts and groups survive a restart
+        # stats: port answering with the server metrics as json (worker i of a sharded server: port + i)
+        # verbose: 0 start up only, 1 one line per event, 2 also whole tables after every change
+        # coalesce: table changes within this many msec are broadcast together (registration storms), 0 turns it off
+        # heartbeat: ping silent clients every this many msec, set them offline after --misses unanswered pings, 0 turns it off
+        # rate / group-rate: requests per sec one client / group messages per sec one group may send, 0 turns it off
+        # multicast: send group messages to the members' multicast address on this port, 0 turns it off
+        engine = "threads"
+        workers = 1
+        compact_offline = None
+        state_dir = None
+        spool_limit = 0 # spool: messages kept per offline client, off (0) unless given
+        stats_port = None
+        verbosity = VERBOSE_EVENTS
+        table_window = 0
+        heartbeat = 0
+        heartbeat_misses = 3
+        rate_limit = 0
+        group_rate_limit = 0
+        multicast_port = 0
+        for i in range(3, len(sys.argv), 2):
+            if sys.argv[i] == "--engine":
+                if sys.argv[i + 1] not in ("threads", "asyncio"):
+                    print("Invalid server engine, use --engine threads OR --engine asyncio")
+                    sys.exit(1)
+                engine = sys.argv[i + 1]
+            elif sys.argv[i] == "--workers":
+                try:
+                    workers = int(sys.argv[i + 1])
+                except:
+                    workers = 0
+                if workers < 1:
+                    print("Invalid number of workers")
+                    sys.exit(1)
+            elif sys.argv[i] == "--compact":
+                try:
+                    compact_offline = int(sys.argv[i + 1])
+                except:
+                    compact_offline = 0
+                if compact_offline < 1:
+                    print("Invalid number of offline accounts to compact")
+                    sys.exit(1)
+            elif sys.argv[i] == "--state":
+                state_dir = sys.argv[i + 1]
+            elif sys.argv[i] == "--spool":
+                try:
+                    spool_limit = int(sys.argv[i + 1])
+                except:
+                    spool_limit = -1
+                if spool_limit < 0:
+                    print("Invalid number of kept messages")
+                    sys.exit(1)
+            elif sys.argv[i] == "--stats":
+                try:
+                    stats_port = int(sys.argv[i + 1])
+                except:
+                    stats_port = 0
+                if not (stats_port >= 1024 and stats_port <= 65535):
+                    print("Invalid stats port number")
+                    sys.exit(1)
+            elif sys.argv[i] == "--verbose":
+                if sys.argv[i + 1] not in ("0", "1", "2"):
+                    print("Invalid verbosity, use --verbose 0, 1 OR 2")
+                    sys.exit(1)
+                verbosity = int(sys.argv[i + 1])
+            elif sys.argv[i] == "--coalesce":
+                try:
+                    table_window = int(sys.argv[i + 1]) / 1000
+                except:
+                    table_window = -1
+                if table_window < 0:
+                    print("Invalid coalescing window")
+                    sys.exit(1)
+            elif sys.argv[i] == "--heartbeat":
+                try:
+                    heartbeat = int(sys.argv[i + 1]) / 1000
+                except:
+                    heartbeat = -1
+                if heartbeat < 0:
+                    print("Invalid heartbeat interval")
+                    sys.exit(1)
+            elif sys.argv[i] == "--misses":
+                try:
+                    heartbeat_misses = int(sys.argv[i + 1])
+                except:
+                    heartbeat_misses = 0
+                if heartbeat_misses < 1:
+                    print("Invalid number of missed heartbeats")
+                    sys.exit(1)
+            elif sys.argv[i] == "--rate":
+                try:
+                    rate_limit = float(sys.argv[i + 1])
+                except:
+                    rate_limit = -1
+                if rate_limit < 0:
+                    print("Invalid rate limit")
+                    sys.exit(1)
+            elif sys.argv[i] == "--group-rate":
+                try:
+                    group_rate_limit = float(sys.argv[i + 1])
+                except:
+                    group_rate_limit = -1
+                if group_rate_limit < 0:
+                    print("Invalid group rate limit")
+                    sys.exit(1)
+            elif sys.argv[i] == "--multicast":
+                try:
+                    multicast_port = int(sys.argv[i + 1])
+                except:
+                    multicast_port = -1
+                if not (multicast_port == 0 or 1024 <= multicast_port <= 65535):
+                    print("Invalid multicast port number")
+                    sys.exit(1)
+            else:
+                print("Invalid option " + sys.argv[i])
+                sys.exit(1)
+        if workers > 1 and engine != "threads":
+            print("The sharded server (--workers) runs the threads engine only")
+            sys.exit(1)
+
+        if workers > 1:
+            serveSharded(server_listen_port, workers, compact_offline, state_dir, spool_limit, stats_port, verbosity, table_window, heartbeat, heartbeat_misses, rate_limit, group_rate_limit, multicast_port)
+        elif engine == "asyncio":
+            server = AsyncServer(server_listen_port, compact_offline, state_dir, spool_limit, stats_port, verbosity, table_window, heartbeat, heartbeat_misses, rate_limit, group_rate_limit, multicast_port)
+            server.serverMode()
+        else:
+            server = Server(server_listen_port, compact_offline, state_dir, spool_limit, stats_port, verbosity, table_window, heartbeat, heartbeat_misses, rate_limit, group_rate_limit, multicast_port)
+            server.serverMode()
 
 
     elif mode == '-c':
-        if len(sys.argv) != 6:
+        if len(sys.argv) not in (6, 8, 10):
             print("Please use valid input like:")
-            print("python ChatApp.py -c <name> <server-ip> <server-port> <client-port>")
+            print("python ChatApp.py -c <name> <server-ip> <server-port> <client-port> [--wire binary|text] [--presence on|off]")
             sys.exit(1)
 
         # check name is valid, because I use name as a unique id, should not use the server's name
@@ -918,7 +3830,26 @@ if __name__ == "__main__":
             print("Invalid client port number")
             sys.exit(1)
 
-        client = Client(name, server_ip, server_listen_port, client_listen_port)
+        # wire format: "binary" (negotiated, falls back to text for legacy peers) or "text" only
+        # presence: "on" looks peers up at the server when first sending to them instead of receiving every table change
+        wire = WIRE_BINARY
+        presence = False
+        for i in range(6, len(sys.argv), 2):
+            if sys.argv[i] == "--wire":
+                if sys.argv[i + 1] not in (WIRE_BINARY, WIRE_TEXT):
+                    print("Invalid wire format, use --wire binary OR --wire text")
+                    sys.exit(1)
+                wire = sys.argv[i + 1]
+            elif sys.argv[i] == "--presence":
+                if sys.argv[i + 1] not in ("on", "off"):
+                    print("Invalid presence mode, use --presence on OR --presence off")
+                    sys.exit(1)
+                presence = sys.argv[i + 1] == "on"
+            else:
+                print("Invalid option " + sys.argv[i])
+                sys.exit(1)
+
+        client = Client(name, server_ip, server_listen_port, client_listen_port, wire, presence)
         client.clientMode()
 
     else:
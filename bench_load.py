@@ -0,0 +1,254 @@
+'''
+Load generator for the chat server in ChatApp.py
+starts the server on localhost, drives simulated clients over real UDP sockets with the Client API,
+and reports requests/sec, ack latency (p50/p99), group fan-out time and packet loss
+
+usage: python3 bench_load.py [scenario.json] [--engine threads|asyncio] [--workers <number>] [--port <server-port>] [--json <result-file>]
+exit status 1 if the scenario has limits ("max_loss", "max_p99_ms") and the run broke one of them
+
+scenario file (see scenarios/), every field optional:
+{
+    "seed": 1,                  random seed, the same scenario always sends the same requests
+    "clients": 10,              number of simulated clients
+    "groups": 2,                client i joins group i % groups
+    "requests_per_client": 50,
+    "pipeline": 8,              requests in flight per client
+    "message_size": 64,         bytes of every private/group message
+    "mix": {"pri_msg": 0.5, "send_group": 0.4, "list_groups": 0.1},
+    "max_loss": 0.0,
+    "max_p99_ms": 100
+}
+'''
+import sys
+import os
+import json
+import time
+import random
+import threading
+import subprocess
+import collections
+
+from ChatApp import Client, DeliveryError
+
+DEFAULT_SCENARIO = {
+    "seed": 1,
+    "clients": 10,
+    "groups": 2,
+    "requests_per_client": 50,
+    "pipeline": 8,
+    "message_size": 64,
+    "mix": {"pri_msg": 0.5, "send_group": 0.4, "list_groups": 0.1},
+}
+SETTLE_TIMEOUT = 5 # sec to wait for client tables / group messages to arrive
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+class LoadRun:
+    def __init__(self, scenario, server_port):
+        self.scenario = dict(DEFAULT_SCENARIO, **scenario)
+        self.server_port = server_port
+        self.clients = []
+        self.lock = threading.Lock()
+        self.latency = collections.defaultdict(list) # msg_type -> ack latencies in sec
+        self.failed = collections.Counter() # msg_type -> requests never acked
+        self.group_sent = {} # token -> (send time, number of expected recipients)
+        self.group_arrivals = collections.defaultdict(list) # token -> arrival times
+
+    def onMessage(self, msg_type, sender_name, text):
+        if msg_type == "grp_msg":
+            token = text.split(" ", 1)[0]
+            with self.lock:
+                self.group_arrivals[token].append(time.monotonic())
+
+    def record(self, msg_type, sent_at, future):
+        with self.lock:
+            try:
+                future.result()
+                self.latency[msg_type].append(time.monotonic() - sent_at)
+            except DeliveryError:
+                self.failed[msg_type] += 1
+
+    def setup(self):
+        # register every client, wait until all of them see each other, then join the groups
+        scenario = self.scenario
+        for i in range(scenario["clients"]):
+            client = Client(f"load{i}", "127.0.0.1", self.server_port, self.server_port + 1 + i)
+            client.on_message = self.onMessage
+            sent_at = time.monotonic()
+            client.start()
+            self.latency["reg"].append(time.monotonic() - sent_at)
+            self.clients.append(client)
+
+        deadline = time.monotonic() + SETTLE_TIMEOUT
+        while any(len(client.client_table) < len(self.clients) for client in self.clients):
+            if time.monotonic() > deadline:
+                raise RuntimeError("client tables did not converge")
+            time.sleep(0.01)
+
+        for g in range(min(scenario["groups"], len(self.clients))):
+            self.clients[g].createGroup(f"group{g}").result()
+        for i, client in enumerate(self.clients):
+            if scenario["groups"]:
+                client.joinGroup(f"group{i % scenario['groups']}").result()
+        self.members = collections.Counter(i % scenario["groups"] for i in range(len(self.clients))) if scenario["groups"] else {}
+
+    def drive(self, i):
+        # one simulated client: requests_per_client requests of the mix, pipeline of them in flight
+        scenario = self.scenario
+        client = self.clients[i]
+        rng = random.Random(scenario["seed"] * 100003 + i)
+        msg_types = list(scenario["mix"])
+        weights = [scenario["mix"][msg_type] for msg_type in msg_types]
+        in_flight = threading.BoundedSemaphore(scenario["pipeline"])
+        padding = "x" * scenario["message_size"]
+
+        for n in range(scenario["requests_per_client"]):
+            msg_type = rng.choices(msg_types, weights)[0]
+            if msg_type in ("send_group", "list_members") and not scenario["groups"]:
+                msg_type = "list_groups"
+            in_flight.acquire()
+            sent_at = time.monotonic()
+            if msg_type == "pri_msg":
+                target = rng.randrange(len(self.clients) - 1)
+                target = target + 1 if target >= i else target # never itself
+                future = client.sendPrivate(f"load{target}", padding)
+            elif msg_type == "send_group":
+                group = i % scenario["groups"]
+                token = f"{i}.{n}"
+                with self.lock:
+                    self.group_sent[token] = (sent_at, self.members[group] - 1)
+                future = client.sendGroup(f"group{group}", token + " " + padding)
+            elif msg_type == "list_members":
+                future = client.listMembers(f"group{i % scenario['groups']}")
+            else:
+                future = client.submit("server", msg_type, None)
+            future.add_done_callback(lambda future, msg_type=msg_type, sent_at=sent_at: (self.record(msg_type, sent_at, future), in_flight.release()))
+
+        # wait for the last requests of this client
+        for _ in range(scenario["pipeline"]):
+            in_flight.acquire()
+
+    def teardown(self):
+        for client in self.clients:
+            sent_at = time.monotonic()
+            future = client.dereg()
+            self.record("dereg", sent_at, future)
+            client.stop()
+
+    def run(self):
+        self.setup()
+        workers = [threading.Thread(target=self.drive, args=(i,)) for i in range(len(self.clients))]
+        started_at = time.monotonic()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.monotonic() - started_at
+
+        # group messages still on their way to the last members
+        deadline = time.monotonic() + SETTLE_TIMEOUT
+        while time.monotonic() < deadline:
+            with self.lock:
+                if all(len(self.group_arrivals[token]) >= expected for token, (_, expected) in self.group_sent.items()):
+                    break
+            time.sleep(0.01)
+        self.teardown()
+        return self.report(elapsed)
+
+    def report(self, elapsed):
+        requests = sum(len(self.latency[msg_type]) + self.failed[msg_type] for msg_type in self.scenario["mix"])
+        acked = sum(len(self.latency[msg_type]) for msg_type in self.scenario["mix"])
+        fanout = []
+        expected_total = 0
+        delivered_total = 0
+        for token, (sent_at, expected) in self.group_sent.items():
+            arrivals = self.group_arrivals.get(token, [])
+            expected_total += expected
+            delivered_total += min(len(arrivals), expected)
+            if arrivals and len(arrivals) >= expected:
+                fanout.append(max(arrivals) - sent_at)
+        all_latency = [latency for msg_type in self.scenario["mix"] for latency in self.latency[msg_type]]
+        return {
+            "requests": requests,
+            "elapsed": elapsed,
+            "requests_per_sec": requests / elapsed if elapsed else 0.0,
+            "p50_ms": percentile(all_latency, 50) * 1000,
+            "p99_ms": percentile(all_latency, 99) * 1000,
+            "per_type": {
+                msg_type: {
+                    "acked": len(latencies),
+                    "failed": self.failed[msg_type],
+                    "p50_ms": percentile(latencies, 50) * 1000,
+                    "p99_ms": percentile(latencies, 99) * 1000,
+                }
+                for msg_type, latencies in self.latency.items()
+            },
+            "fanout_p50_ms": percentile(fanout, 50) * 1000,
+            "fanout_p99_ms": percentile(fanout, 99) * 1000,
+            # requests never acked + group messages that never reached a member
+            "loss": ((requests - acked) + (expected_total - delivered_total)) / ((requests + expected_total) or 1),
+        }
+
+
+def printReport(result):
+    print(f"requests      {result['requests']} in {result['elapsed']:.2f}s, {result['requests_per_sec']:,.0f} req/s")
+    print(f"ack latency   p50 {result['p50_ms']:.2f}ms  p99 {result['p99_ms']:.2f}ms")
+    print(f"group fan-out p50 {result['fanout_p50_ms']:.2f}ms  p99 {result['fanout_p99_ms']:.2f}ms")
+    print(f"loss          {result['loss']:.2%}")
+    print(f"{'msg_type':<14}{'acked':>8}{'failed':>8}{'p50 ms':>10}{'p99 ms':>10}")
+    for msg_type, stats in result["per_type"].items():
+        print(f"{msg_type:<14}{stats['acked']:>8}{stats['failed']:>8}{stats['p50_ms']:>10.2f}{stats['p99_ms']:>10.2f}")
+
+
+if __name__ == "__main__":
+    scenario = {}
+    engine = "threads"
+    workers = 1
+    server_port = 7700
+    result_file = None
+    args = sys.argv[1:]
+    try:
+        while args:
+            arg = args.pop(0)
+            if arg == "--engine":
+                engine = args.pop(0)
+            elif arg == "--workers":
+                workers = int(args.pop(0))
+            elif arg == "--port":
+                server_port = int(args.pop(0))
+            elif arg == "--json":
+                result_file = args.pop(0)
+            else:
+                with open(arg) as f:
+                    scenario = json.load(f)
+    except (IndexError, ValueError):
+        print("usage: python3 bench_load.py [scenario.json] [--engine threads|asyncio] [--workers <number>] [--port <server-port>] [--json <result-file>]")
+        sys.exit(1)
+
+    server = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "ChatApp.py"),
+                               "-s", str(server_port), "--engine", engine, "--workers", str(workers)], stdout=subprocess.DEVNULL)
+    time.sleep(0.5) # let the server bind its socket
+    try:
+        result = LoadRun(scenario, server_port).run()
+    finally:
+        server.terminate()
+
+    printReport(result)
+    if result_file:
+        with open(result_file, "w") as f:
+            json.dump(result, f, indent=4)
+
+    broken = []
+    if "max_loss" in scenario and result["loss"] > scenario["max_loss"]:
+        broken.append(f"loss {result['loss']:.2%} > {scenario['max_loss']:.2%}")
+    if "max_p99_ms" in scenario and result["p99_ms"] > scenario["max_p99_ms"]:
+        broken.append(f"p99 {result['p99_ms']:.2f}ms > {scenario['max_p99_ms']}ms")
+    if broken:
+        print("FAILED: " + ", ".join(broken))
+        sys.exit(1)
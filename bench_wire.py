@@ -0,0 +1,55 @@
+'''
+Micro-benchmark of the two wire formats in ChatApp.py
+text:   packetFormat(...).encode() / packetResolve(...)
+binary: packetEncode(..., wire=WIRE_BINARY) / packetDecode(...)
+zlib:   packetEncode(..., wire=WIRE_BINARY, compressor=Compressor()) / packetDecode(...)
+
+usage: python3 bench_wire.py [number-of-iterations]
+'''
+import sys
+import json
+import timeit
+
+from ChatApp import packetFormat, packetResolve, packetEncode, packetDecode, WIRE_BINARY, Compressor
+
+REPEAT = 5 # best of REPEAT runs, to keep the numbers stable
+
+
+# representative packets: (msg_type, msg)
+client_table = {f"client{i}": {"ip": "127.0.0.1", "port": 7000 + i, "online": True} for i in range(50)}
+SAMPLES = {
+    "ack": ("ack", None),
+    "grp_ack": ("ack", "senderA;1042"),
+    "grp_msg": ("grp_msg", "senderA;1042;" + "hello everyone, how is it going? " * 4),
+    "table": ("table", json.dumps(client_table)),
+}
+
+
+def best(func, number):
+    return min(timeit.repeat(func, number=number, repeat=REPEAT))
+
+
+def bench(iterations):
+    print(f"{'packet':<10}{'format':<8}{'bytes':>7}{'encode/s':>14}{'decode/s':>14}")
+    for sample_name, (msg_type, msg) in SAMPLES.items():
+        text_packet = packetFormat(7771, "senderA", msg_type, msg).encode()
+        binary_packet = packetEncode(7771, "senderA", msg_type, msg, wire=WIRE_BINARY)
+        zlib_packet = packetEncode(7771, "senderA", msg_type, msg, wire=WIRE_BINARY, compressor=Compressor())
+        assert packetResolve(text_packet) == packetDecode(binary_packet)[:4] == packetDecode(zlib_packet)[:4]
+
+        text_encode = best(lambda: packetFormat(7771, "senderA", msg_type, msg).encode(), number=iterations)
+        text_decode = best(lambda: packetResolve(text_packet), number=iterations)
+        binary_encode = best(lambda: packetEncode(7771, "senderA", msg_type, msg, wire=WIRE_BINARY), number=iterations)
+        binary_decode = best(lambda: packetDecode(binary_packet), number=iterations)
+        compressor = Compressor()
+        zlib_encode = best(lambda: packetEncode(7771, "senderA", msg_type, msg, wire=WIRE_BINARY, compressor=compressor), number=iterations)
+        zlib_decode = best(lambda: packetDecode(zlib_packet), number=iterations)
+
+        print(f"{sample_name:<10}{'text':<8}{len(text_packet):>7}{iterations / text_encode:>14,.0f}{iterations / text_decode:>14,.0f}")
+        print(f"{'':<10}{'binary':<8}{len(binary_packet):>7}{iterations / binary_encode:>14,.0f}{iterations / binary_decode:>14,.0f}")
+        print(f"{'':<10}{'zlib':<8}{len(zlib_packet):>7}{iterations / zlib_encode:>14,.0f}{iterations / zlib_decode:>14,.0f}")
+
+
+if __name__ == "__main__":
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    bench(iterations)
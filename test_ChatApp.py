@@ -0,0 +1,657 @@
+'''
+Regression tests of ChatApp.py
+most tests start the server on localhost (python3 ChatApp.py -s <port> ...) and drive clients over real UDP sockets
+with the Client API, the same tests against every server engine (threads, asyncio, sharded with --workers 3);
+ShardedStateTest drives workers of the sharded server in this process, to lose a peer datagram on purpose
+
+usage: python3 -m unittest test_ChatApp  OR  python3 -m pytest test_ChatApp.py
+'''
+import sys
+import os
+import time
+import json
+import zlib
+import shutil
+import tempfile
+import itertools
+import threading
+import subprocess
+import unittest
+from socket import socket, AF_INET, SOCK_DGRAM
+
+from ChatApp import Client, DeliveryError, Server, AsyncServer, ShardedServer, AckTimerWheel, GroupSlots, MessageSpool, packetEncode, VERBOSE_QUIET, REPLY_CACHE_SIZE, GROUP_SEQ_RESERVE
+from ChatApp import packetDecode, RateLimiter, Compressor, COMPRESS_MIN, MAX_DECOMPRESSED, ZLIB_DICTIONARY
+from ChatApp import WIRE_TEXT, WIRE_BINARY, WIRE_HEADER, WIRE_MAGIC, WIRE_VERSION, FLAG_HAS_MSG, FLAG_ZLIB
+from ChatApp import BatchReceiver, FragmentLayer, FRAGMENT_HEADER, FRAGMENT_MAGIC, FRAGMENT_DATA, FRAGMENT_NACK
+
+SERVER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ChatApp.py")
+PORTS = itertools.count(17000 + os.getpid() % 1000 * 20, 20) # every test gets its own 20 ports
+RESULT_TIMEOUT = 10 # sec a request may take, clients give up after their own retransmissions long before
+MALFORMED_PACKETS = [
+    b"",
+    bytes([WIRE_MAGIC, 2]) + b"\0" * 13, # unknown wire version
+    WIRE_HEADER.pack(WIRE_MAGIC, WIRE_VERSION, 200, 0, 40000, 1, 0, 0), # unknown msg_type
+    bytes([WIRE_MAGIC, WIRE_VERSION, 0]), # truncated header
+    WIRE_HEADER.pack(WIRE_MAGIC, WIRE_VERSION, 9, FLAG_HAS_MSG | FLAG_ZLIB, 40000, 1, 1, 4) + b"a" + b"\xff" * 4, # bad zlib data
+    WIRE_HEADER.pack(WIRE_MAGIC, WIRE_VERSION, 9, FLAG_HAS_MSG, 40000, 1, 1, 2) + b"a" + b"\xff\xfe", # not utf-8
+    b"port\nnot a number\n",
+]
+
+
+class ThreadsEngineTest(unittest.TestCase):
+    engine_args = []
+    stats_ports = 1 # workers answering on stats port, stats port + 1, ...
+
+    def startServer(self, *args):
+        # start the server with the options of this test, stopped when the test ends
+        server = subprocess.Popen([sys.executable, SERVER_PATH, "-s", str(self.port)] + self.engine_args + list(args), stdout=subprocess.DEVNULL)
+        self.addCleanup(server.wait)
+        self.addCleanup(server.terminate)
+        time.sleep(0.5) # let the server bind its socket
+        return server
+
+    def waitFor(self, condition):
+        deadline = time.monotonic() + RESULT_TIMEOUT
+        while not condition():
+            self.assertLess(time.monotonic(), deadline, "timed out")
+            time.sleep(0.01)
+
+    def startClient(self, name, **options):
+        # registered client listening on the next free port of this test, stopped when the test ends
+        client = Client(name, "127.0.0.1", self.port, next(self.client_ports), **options)
+        client.on_message = lambda msg_type, sender_name, text: self.received.append((client.name, msg_type, sender_name, text))
+        client.start()
+        self.addCleanup(client.stop)
+        return client
+
+    def stats(self):
+        # metrics of the server started with "--stats", str(self.port + 10): counters and gauges summed over the workers
+        counters, gauges = {}, {}
+        with socket(AF_INET, SOCK_DGRAM) as sock:
+            sock.settimeout(RESULT_TIMEOUT)
+            for port in range(self.port + 10, self.port + 10 + self.stats_ports):
+                sock.sendto(b"stats", ("127.0.0.1", port))
+                stats = json.loads(sock.recv(65535))
+                for name, n in stats["counters"].items():
+                    counters[name] = counters.get(name, 0) + n
+                for name, n in stats["gauges"].items():
+                    if isinstance(n, int):
+                        gauges[name] = gauges.get(name, 0) + n
+        return counters, gauges
+
+    def setUp(self):
+        self.port = next(PORTS)
+        self.client_ports = itertools.count(self.port + 1)
+        self.received = [] # (recipient, msg_type, sender_name, text) of every message shown to a client
+
+    def testUnknownGroup(self):
+        # requests about a group that does not exist are answered, and the server keeps answering afterwards
+        self.startServer()
+        a = self.startClient("a")
+        self.assertEqual(a.listMembers("nope").result(RESULT_TIMEOUT), "not exists")
+        self.assertEqual(a.leaveGroup("nope").result(RESULT_TIMEOUT), "not exists")
+        self.assertEqual(a.sendGroup("nope", "hello").result(RESULT_TIMEOUT), "not exists")
+        self.assertEqual(a.createGroup("g").result(RESULT_TIMEOUT), "created")
+        self.assertEqual(a.joinGroup("g").result(RESULT_TIMEOUT), "joined")
+        self.assertEqual(a.listMembers("g").result(RESULT_TIMEOUT), "a")
+
+    def testMalformedDatagrams(self):
+        # garbage is dropped by the server and by a client, both keep answering
+        self.startServer()
+        a = self.startClient("a")
+        with socket(AF_INET, SOCK_DGRAM) as sock:
+            for packet in MALFORMED_PACKETS:
+                sock.sendto(packet, ("127.0.0.1", self.port))
+                sock.sendto(packet, ("127.0.0.1", a.client_listen_port))
+        self.assertEqual(a.createGroup("g").result(RESULT_TIMEOUT), "created")
+        self.waitFor(lambda: a.malformed_packets == len(MALFORMED_PACKETS))
+
+    def testCompressedGroupMessage(self):
+        # a long group message reaches a zlib client compressed, and is shown as it was sent
+        self.startServer("--stats", str(self.port + 10))
+        a = self.startClient("a")
+        b = self.startClient("b")
+        a.createGroup("g").result(RESULT_TIMEOUT)
+        a.joinGroup("g").result(RESULT_TIMEOUT)
+        b.joinGroup("g").result(RESULT_TIMEOUT)
+        text = "the same words over and over again, " * 20
+        a.sendGroup("g", text).result(RESULT_TIMEOUT)
+        self.waitFor(lambda: ("b", "grp_msg", "a", text) in self.received)
+        _, gauges = self.stats()
+        self.assertGreater(gauges["compressed_packets"], 0)
+        self.assertGreater(gauges["compression_saved_bytes"], len(text) // 2)
+
+    def testHeartbeatSetsSilentClientOffline(self):
+        # a client that stops answering pings is set offline after --misses rounds, one that answers stays online
+        self.startServer("--heartbeat", "100", "--misses", "2", "--stats", str(self.port + 10))
+        a = self.startClient("a")
+        b = Client("b", "127.0.0.1", self.port, next(self.client_ports)).start()
+        self.waitFor(lambda: a.client_table.get("b", {}).get("online"))
+        b.stop() # gone without dereg
+        self.waitFor(lambda: not a.client_table["b"]["online"])
+        time.sleep(0.5) # five more rounds
+        self.assertTrue(a.client_table["a"]["online"])
+        self.assertEqual(a.createGroup("g").result(RESULT_TIMEOUT), "created")
+        counters, _ = self.stats()
+        self.assertEqual(counters["heartbeat_offline"], 1)
+
+    def testRateLimitSlowsClientDown(self):
+        # requests over the sender's rate are answered with slow_down, the client paces itself and gets all answers
+        self.startServer("--rate", "5", "--stats", str(self.port + 10))
+        a = self.startClient("a")
+        futures = [a.createGroup(f"g{i}") for i in range(14)]
+        self.assertEqual([future.result(RESULT_TIMEOUT) for future in futures], ["created"] * 14)
+        counters, _ = self.stats()
+        self.assertGreater(counters["slow_downs"], 0)
+
+    def testMulticastGroup(self):
+        # members that joined the group's multicast address get its messages from there, and a client stops cleanly
+        self.startServer("--multicast", str(self.port + 15), "--stats", str(self.port + 10))
+        a = self.startClient("a")
+        b = self.startClient("b")
+        c = Client("c", "127.0.0.1", self.port, next(self.client_ports)).start() # stopped below
+        c.on_message = lambda msg_type, sender_name, text: self.received.append(("c", msg_type, sender_name, text))
+        a.createGroup("g").result(RESULT_TIMEOUT)
+        for client in (a, b, c):
+            client.joinGroup("g").result(RESULT_TIMEOUT)
+        self.assertIn("g", b.multicast_groups)
+        time.sleep(0.2) # the "multicast" requests reached the server
+        a.sendGroup("g", "hello").result(RESULT_TIMEOUT)
+        self.waitFor(lambda: ("b", "grp_msg", "a", "hello") in self.received and ("c", "grp_msg", "a", "hello") in self.received)
+        counters, _ = self.stats()
+        self.assertGreater(counters["multicast_sends"], 0)
+        errors = []
+        self.addCleanup(setattr, threading, "excepthook", threading.excepthook)
+        threading.excepthook = errors.append
+        c.stop()
+        time.sleep(0.2)
+        self.assertFalse(c.thread_multicast.is_alive())
+        self.assertEqual(errors, [])
+
+    def testMulticastFallback(self):
+        # a member the multicast datagrams do not reach misses the ack, gets unicast from then on and the lost message from history
+        self.startServer("--multicast", str(self.port + 15), "--stats", str(self.port + 10))
+        a = self.startClient("a")
+        b = self.startClient("b")
+        a.createGroup("g").result(RESULT_TIMEOUT)
+        a.joinGroup("g").result(RESULT_TIMEOUT)
+        b.joinGroup("g").result(RESULT_TIMEOUT)
+        time.sleep(0.2)
+        with b.group_lock:
+            b.multicast_groups.clear() # b drops what comes from the address
+        a.sendGroup("g", "lost").result(RESULT_TIMEOUT)
+        time.sleep(1) # the ack deadline passes
+        a.sendGroup("g", "unicast").result(RESULT_TIMEOUT)
+        self.waitFor(lambda: ("b", "grp_msg", "a", "unicast") in self.received)
+        self.assertIn(("b", "grp_msg", "a", "lost"), self.received)
+        self.assertEqual(b.listMembers("g").result(RESULT_TIMEOUT).split(";").count("b"), 1)
+        counters, _ = self.stats()
+        self.assertEqual(counters["multicast_fallbacks"], 1)
+
+    def testWindowKeepsRetransmissionsCached(self):
+        # while its oldest request waits for an ack, a client sends at most REPLY_CACHE_SIZE - 1 newer ones,
+        # the server still has the reply of the oldest one when it is retransmitted
+        self.startServer()
+        a = self.startClient("a")
+        self.waitFor(lambda: a.last_seq and not a.pending) # the spool fetched right after registering is answered
+        a.client_table["ghost"] = {"ip": "127.0.0.1", "port": next(self.client_ports), "online": True} # never acks
+        stuck = a.submit("ghost", "pri_msg", "hello")
+        for _ in range(REPLY_CACHE_SIZE - 1):
+            a.listGroups().result(RESULT_TIMEOUT)
+        blocked = threading.Thread(target=a.listGroups)
+        blocked.start()
+        blocked.join(0.3)
+        self.assertTrue(blocked.is_alive())
+        with self.assertRaises(DeliveryError):
+            stuck.result(RESULT_TIMEOUT)
+        blocked.join(RESULT_TIMEOUT)
+        self.assertFalse(blocked.is_alive())
+
+    def testGapFetchWaitsWithoutGroupLock(self):
+        # a gap found while the window is full is fetched once there is room, group messages still get through meanwhile
+        self.startServer()
+        a = self.startClient("a")
+        self.waitFor(lambda: a.last_seq and not a.pending) # the spool fetched right after registering is answered
+        a.client_table["ghost"] = {"ip": "127.0.0.1", "port": next(self.client_ports), "online": True} # never acks
+        stuck = a.submit("ghost", "pri_msg", "hello")
+        for _ in range(REPLY_CACHE_SIZE - 1):
+            a.listGroups()
+        a.group_seqs["g"] = 1
+        receiving = threading.Thread(target=a.groupReceived, args=("g", 5, ("b", "hello"))) # like the multicast thread
+        receiving.start()
+        receiving.join(0.3)
+        self.assertTrue(receiving.is_alive()) # waits for the window with its history request
+        self.assertTrue(a.group_lock.acquire(timeout=0.3))
+        a.group_lock.release()
+        with self.assertRaises(DeliveryError):
+            stuck.result(RESULT_TIMEOUT)
+        receiving.join(RESULT_TIMEOUT)
+        self.waitFor(lambda: a.group_seqs["g"] == 5)
+
+    def testOfflineNameStaysTaken(self):
+        # without --spool a name never comes back, like before the spool
+        self.startServer()
+        b = self.startClient("b")
+        b.dereg().result(RESULT_TIMEOUT)
+        with self.assertRaises(DeliveryError):
+            self.startClient("b")
+
+    def testSpoolToClientBackOnline(self):
+        # a message spooled while the sender's table still shows the recipient offline is delivered directly
+        self.startServer("--spool", "10")
+        a = self.startClient("a")
+        b = self.startClient("b")
+        b.dereg().result(RESULT_TIMEOUT)
+        self.waitFor(lambda: not a.client_table.get("b", {"online": True})["online"])
+        b = self.startClient("b")
+        a.client_table["b"] = dict(a.client_table["b"], online=False) # the change has not reached a yet
+        self.assertIsNone(a.sendPrivate("b", "hello").result(RESULT_TIMEOUT))
+        self.waitFor(lambda: ("b", "pri_msg", "a", "hello") in self.received)
+
+    def testGroupSeqAfterRestart(self):
+        # a restarted server numbers group messages right after the seqs it reserved, members skip no more than that
+        state_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, state_dir)
+        server = self.startServer("--state", state_dir)
+        a = self.startClient("a")
+        b = self.startClient("b")
+        a.createGroup("g").result(RESULT_TIMEOUT)
+        a.joinGroup("g").result(RESULT_TIMEOUT)
+        b.joinGroup("g").result(RESULT_TIMEOUT)
+        a.sendGroup("g", "before").result(RESULT_TIMEOUT)
+        self.waitFor(lambda: ("b", "grp_msg", "a", "before") in self.received)
+        seq_before = b.group_seqs["g"]
+
+        server.terminate()
+        server.wait()
+        time.sleep(0.5) # uptime of the old server, it must not show in the seqs
+        self.startServer("--state", state_dir)
+        a.sendGroup("g", "after").result(RESULT_TIMEOUT)
+        self.waitFor(lambda: ("b", "grp_msg", "a", "after") in self.received)
+        self.assertLessEqual(b.group_seqs["g"] - seq_before, GROUP_SEQ_RESERVE)
+        self.assertEqual(b.group_held.get("g", {}), {})
+
+
+class MessageSpoolTest(unittest.TestCase):
+    def testBytesAreEncoded(self):
+        spool = MessageSpool(max_per_recipient=2, max_bytes=10)
+        self.assertEqual(spool.put("b", "a", "\u00e9\u00e9\u00e9\u00e9"), "queued") # 8 bytes in utf-8
+        self.assertEqual(spool.put("b", "a", "\u00e9\u00e9"), "full")
+        self.assertEqual(spool.stats()["bytes"], 8)
+        self.assertEqual(spool.take("b", 3000), [("a", "\u00e9\u00e9\u00e9\u00e9")])
+        self.assertEqual(spool.stats()["bytes"], 0)
+
+
+class BatchReceiverTest(unittest.TestCase):
+    def testCloseEndsIteration(self):
+        # close() wakes up the iterating thread, which ends without an error
+        sock = socket(AF_INET, SOCK_DGRAM)
+        self.addCleanup(sock.close)
+        sock.bind(("127.0.0.1", 0))
+        receiver = BatchReceiver(sock)
+        received = []
+        def iterate():
+            for data, _ in receiver:
+                received.append(data)
+        thread = threading.Thread(target=iterate)
+        thread.start()
+        with socket(AF_INET, SOCK_DGRAM) as sender:
+            sender.sendto(b"hello", sock.getsockname())
+        deadline = time.monotonic() + RESULT_TIMEOUT
+        while not received and time.monotonic() < deadline:
+            time.sleep(0.01)
+        receiver.close()
+        thread.join(RESULT_TIMEOUT)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(received, [b"hello"])
+
+    def testSocketWithTimeout(self):
+        # recvfrom path: a batch is what is already waiting, no wait for the timeout, which only ends a quiet receive
+        sock = socket(AF_INET, SOCK_DGRAM)
+        self.addCleanup(sock.close)
+        sock.bind(("127.0.0.1", 0))
+        sock.settimeout(2)
+        receiver = BatchReceiver(sock)
+        with socket(AF_INET, SOCK_DGRAM) as sender:
+            for i in range(3):
+                sender.sendto(b"%d" % i, sock.getsockname())
+        time.sleep(0.1)
+        start = time.monotonic()
+        self.assertEqual([data for data, _ in receiver.receive()], [b"0", b"1", b"2"])
+        self.assertLess(time.monotonic() - start, 1)
+        sock.settimeout(0.1)
+        with self.assertRaises(TimeoutError):
+            receiver.receive()
+
+
+class WireFormatTest(unittest.TestCase):
+    TABLE = json.dumps({"version": 7, "table": {f"client{i}": {"ip": "127.0.0.1", "port": 6000 + i, "online": True} for i in range(5)}})
+
+    def testRoundTrip(self):
+        for wire in (WIRE_TEXT, WIRE_BINARY):
+            self.assertEqual(packetDecode(packetEncode(40001, "a", "send_group", "g;hello", wire=wire))[:4], (40001, "a", "send_group", "g;hello"))
+            self.assertEqual(packetDecode(packetEncode(40001, "a", "list_groups", None, wire=wire))[:4], (40001, "a", "list_groups", None))
+        self.assertEqual(packetDecode(packetEncode(40001, "a", "list_groups", None, seq=9))[4], 9)
+
+    def testCompressedRoundTrip(self):
+        # with a Compressor the message is sent with FLAG_ZLIB, deflated against the preset dictionary
+        compressor = Compressor()
+        packet = packetEncode(40000, "server", "snapshot", self.TABLE, compressor=compressor)
+        flags, msg_len = WIRE_HEADER.unpack_from(packet)[3], WIRE_HEADER.unpack_from(packet)[7]
+        self.assertTrue(flags & FLAG_ZLIB)
+        self.assertLess(msg_len, len(self.TABLE))
+        self.assertEqual(packetDecode(packet), (40000, "server", "snapshot", self.TABLE, 0))
+        self.assertEqual(compressor.packets, 1)
+        self.assertEqual(compressor.saved(), len(self.TABLE) - msg_len)
+        compressed = packet[-msg_len:]
+        with self.assertRaises(zlib.error):
+            zlib.decompress(compressed) # needs the dictionary
+        decompressor = zlib.decompressobj(zdict=ZLIB_DICTIONARY)
+        self.assertEqual(decompressor.decompress(compressed), self.TABLE.encode())
+
+    def testShortStaysRaw(self):
+        compressor = Compressor()
+        packet = packetEncode(40000, "server", "delta", "x" * (COMPRESS_MIN - 1), compressor=compressor)
+        self.assertFalse(WIRE_HEADER.unpack_from(packet)[3] & FLAG_ZLIB)
+        self.assertEqual(compressor.packets, 0)
+
+    def testDecompressedSizeIsBounded(self):
+        deflater = zlib.compressobj(zdict=ZLIB_DICTIONARY)
+        bomb = deflater.compress(b"\0" * (MAX_DECOMPRESSED + 1)) + deflater.flush()
+        packet = WIRE_HEADER.pack(WIRE_MAGIC, WIRE_VERSION, 6, FLAG_HAS_MSG | FLAG_ZLIB, 40000, 0, 6, len(bomb)) + b"server" + bomb
+        with self.assertRaises(ValueError):
+            packetDecode(packet)
+
+
+class FragmentLayerTest(unittest.TestCase):
+    ADDR = ("127.0.0.1", 40001)
+
+    def setUp(self):
+        self.sent = [] # (datagram, addr) sent by the layer: nacks and retransmitted fragments
+        self.layer = FragmentLayer(40001, lambda datagram, addr: self.sent.append((datagram, addr)))
+        self.packet = bytes([WIRE_MAGIC]) + bytes(range(256)) * 12
+        self.fragments = self.layer.split(self.packet)
+
+    def forged(self, kind, index, count, rest=b""):
+        frag_id = FRAGMENT_HEADER.unpack_from(self.fragments[0])[2]
+        return FRAGMENT_HEADER.pack(FRAGMENT_MAGIC, kind, frag_id, index, count, 40001) + rest
+
+    def testOutOfOrder(self):
+        self.assertEqual(len(self.fragments), 3)
+        self.assertIsNone(self.layer.receive(self.fragments[2], self.ADDR))
+        self.assertIsNone(self.layer.receive(self.fragments[0], self.ADDR))
+        self.assertEqual(self.layer.receive(self.fragments[1], self.ADDR), self.packet)
+        self.assertEqual(self.layer.partial, {})
+
+    def testDuplicate(self):
+        self.assertIsNone(self.layer.receive(self.fragments[0], self.ADDR))
+        self.assertIsNone(self.layer.receive(self.fragments[0], self.ADDR))
+        self.assertIsNone(self.layer.receive(self.fragments[1], self.ADDR))
+        self.assertEqual(self.layer.receive(self.fragments[2], self.ADDR), self.packet)
+        self.assertEqual(self.layer.reassembled, 1)
+
+    def testBadIndexOrCount(self):
+        # fragments that do not fit the packet are dropped, the packet still completes from the right ones
+        self.assertIsNone(self.layer.receive(self.fragments[0], self.ADDR))
+        self.assertIsNone(self.layer.receive(self.forged(FRAGMENT_DATA, 5, 3, b"x"), self.ADDR))
+        self.assertIsNone(self.layer.receive(self.forged(FRAGMENT_DATA, 1, 2, b"x"), self.ADDR))
+        self.assertIsNone(self.layer.receive(self.fragments[1], self.ADDR))
+        self.assertEqual(self.layer.receive(self.fragments[2], self.ADDR), self.packet)
+        self.assertIsNone(self.layer.receive(self.forged(FRAGMENT_DATA, 0, 0), self.ADDR))
+        self.assertEqual(self.layer.rejected, 3)
+
+    def testShortDatagrams(self):
+        self.assertIsNone(self.layer.receive(bytes([FRAGMENT_MAGIC, FRAGMENT_DATA]), self.ADDR))
+        self.assertIsNone(self.layer.receive(self.forged(FRAGMENT_NACK, 0, 10, b"\0\1"), self.ADDR))
+        self.assertEqual(self.layer.rejected, 2)
+        self.assertEqual(self.sent, [])
+
+    def testNack(self):
+        # only the fragments asked for are sent again, to the listening port in the nack
+        self.layer.receive(self.forged(FRAGMENT_NACK, 0, 2, b"\0\2\0\7"), ("127.0.0.1", 50000))
+        self.assertEqual(self.sent, [(self.fragments[2], ("127.0.0.1", 40001))])
+
+
+class GroupSlotsTest(unittest.TestCase):
+    def testMaskAndNames(self):
+        slots = GroupSlots()
+        for name in ("a", "b", "c"):
+            slots.assign(name)
+        slots.assign("a") # already in
+        self.assertEqual(slots.mask(["a", "c"]), 0b101)
+        self.assertEqual(slots.names(0b111), {"a", "b", "c"})
+        slots.release("b")
+        self.assertEqual(slots.names(0b111), {"a", "c"}) # a message in flight still has b's bit
+
+    def testReleasedSlotWaits(self):
+        # a released slot is not given to the next member before REUSE_AFTER, then it is
+        slots = GroupSlots()
+        slots.assign("a")
+        slots.assign("b")
+        slots.release("a")
+        slots.assign("c")
+        self.assertEqual(slots.mask(["c"]), 0b100)
+        slots.released[0] = (slots.released[0][0] - GroupSlots.REUSE_AFTER, slots.released[0][1])
+        slots.assign("d")
+        self.assertEqual(slots.mask(["d"]), 0b001)
+        self.assertEqual(slots.names(0b001), {"d"})
+
+
+class RateLimiterTest(unittest.TestCase):
+    def testTokenBucket(self):
+        limiter = RateLimiter(rate=10, burst=2)
+        self.assertEqual([limiter.take("a", 100.0) for _ in range(2)], [0, 0]) # the burst
+        self.assertAlmostEqual(limiter.take("a", 100.0), 0.1) # sec until the next token
+        self.assertEqual(limiter.take("b", 100.0), 0) # every key has its own bucket
+        self.assertEqual(limiter.take("a", 100.15), 0) # 1.5 tokens refilled
+        self.assertAlmostEqual(limiter.take("a", 100.15), 0.05)
+        waits = [limiter.take("a", 110.0) for _ in range(3)] # refilled up to the burst only
+        self.assertEqual(waits[:2], [0, 0])
+        self.assertGreater(waits[2], 0)
+
+
+class AckTimerWheelTest(unittest.TestCase):
+    def startWheel(self):
+        self.expired = []
+        slots = {"a": 0, "b": 1, "c": 2}
+        return AckTimerWheel(on_expire=lambda group_name, mask: self.expired.append((group_name, mask)), slot_of=lambda group_name, name: slots.get(name))
+
+    def testExpiry(self):
+        # what is not acked by the deadline expires with the bits of the members that did not ack
+        wheel = self.startWheel()
+        now = wheel.next_tick
+        wheel.add(1, "g", 0b111, 0.2)
+        wheel.add(2, "g", 0b011, 0.2)
+        wheel.add(3, "g", 0b000, 0.2) # nobody to wait for
+        wheel.ack(1, "a")
+        wheel.ack(2, "a")
+        wheel.ack(2, "b") # fully acked, dropped at once
+        wheel.ack(1, "nobody")
+        self.assertEqual(wheel.pendingCount(), 1)
+        wheel.advance(now + 0.1)
+        self.assertEqual(self.expired, [])
+        wheel.advance(now + 0.4)
+        self.assertEqual(self.expired, [("g", 0b110)])
+        self.assertEqual(wheel.pendingCount(), 0)
+        wheel.ack(1, "b") # late ack
+
+    def testDeadlineAfterATurn(self):
+        # a deadline further away than one turn of the wheel waits for its own turn
+        wheel = self.startWheel()
+        now = wheel.next_tick
+        turn = wheel.tick * len(wheel.slots)
+        wheel.add(1, "g", 0b1, turn + 1)
+        wheel.advance(now + turn + 0.1)
+        self.assertEqual(self.expired, [])
+        wheel.advance(now + turn + 1.1)
+        self.assertEqual(self.expired, [("g", 0b1)])
+
+
+class ServerStateTest(unittest.TestCase):
+    """
+    a server driven in this process, without its threads: requests go straight to serverDispatch
+    """
+    def startServer(self):
+        server = Server(next(PORTS), verbosity=VERBOSE_QUIET)
+        self.addCleanup(server.server_listen_socket.close)
+        return server
+
+    def testReplyCacheReplay(self):
+        # a send_group retransmitted after REPLY_CACHE_SIZE - 1 newer requests is answered from reply_cache, not sent again
+        server = self.startServer()
+        for name, port in (("a", 40001), ("b", 40002)):
+            server.serverDispatch(packetEncode(port, name, "reg", None, seq=1), ("127.0.0.1", 50000))
+        server.serverDispatch(packetEncode(40001, "a", "create_group", "g", seq=2), ("127.0.0.1", 50000))
+        server.serverDispatch(packetEncode(40001, "a", "join_group", "g", seq=3), ("127.0.0.1", 50000))
+        server.serverDispatch(packetEncode(40002, "b", "join_group", "g", seq=2), ("127.0.0.1", 50000))
+        request = packetEncode(40001, "a", "send_group", "g;hello", seq=4)
+        server.serverDispatch(request, ("127.0.0.1", 50000))
+        for seq in range(5, 4 + REPLY_CACHE_SIZE):
+            server.serverDispatch(packetEncode(40001, "a", "list_groups", None, seq=seq), ("127.0.0.1", 50000))
+        server.serverDispatch(request, ("127.0.0.1", 50000))
+        self.assertEqual(server.metrics.counters["reply_cache_hits"], 1)
+        self.assertEqual(server.metrics.fanout_size.count, 1)
+
+    def testEvictNonresponsive(self):
+        # a member that does not ack a group message by its deadline is removed from the group
+        server = self.startServer()
+        for name, port in (("a", 40001), ("b", 40002), ("c", 40003)):
+            server.serverDispatch(packetEncode(port, name, "reg", None, seq=1), ("127.0.0.1", port))
+            if name == "a":
+                server.serverDispatch(packetEncode(port, name, "create_group", "g", seq=2), ("127.0.0.1", port))
+            server.serverDispatch(packetEncode(port, name, "join_group", "g", seq=3), ("127.0.0.1", port))
+        server.serverDispatch(packetEncode(40001, "a", "send_group", "g;hello", seq=4), ("127.0.0.1", 40001))
+        msg_id = next(server.msg_ids) - 1
+        server.serverDispatch(packetEncode(40002, "b", "ack", f"a;{msg_id}"), ("127.0.0.1", 40002))
+        server.ack_wheel.advance(time.monotonic() + 1)
+        self.assertEqual(server.group_table["g"], {"a", "b"})
+        self.assertEqual(server.metrics.counters["evicted_members"], 1)
+
+    def testSlowDown(self):
+        # a request over the sender's rate is dropped; a CAP_SLOW_DOWN client is told how long to wait, under the request's seq
+        server = Server(next(PORTS), verbosity=VERBOSE_QUIET, rate_limit=1)
+        self.addCleanup(server.server_listen_socket.close)
+        sent = []
+        server.sendDatagram = lambda datagram, addr: sent.append((packetDecode(datagram), addr))
+        server.serverDispatch(packetEncode(40001, "a", "reg", "binary,slowdown"), ("127.0.0.1", 50000))
+        sent.clear() # reg_ack and table
+        admitted = []
+        for seq in range(2, 6):
+            packet = packetEncode(40001, "a", "list_groups", None, seq=seq)
+            admitted.append(server.serverAdmit(packet, ("127.0.0.1", 50000), packetDecode(packet)))
+        self.assertEqual(admitted, [True, True, False, False])
+        self.assertEqual([(fields[2], fields[4], addr) for fields, addr in sent], [("slow_down", 4, ("127.0.0.1", 40001)), ("slow_down", 5, ("127.0.0.1", 40001))])
+        self.assertGreater(int(sent[0][0][3]), 0)
+        ack = packetEncode(40001, "a", "ack", "b;1")
+        self.assertTrue(server.serverAdmit(ack, ("127.0.0.1", 50000), packetDecode(ack))) # acks always pass
+        self.assertEqual(server.metrics.counters["throttled_senders"], 2)
+
+    def testGroupRate(self):
+        # the messages of one group are limited whoever sends them; a send_group without a message is left to dispatch
+        server = Server(next(PORTS), verbosity=VERBOSE_QUIET, group_rate_limit=1)
+        self.addCleanup(server.server_listen_socket.close)
+        admitted = []
+        for name in ("a", "b", "c"):
+            packet = packetEncode(40001, name, "send_group", "g;hello", seq=2)
+            admitted.append(server.serverAdmit(packet, ("127.0.0.1", 50000), packetDecode(packet)))
+        self.assertEqual(admitted, [True, True, False])
+        self.assertEqual(server.metrics.counters["throttled_groups"], 1)
+        packet = packetEncode(40001, "a", "send_group", None, seq=3)
+        self.assertTrue(server.serverAdmit(packet, ("127.0.0.1", 50000), packetDecode(packet)))
+
+    def testAsyncioEngineHasNoReplyThreads(self):
+        # the event loop reads and writes through its transport, nothing is started for that
+        threads = threading.active_count()
+        server = AsyncServer(next(PORTS), verbosity=VERBOSE_QUIET)
+        self.addCleanup(server.server_listen_socket.close)
+        self.assertIsNone(server.receiver)
+        self.assertIsNone(server.reply_worker)
+        self.assertEqual(threading.active_count(), threads + 1) # the fan-out worker
+        self.assertNotIn("reply_queue", server.statsGauges())
+
+
+class ShardedStateTest(unittest.TestCase):
+    """
+    workers of a sharded server driven in this process, without their threads: requests go straight to serverDispatch
+    and peer datagrams are passed on by hand, so a lost one can be left out
+    """
+    def startWorkers(self, num_shards, **options):
+        peer_sockets = []
+        for _ in range(num_shards):
+            peer_socket = socket(AF_INET, SOCK_DGRAM)
+            peer_socket.bind(("127.0.0.1", 0))
+            self.addCleanup(peer_socket.close)
+            peer_sockets.append(peer_socket)
+        port = next(PORTS)
+        workers = [ShardedServer(port, shard_id, peer_sockets, verbosity=VERBOSE_QUIET, **options) for shard_id in range(num_shards)]
+        for worker in workers:
+            self.addCleanup(worker.server_listen_socket.close)
+        return workers, peer_sockets
+
+    def groupOn(self, shard_id, num_shards):
+        # a group name owned by worker shard_id
+        return next(name for name in (f"g{i}" for i in itertools.count()) if zlib.crc32(name.encode()) % num_shards == shard_id)
+
+    def passOn(self, worker, peer_socket):
+        # apply every peer datagram waiting for worker
+        peer_socket.setblocking(False)
+        try:
+            while True:
+                worker.peerApply(peer_socket.recv(65535))
+        except BlockingIOError:
+            pass
+
+    def testLostTableChange(self):
+        # a member whose replicated client_table entry never reached the group's worker is skipped,
+        # and worker 0 sends the entry again
+        (worker0, worker1), peer_sockets = self.startWorkers(2)
+        group_name = self.groupOn(1, 2)
+        for name, port in (("a", 40001), ("b", 40002)):
+            worker0.client_table[name] = {"ip": "127.0.0.1", "port": port, "online": True}
+            worker0.client_caps[name] = set()
+        worker1.client_table["a"] = dict(worker0.client_table["a"]) # the change about b got lost
+        worker1.group_table[group_name] = {"a", "b"}
+        worker1.group_slots[group_name] = GroupSlots()
+        worker1.group_slots[group_name].assign("a")
+        worker1.group_slots[group_name].assign("b")
+
+        worker1.serverDispatch(packetEncode(40001, "a", "send_group", group_name + ";hello", seq=1), ("127.0.0.1", 40001))
+        self.assertEqual(worker1.metrics.counters["missing_recipients"], 1)
+        self.assertEqual(worker1.metrics.counters["failed_commands"], 0)
+        self.assertEqual(worker1.ack_wheel.pendingCount(), 0) # b owes no ack for a message it never got
+
+        resync = peer_sockets[0].recv(4096)
+        self.assertEqual(json.loads(resync[1:]), {"shard": 1, "names": ["b"]})
+        worker0.peerApply(resync)
+        worker1.peerApply(peer_sockets[1].recv(4096))
+        self.assertEqual(worker1.client_table["b"], worker0.client_table["b"])
+
+    def testRegisterAgainClearsReplies(self):
+        # a client registering again (spool on) starts its seqs anew on every worker, not only on worker 0
+        (worker0, worker1), peer_sockets = self.startWorkers(2, spool_limit=10)
+        addr = ("127.0.0.1", 40001)
+        worker0.serverDispatch(packetEncode(40001, "a", "reg", None), addr) # like Client.register, without a seq
+        self.passOn(worker1, peer_sockets[1])
+        worker1.serverDispatch(packetEncode(40001, "a", "create_group", self.groupOn(1, 2), seq=2), addr)
+        worker0.serverDispatch(packetEncode(40001, "a", "dereg", None, seq=3), addr)
+        self.passOn(worker1, peer_sockets[1])
+
+        worker0.serverDispatch(packetEncode(40001, "a", "reg", None), addr)
+        self.passOn(worker1, peer_sockets[1])
+        group_name = next(name for name in (f"h{i}" for i in itertools.count()) if zlib.crc32(name.encode()) % 2 == 1)
+        worker1.serverDispatch(packetEncode(40001, "a", "create_group", group_name, seq=2), addr)
+        self.assertIn(group_name, worker1.group_table)
+        self.assertEqual(worker1.metrics.counters["reply_cache_hits"], 0)
+
+
+class AsyncioEngineTest(ThreadsEngineTest):
+    engine_args = ["--engine", "asyncio"]
+
+
+class ShardedServerTest(ThreadsEngineTest):
+    engine_args = ["--workers", "3"]
+    stats_ports = 3
+
+
+if __name__ == "__main__":
+    unittest.main()